@@ -3,7 +3,22 @@ from flask import Flask
 import os
 
 
-from app.utils import mail, generate_code
+from app.utils import mail, auth_cache, generate_code
+from app.mailer import mailer
+from app.hashing import hasher
+from app.instrumentation import instrumentation
+from app.timeline import timeline
+from app.cache import object_cache
+from app.graph import graph
+from app.search import search, create_search_indexes_command
+from app.stream import stream
+from app.likes import likes
+from app.ids import ids, migrate_tweet_ids_command
+from app.serializers import serialization
+from app.pagination import InvalidCursor, handle_invalid_cursor
+from app.counters import reconcile_counters_command
+from app.suggestions import compute_suggestions_command
+from app.trends import compute_trends_command
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -15,7 +30,19 @@ def create_app(config):
 
     db.init_app(app)
     ma.init_app(app)
+    instrumentation.init_app(app)
+    hasher.init_app(app)
     mail.init_app(app)
+    mailer.init_app(app)
+    auth_cache.init_app(app)
+    timeline.init_app(app)
+    object_cache.init_app(app)
+    graph.init_app(app)
+    search.init_app(app)
+    stream.init_app(app)
+    likes.init_app(app)
+    ids.init_app(app)
+    serialization.init_app(app)
     with app.app_context():
         db.create_all()
 
@@ -23,4 +50,10 @@ def create_app(config):
     from app.tweet import status as statusBluePrint
     app.register_blueprint(userBluePrint)
     app.register_blueprint(statusBluePrint)
+    app.register_error_handler(InvalidCursor, handle_invalid_cursor)
+    app.cli.add_command(reconcile_counters_command)
+    app.cli.add_command(compute_suggestions_command)
+    app.cli.add_command(compute_trends_command)
+    app.cli.add_command(migrate_tweet_ids_command)
+    app.cli.add_command(create_search_indexes_command)
     return app
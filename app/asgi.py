@@ -0,0 +1,528 @@
+'''ASGI serving mode
+
+The hot read endpoints (home_timeline, a status, the statuses page and a
+user) run on asyncio against an async connection pool, asyncpg on
+PostgreSQL. /statuses/stream is served on the event loop too, an idle
+stream holds no thread. Other databases have no async driver here, their statements
+run on the SQLAlchemy engine in a thread pool. Every other request goes to
+the Flask app on a thread pool, so it behaves exactly as under WSGI.
+
+    uvicorn asgi:app --workers 4
+'''
+import asyncio
+import functools
+import io
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+from sqlalchemy import select
+from sqlalchemy.engine.url import make_url
+from app.models import db, User, Tweet, Favorites, followers, TweetSchema, UserSchema, \
+    FINGERPRINT_COLUMNS, fingerprint
+from app.pagination import InvalidCursor, encode_cursor, decode_cursor, after
+from app.utils import decode_token
+from app.serializers import dump_compiled, make_dumps
+from app.stream import stream, opening_events, format_messages
+from app.timeline import timeline
+
+tweets = Tweet.__table__
+users = User.__table__
+favorites = Favorites.__table__
+user_serializer = UserSchema()
+
+
+class AsyncpgDatabase(object):
+    '''asyncpg pool, statements are compiled for PostgreSQL with $n parameters'''
+
+    def __init__(self, url, min_size, max_size):
+        url = make_url(url)
+        url.drivername = 'postgresql'
+        self.dsn = str(url)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        from sqlalchemy.dialects import postgresql
+        self.dialect = postgresql.dialect(paramstyle='format')
+
+    async def connect(self):
+        import asyncpg
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    def compile(self, statement):
+        compiled = statement.compile(dialect=self.dialect)
+        positions = iter(range(1, len(compiled.positiontup) + 1))
+        sql = re.sub(r'%%|%s', lambda m: '%' if m.group() == '%%' else f'${next(positions)}',
+                     compiled.string)
+        return sql, [compiled.params[name] for name in compiled.positiontup]
+
+    async def fetch(self, statement):
+        sql, params = self.compile(statement)
+        return [dict(r) for r in await self.pool.fetch(sql, *params)]
+
+
+class ThreadedDatabase(object):
+    '''Runs statements on the app's engine in a thread pool, for databases without an async driver'''
+
+    def __init__(self, engine, executor):
+        self.engine = engine
+        self.executor = executor
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _fetch(self, statement):
+        with self.engine.connect() as connection:
+            return [dict(r) for r in connection.execute(statement)]
+
+    async def fetch(self, statement):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._fetch, statement)
+
+
+class Request(object):
+    def __init__(self, scope):
+        self.scope = scope
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        self.args = {k: v[0] for k, v in parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+    def int_arg(self, name):
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return None
+
+
+class Response(object):
+    def __init__(self, payload=None, status=200, etag=None):
+        self.payload = payload
+        self.status = status
+        self.etag = etag
+
+
+async def load_tweets(database, ids, viewer_id=None, buffer=None):
+    '''Tweets of ids with their nested statuses and users, like get_tweet_context
+
+    Returns the tweets as plain objects TweetSchema can dump, the fetched
+    rows keyed by id, their authors and the ids among them the viewer liked.
+    Likes still in the write-behind buffer are counted in, the buffer is
+    read first like read_with_pending_likes does.
+    '''
+    for _ in range(3):
+        snapshot = buffer.snapshot(viewer_id) if buffer is not None else (0, {}, {})
+        rows, authors, liked = await fetch_tweets(database, ids, viewer_id)
+        if buffer is None or buffer.flushes == snapshot[0]:
+            break
+    _, states, counts = snapshot
+    for i, delta in counts.items():
+        if i in rows:
+            rows[i]['like_count'] += delta
+    liked = [i for i in rows if states.get(i, i in liked)]
+
+    objects = {i: SimpleNamespace(user=authors.get(r['user_id']), **r) for i, r in rows.items()}
+    for o in objects.values():
+        o.in_reply_to_status = objects.get(o.in_reply_to_status_id)
+        o.retweet_status = objects.get(o.retweet_status_id)
+    return [objects[i] for i in ids if i in objects], rows, authors, liked
+
+
+async def fetch_tweets(database, ids, viewer_id=None):
+    '''Rows of ids and their nested statuses by id, their authors and the ids the viewer liked'''
+    rows = {}
+    pending = set(ids)
+    # the page and the two levels of nested statuses TweetSchema renders
+    for _ in range(3):
+        if not pending:
+            break
+        for row in await database.fetch(select([tweets]).where(tweets.c.id.in_(list(pending)))):
+            rows[row['id']] = row
+        pending = {i for r in rows.values() for i in (r['retweet_status_id'], r['in_reply_to_status_id'])
+                   if i is not None and i not in rows}
+    user_ids = list({r['user_id'] for r in rows.values() if r['user_id'] is not None})
+    authors = {}
+    if user_ids:
+        authors = {r['id']: SimpleNamespace(**r) for r in await database.fetch(
+            select([users]).where(users.c.id.in_(user_ids)))}
+    liked = set()
+    if viewer_id is not None and rows:
+        liked = {r['tweet_id'] for r in await database.fetch(select([favorites.c.tweet_id]).where(
+            (favorites.c.user_id == viewer_id) & favorites.c.tweet_id.in_(list(rows))))}
+    return rows, authors, liked
+
+
+async def fetch_fingerprint(database, ids, viewer_id=None, buffer=None, extra=None):
+    '''get_tweet_fingerprint of ids from the async database'''
+    columns = [c.property.columns[0] for c in FINGERPRINT_COLUMNS]
+
+    async def read():
+        rows = {}
+        pending = set(ids)
+        for _ in range(3):
+            if not pending:
+                break
+            for row in await database.fetch(select(columns).select_from(
+                    tweets.outerjoin(users, users.c.id == tweets.c.user_id)).where(tweets.c.id.in_(list(pending)))):
+                rows[row['id']] = tuple(row.values())
+            pending = {i for r in rows.values() for i in r[1:3] if i is not None and i not in rows}
+        liked = set()
+        if viewer_id is not None and rows:
+            liked = {r['tweet_id'] for r in await database.fetch(select([favorites.c.tweet_id]).where(
+                (favorites.c.user_id == viewer_id) & favorites.c.tweet_id.in_(list(rows))))}
+        return rows, liked
+
+    for _ in range(3):
+        snapshot = buffer.snapshot(viewer_id) if buffer is not None else (0, {}, {})
+        rows, liked = await read()
+        if buffer is None or buffer.flushes == snapshot[0]:
+            break
+    _, states, counts = snapshot
+    rows = {i: r[:4] + (r[4] + counts.get(i, 0),) + r[5:] for i, r in rows.items()}
+    return fingerprint(ids, rows.values(), [i for i in rows if states.get(i, i in liked)], extra)
+
+
+def dump_tweets(objects, rows, viewer=None, liked=(), fast=False):
+    '''Dump a page from load_tweets with the context get_tweet_context would build'''
+    context = {'user': viewer}
+    if viewer is not None:
+        context['liked'] = dict.fromkeys(rows, False)
+        context['liked'].update((i, True) for i in liked)
+    schema = TweetSchema(many=True, context=context)
+    # there is no app context here for CompiledSchema to find the setting in
+    return dump_compiled(schema, objects) if fast else schema.dump(objects)
+
+
+class ASGIApp(object):
+    '''ASGI application serving the hot reads natively and the rest through flask_app'''
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = self.config = flask_app.config
+        config.setdefault('ASYNC_POOL_MIN_SIZE', 2)
+        config.setdefault('ASYNC_POOL_MAX_SIZE', 10)
+        config.setdefault('ASYNC_THREADS', 16)
+        config.setdefault('ASYNC_STREAM_THREADS', 64)
+        self.executor = ThreadPoolExecutor(config['ASYNC_THREADS'])
+        # a streamed body holds its thread as long as the client stays, keep them off the request threads
+        self.stream_executor = ThreadPoolExecutor(config['ASYNC_STREAM_THREADS'])
+        uri = config['SQLALCHEMY_DATABASE_URI']
+        if uri.startswith('postgres'):
+            self.database = AsyncpgDatabase(uri, config['ASYNC_POOL_MIN_SIZE'], config['ASYNC_POOL_MAX_SIZE'])
+        else:
+            with flask_app.app_context():
+                engine = db.engine
+            self.database = ThreadedDatabase(engine, self.executor)
+        self.like_buffer = flask_app.extensions['like_buffer']
+        self.fast = config['FAST_SERIALIZATION']
+        self.dumps = make_dumps(flask_app, use_orjson=self.fast)
+        self.routes = [
+            (re.compile(r'^/statuses/home_timeline$'), self.home_timeline),
+            (re.compile(r'^/statuses/(\d+)$'), self.get_a_status),
+            (re.compile(r'^/statuses/$'), self.get_a_statuses),
+            (re.compile(r'^/user/(\d+)$'), self.get_a_user),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if scope['method'] == 'GET' and scope['path'] == '/statuses/stream':
+            return await self.stream_statuses(scope, receive, send)
+        if scope['method'] in ('GET', 'HEAD'):
+            for pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match:
+                    response = await handler(Request(scope), *(int(g) for g in match.groups()))
+                    if response is not None:
+                        return await self.respond(scope, send, response)
+                    break
+        await self.wsgi(scope, receive, send)
+
+    async def startup(self):
+        await self.database.connect()
+
+    async def shutdown(self):
+        await self.database.close()
+        self.executor.shutdown(wait=False)
+        self.stream_executor.shutdown(wait=False)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def respond(self, scope, send, response):
+        headers = [(b'content-type', b'application/json')]
+        status = response.status
+        if response.etag is not None:
+            headers.append((b'etag', f'"{response.etag}"'.encode('latin-1')))
+            if_none_match = Request(scope).headers.get('if-none-match', '')
+            if f'"{response.etag}"' in re.findall(r'"[^"]*"', if_none_match):
+                status, response.payload = 304, None
+        body = b''
+        if response.payload is not None:
+            body = self.dumps(response.payload) + b'\n'
+            headers.append((b'content-length', str(len(body)).encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else body})
+
+    def not_modified(self, request, etag):
+        '''Empty 304 when the client already holds the representation tagged etag'''
+        if f'"{etag}"' in re.findall(r'"[^"]*"', request.headers.get('if-none-match', '')):
+            return Response(status=304, etag=etag)
+        return None
+
+    def page_size(self, request):
+        count = request.int_arg('count') or self.config['PAGE_SIZE']
+        return max(1, min(count, self.config['MAX_PAGE_SIZE']))
+
+    async def authenticate(self, request):
+        '''(user, None) for a valid token, otherwise (None, the error protected returns)'''
+        token = request.headers.get('x-access-token')
+        if not token:
+            return None, Response({'error': {'message': 'token is missing', 'code': 401}, 'data': None})
+        data = decode_token(token)
+        if data == 'Invalid token' or data == 'Signature expired':
+            return None, Response({'error': {'message': 'malformed token', 'code': 401}, 'data': None})
+        rows = await self.database.fetch(select([users]).where(users.c.id == data['id']))
+        if not rows:
+            return None, Response({'error': {'message': 'malformed token', 'code': 401}, 'data': None})
+        if not rows[0]['verified']:
+            return None, Response({'error': {'message': 'please verify account', 'code': 400}, 'data': None})
+        return SimpleNamespace(**rows[0]), None
+
+    async def get_a_status(self, request, status_id):
+        # the fingerprint only reads ids and counters, a matching poll skips loading the status
+        etag = await fetch_fingerprint(self.database, [status_id], buffer=self.like_buffer)
+        response = self.not_modified(request, etag)
+        if response:
+            return response
+        objects, _, _, _ = await load_tweets(self.database, [status_id], buffer=self.like_buffer)
+        if not objects:
+            return Response({'data': 'Resource not found', 'error': None}, 404)
+        status = dump_tweets(objects, (), fast=self.fast)[0]
+        return Response({'data': {'status': status}, 'error': None}, etag=etag)
+
+    async def get_a_user(self, request, user_id):
+        rows = await self.database.fetch(select([users]).where(
+            (users.c.id == user_id) & (users.c.verified == True)))  # noqa: E712
+        if not rows:
+            return Response({'error': {'message': 'Invalid User', }, 'data': None}, 404)
+        row = SimpleNamespace(**rows[0])
+        data = dump_compiled(user_serializer, row) if self.fast else user_serializer.dump(row)
+        return Response({'error': None, 'data': data})
+
+    async def get_a_statuses(self, request):
+        user, error = await self.authenticate(request)
+        if error:
+            return error
+        count = self.page_size(request)
+        columns = [tweets.c.id]
+        query = select(columns)
+        since_id = request.int_arg('since_id')
+        if since_id is not None:
+            query = query.where(tweets.c.id > since_id)
+        if request.args.get('cursor'):
+            try:
+                values = decode_cursor(request.args['cursor'], columns)
+            except InvalidCursor:
+                return Response({'error': {'message': 'invalid cursor'}, 'data': None}, 400)
+            query = query.where(after(columns, values))
+        rows = await self.database.fetch(query.order_by(tweets.c.id.desc()).limit(count + 1))
+        next_cursor = None
+        if len(rows) > count:
+            rows = rows[:count]
+            next_cursor = encode_cursor([rows[-1]['id']])
+        objects, loaded, _, liked = await load_tweets(
+            self.database, [r['id'] for r in rows], user.id, self.like_buffer)
+        return Response({'data': {'statuses': dump_tweets(objects, loaded, user, liked, self.fast)},
+                         'next_cursor': next_cursor, 'error': None})
+
+    async def home_timeline(self, request):
+        user, error = await self.authenticate(request)
+        if error:
+            return error
+        store = self.flask_app.extensions['timeline']
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(self.executor, store.exists, user.id):
+            # building the timeline is a write, leave it to the sync path
+            return None
+        count = self.page_size(request)
+        max_id = None
+        if request.args.get('cursor'):
+            try:
+                max_id = decode_cursor(request.args['cursor'], [tweets.c.id])[0]
+            except InvalidCursor:
+                return Response({'error': {'message': 'invalid cursor'}, 'data': None}, 400)
+        since_id = request.int_arg('since_id')
+        ids = await loop.run_in_executor(self.executor, functools.partial(
+            store.get, user.id, count + 1, max_id=max_id))
+
+        over_limit = [r['id'] for r in await self.database.fetch(
+            select([users.c.id]).select_from(users.join(followers, followers.c.followed_id == users.c.id)).where(
+                (followers.c.follower_id == user.id) &
+                (users.c.followers_count > self.config['TIMELINE_FANOUT_LIMIT'])))]
+        if over_limit:
+            query = select([tweets.c.id]).where(tweets.c.user_id.in_(over_limit))
+            if max_id is not None:
+                query = query.where(tweets.c.id < max_id)
+            if since_id is not None:
+                query = query.where(tweets.c.id > since_id)
+            rows = await self.database.fetch(query.order_by(tweets.c.id.desc()).limit(count + 1))
+            ids = sorted(set(ids).union(r['id'] for r in rows), reverse=True)[:count + 1]
+        if since_id is not None:
+            ids = [i for i in ids if i > since_id]
+        next_cursor = None
+        if len(ids) > count:
+            ids = ids[:count]
+            next_cursor = encode_cursor([ids[-1]])
+
+        etag = await fetch_fingerprint(self.database, ids, user.id, self.like_buffer, next_cursor)
+        response = self.not_modified(request, etag)
+        if response:
+            return response
+        objects, rows, _, liked = await load_tweets(self.database, ids, user.id, self.like_buffer)
+        return Response({'data': {'tweets': dump_tweets(objects, rows, user, liked, self.fast)},
+                         'next_cursor': next_cursor, 'error': None}, etag=etag)
+
+    def subscribe(self, user_id, last_id, notify):
+        with self.flask_app.app_context():
+            try:
+                user = User.query.get(user_id)
+                subscription = stream.subscribe(user, notify)
+                try:
+                    # a reconnecting client first gets what it missed while it was away
+                    missed = timeline.get_tweet_ids(user, since_id=last_id)[::-1] if last_id else []
+                except Exception:
+                    stream.unsubscribe(subscription)
+                    raise
+                return subscription, missed
+            finally:
+                db.session.remove()
+
+    async def stream_statuses(self, scope, receive, send):
+        '''Server-sent events of the statuses of followed users, like the Flask view but threadless'''
+        request = Request(scope)
+        user, error = await self.authenticate(request)
+        if error:
+            return await self.respond(scope, send, error)
+        try:
+            last_id = int(request.headers.get('last-event-id', ''))
+        except ValueError:
+            last_id = None
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        # in place before the subscription is, a message published right after wakes the loop
+        subscription, missed = await loop.run_in_executor(
+            self.executor, self.subscribe, user.id, last_id, lambda: loop.call_soon_threadsafe(ready.set))
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')]})
+            await send({'type': 'http.response.body', 'body': opening_events(missed).encode('utf-8'),
+                        'more_body': True})
+            while True:
+                waiter = asyncio.ensure_future(ready.wait())
+                await asyncio.wait([waiter, disconnected], timeout=self.config['STREAM_HEARTBEAT'],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if disconnected.done():
+                    break
+                # cleared before taking, a put racing with take() wakes the next round
+                ready.clear()
+                body = ''.join(format_messages(*subscription.take()))
+                await send({'type': 'http.response.body', 'body': body.encode('utf-8'), 'more_body': True})
+        finally:
+            disconnected.cancel()
+            subscription.notify = None
+            self.flask_app.extensions['stream']['hub'].unsubscribe(subscription)
+
+    def environ(self, scope, body):
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+            'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    async def wsgi(self, scope, receive, send):
+        '''Run the request through the Flask app on the thread pool, streaming its body'''
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            self.executor, self.flask_app.wsgi_app, self.environ(scope, b''.join(body)), start_response)
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        iterator = iter(result)
+        # without a length the body is generated as it is sent, possibly for as long as the client stays
+        streamed = not any(name == b'content-length' for name, _ in started['headers'])
+        executor = self.stream_executor if streamed else self.executor
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            while not disconnected.done():
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(executor, result.close)
+
+    async def wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+def create_asgi_app(config):
+    from app import create_app
+    return ASGIApp(create_app(config))
@@ -0,0 +1,87 @@
+from datetime import datetime
+from sqlalchemy import select, and_
+from app.models import db, User, Tweet, Favorites, followers
+from app.cache import mark_dirty
+from app.replicas import written
+from app.utils import auth_cache
+
+
+class InvalidIds(Exception):
+    pass
+
+
+def parse_ids(data, limit):
+    '''Distinct ids of a batch request body, in the order given'''
+    ids = (data or {}).get('ids')
+    if not isinstance(ids, list) or not all(type(i) is int for i in ids):
+        raise InvalidIds('ids must be a list of integers')
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > limit:
+        raise InvalidIds(f'at most {limit} ids per request')
+    return ids
+
+
+def insert_ignore(table, rows, key):
+    '''Insert rows, skipping those whose key columns already exist, returns the inserted rows
+
+    PostgreSQL does it in one INSERT ... ON CONFLICT DO NOTHING RETURNING.
+    Elsewhere the existing keys are read first and the rest inserted one
+    statement each with the dialect's ignore clause. A duplicate written
+    concurrently is dropped and, going by the row's rowcount, not returned.
+    '''
+    if not rows:
+        return []
+    columns = [table.c[k] for k in key]
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        inserted = db.session.execute(insert(table).values(rows).on_conflict_do_nothing(
+            index_elements=columns).returning(*columns))
+        inserted = {tuple(r) for r in inserted}
+        return [r for r in rows if tuple(r[k] for k in key) in inserted]
+    # each column IN its values matches a superset, the exact keys are compared below
+    existing = {tuple(r) for r in db.session.execute(select(columns).where(and_(
+        *[c.in_({r[c.key] for r in rows}) for c in columns])))}
+    insert = table.insert().prefix_with('OR IGNORE', dialect='sqlite').prefix_with('IGNORE', dialect='mysql')
+    # an executemany rowcount cannot tell which rows were ignored
+    return [r for r in rows if tuple(r[k] for k in key) not in existing
+            and db.session.execute(insert, r).rowcount == 1]
+
+
+def like_many(user, tweet_ids):
+    '''Like every tweet of tweet_ids with set-based writes, returns {id: result}'''
+    tweets = Tweet.__table__
+    found = {r[0] for r in db.session.execute(select([tweets.c.id]).where(tweets.c.id.in_(tweet_ids)))}
+    inserted = insert_ignore(Favorites.__table__, [
+        {'user_id': user.id, 'tweet_id': i} for i in tweet_ids if i in found], ['user_id', 'tweet_id'])
+    liked = {r['tweet_id'] for r in inserted}
+    if liked:
+        db.session.execute(tweets.update().where(tweets.c.id.in_(liked)).values(
+            like_count=tweets.c.like_count + 1))
+        for i in liked:
+            mark_dirty(db.session, 'status', i)
+        written(db.session)
+    return {i: 'liked' if i in liked else 'already_liked' if i in found else 'not_found'
+            for i in tweet_ids}
+
+
+def follow_many(user, user_ids):
+    '''Follow every user of user_ids with set-based writes, returns {id: result}'''
+    users = User.__table__
+    found = {r[0] for r in db.session.execute(select([users.c.id]).where(users.c.id.in_(user_ids)))}
+    inserted = insert_ignore(followers, [
+        {'follower_id': user.id, 'followed_id': i} for i in user_ids if i in found],
+        ['follower_id', 'followed_id'])
+    followed = {r['followed_id'] for r in inserted}
+    if followed:
+        db.session.execute(users.update().where(users.c.id.in_(followed)).values(
+            followers_count=users.c.followers_count + 1))
+        db.session.execute(users.update().where(users.c.id == user.id).values(
+            followed_count=users.c.followed_count + len(followed), graph_updated_at=datetime.utcnow()))
+        # the relationship events that keep these caches fresh do not see Core statements
+        db.session.info.setdefault('dirty_graph', set()).update(followed)
+        for i in followed | {user.id}:
+            mark_dirty(db.session, 'user', i)
+            auth_cache.invalidate(i)
+        written(db.session)
+    return {i: 'following' if i in followed else 'already_following' if i in found else 'not_found'
+            for i in user_ids}
@@ -0,0 +1,238 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from app.models import User, Tweet
+from app.replicas import primary
+
+
+class TTLCache(object):
+    '''Thread safe LRU cache whose entries also expire after ttl seconds'''
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires <= self.timer():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, self.timer() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class RedisTier(object):
+    '''Shared cache tier in redis, payloads are stored as JSON'''
+
+    def __init__(self, url, ttl, prefix='objects:'):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def version(self, kind, id):
+        return int(self.redis.get(f'{self.prefix}ver:{kind}:{id}') or 0)
+
+    def bump(self, kind, id):
+        return self.redis.incr(f'{self.prefix}ver:{kind}:{id}')
+
+    def get(self, kind, id, version):
+        value = self.redis.get(f'{self.prefix}{kind}:{id}:{version}')
+        return None if value is None else json.loads(value)
+
+    def set(self, kind, id, version, value):
+        self.redis.set(f'{self.prefix}{kind}:{id}:{version}', json.dumps(value), ex=self.ttl)
+
+    def lock(self, kind, id, version, timeout):
+        return bool(self.redis.set(f'{self.prefix}lock:{kind}:{id}:{version}', 1,
+                                   nx=True, px=int(timeout * 1000)))
+
+    def unlock(self, kind, id, version):
+        self.redis.delete(f'{self.prefix}lock:{kind}:{id}:{version}')
+
+
+class ObjectCache(object):
+    '''Read-through cache of serialized statuses and users
+
+    Entries are keyed by kind, id and a version that every committed write
+    to the row bumps. Lookups go to a bounded in-process LRU first and then
+    to the optional shared tier (OBJECT_CACHE_SHARED = 'redis'). A miss is
+    rebuilt by one caller at a time, others wait for its result.
+
+    With the shared tier versions live in redis and a payload older than a
+    write is never served again. Without it they live in the process, which
+    only sees its own writes: other processes keep serving their copy for
+    up to OBJECT_CACHE_TTL seconds, so deployments running several
+    processes should set OBJECT_CACHE_SHARED.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('OBJECT_CACHE_SIZE', 10000)
+        app.config.setdefault('OBJECT_CACHE_TTL', 30)
+        app.config.setdefault('OBJECT_CACHE_SHARED', None)
+        app.config.setdefault('OBJECT_CACHE_LOCK_TIMEOUT', 5)
+
+        ttl = app.config['OBJECT_CACHE_TTL']
+        shared = None
+        if app.config['OBJECT_CACHE_SHARED'] == 'redis':
+            shared = RedisTier(app.config['REDIS_URL'], ttl)
+        app.extensions['object_cache'] = {
+            'local': TTLCache(app.config['OBJECT_CACHE_SIZE'], ttl),
+            'versions': TTLCache(app.config['OBJECT_CACHE_SIZE'] * 10, ttl * 100),
+            'shared': shared,
+            'locks': [threading.Lock() for _ in range(64)],
+        }
+
+    @property
+    def state(self):
+        return current_app.extensions['object_cache']
+
+    def version(self, kind, id):
+        state = self.state
+        if state['shared'] is not None:
+            return state['shared'].version(kind, id)
+        return state['versions'].get((kind, id), 0)
+
+    def _lookup(self, kind, id, version):
+        state = self.state
+        entry = state['local'].get((kind, id))
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        if state['shared'] is not None:
+            value = state['shared'].get(kind, id, version)
+            if value is not None:
+                state['local'].set((kind, id), (version, value))
+            return value
+        return None
+
+    def _store(self, kind, id, version, value):
+        state = self.state
+        # a write committed while building bumps the version, drop the stale value
+        if self.version(kind, id) != version:
+            return
+        state['local'].set((kind, id), (version, value))
+        if state['shared'] is not None:
+            state['shared'].set(kind, id, version, value)
+
+    def get_or_build(self, kind, id, build):
+        '''Return the cached payload or build(), None results are not cached'''
+        version = self.version(kind, id)
+        value = self._lookup(kind, id, version)
+        if value is not None:
+            return value
+
+        state = self.state
+        with state['locks'][hash((kind, id)) % len(state['locks'])]:
+            value = self._lookup(kind, id, version)
+            if value is not None:
+                return value
+            shared = state['shared']
+            timeout = current_app.config['OBJECT_CACHE_LOCK_TIMEOUT']
+            if shared is not None and not shared.lock(kind, id, version, timeout):
+                # another process is building it, wait for its result
+                deadline = time.monotonic() + timeout
+                while time.monotonic() < deadline:
+                    time.sleep(0.01)
+                    value = self._lookup(kind, id, version)
+                    if value is not None:
+                        return value
+            try:
+                # a lagging replica would cache stale data under the new version
+                with primary():
+                    value = build()
+                if value is not None:
+                    self._store(kind, id, version, value)
+            finally:
+                if shared is not None:
+                    shared.unlock(kind, id, version)
+            return value
+
+    def invalidate(self, kind, id):
+        state = self.state
+        if state['shared'] is not None:
+            state['shared'].bump(kind, id)
+        else:
+            versions = state['versions']
+            versions.set((kind, id), versions.get((kind, id), 0) + 1)
+        state['local'].delete((kind, id))
+
+
+object_cache = ObjectCache()
+
+
+def mark_dirty(session, kind, id):
+    session.info.setdefault('dirty_objects', set()).add((kind, id))
+
+
+def mark_status(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        mark_dirty(session, 'status', target.id)
+        for parent_id in (target.in_reply_to_status_id, target.retweet_status_id):
+            if parent_id is not None:
+                mark_dirty(session, 'status', parent_id)
+
+
+def mark_user(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        mark_dirty(session, 'user', target.id)
+
+
+def invalidate_dirty(session):
+    dirty = session.info.pop('dirty_objects', None)
+    if dirty and has_app_context() and 'object_cache' in current_app.extensions:
+        for kind, id in dirty:
+            object_cache.invalidate(kind, id)
+
+
+def forget_dirty(session, previous_transaction):
+    session.info.pop('dirty_objects', None)
+
+
+for name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Tweet, name, mark_status)
+event.listen(User, 'after_update', mark_user)
+event.listen(User, 'after_delete', mark_user)
+event.listen(SignallingSession, 'after_commit', invalidate_dirty)
+event.listen(SignallingSession, 'after_soft_rollback', forget_dirty)
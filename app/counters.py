@@ -0,0 +1,52 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+from app.models import db, User, Tweet, Favorites, followers
+
+
+def counter_sources():
+    users = User.__table__
+    tweets = Tweet.__table__
+    replies = tweets.alias('replies')
+    favorites = Favorites.__table__
+    yield users.c.followers_count, select([func.count()]).where(
+        followers.c.followed_id == users.c.id)
+    yield users.c.followed_count, select([func.count()]).where(
+        followers.c.follower_id == users.c.id)
+    yield tweets.c.like_count, select([func.count()]).where(
+        favorites.c.tweet_id == tweets.c.id)
+    yield tweets.c.reply_count, select([func.count()]).where(
+        replies.c.in_reply_to_status_id == tweets.c.id)
+    yield tweets.c.retweet_count, select([func.count()]).where(
+        replies.c.retweet_status_id == tweets.c.id)
+
+
+def reconcile_counters(repair=True):
+    '''Find stored counters that drifted from the rows they count
+
+    Every counter is checked with one set-based statement, with repair the
+    drifted rows are rewritten in the same statement. Returns the number of
+    drifted rows per counter.
+    '''
+    drifted = {}
+    for column, actual in counter_sources():
+        actual = actual.as_scalar()
+        name = f'{column.table.name}.{column.name}'
+        if repair:
+            result = db.session.execute(column.table.update().where(
+                column != actual).values({column: actual}))
+            drifted[name] = result.rowcount
+        else:
+            drifted[name] = db.session.execute(select([func.count()]).select_from(
+                column.table).where(column != actual)).scalar()
+    db.session.commit()
+    return drifted
+
+
+@click.command('reconcile-counters')
+@with_appcontext
+@click.option('--dry-run', is_flag=True, help='Only report drifted counters.')
+def reconcile_counters_command(dry_run):
+    '''Repair drifted like, reply, retweet and follow counters'''
+    for name, count in reconcile_counters(repair=not dry_run).items():
+        click.echo(f'{name}: {count} drifted')
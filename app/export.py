@@ -0,0 +1,51 @@
+import json
+import zlib
+from flask import request, current_app, stream_with_context
+
+
+def iter_chunks(query, size):
+    '''Iterate a query in lists of size rows over a server-side cursor'''
+    chunk = []
+    for row in query.yield_per(size):
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def wants_gzip():
+    return request.args.get('gzip', type=int) == 1 or request.accept_encodings['gzip'] > 0
+
+
+def ndjson_response(query, dump):
+    '''Stream query as newline delimited JSON, dump serializes one chunk of rows
+
+    Only one chunk of EXPORT_CHUNK_SIZE rows and its JSON is held at a time,
+    so memory stays flat however large the table is.
+    '''
+    size = current_app.config['EXPORT_CHUNK_SIZE']
+    encoder = current_app.json_encoder
+
+    def generate():
+        for chunk in iter_chunks(query, size):
+            yield ''.join(json.dumps(item, cls=encoder) + '\n'
+                          for item in dump(chunk)).encode('utf-8')
+
+    body = generate()
+    headers = {'Vary': 'Accept-Encoding'}
+    if wants_gzip():
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return current_app.response_class(
+        stream_with_context(body), mimetype='application/x-ndjson', headers=headers)
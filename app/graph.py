@@ -0,0 +1,141 @@
+import bisect
+from array import array
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from app.models import db, User, followers
+from app.cache import TTLCache
+from app.replicas import primary
+
+
+class IdSet(object):
+    '''Sorted set of ids packed in an array, 8 bytes per id'''
+
+    __slots__ = ('ids',)
+
+    def __init__(self, ids):
+        self.ids = array('q', sorted(set(ids)))
+
+    def __contains__(self, id):
+        position = bisect.bisect_left(self.ids, id)
+        return position < len(self.ids) and self.ids[position] == id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intersection(self, ids):
+        return [i for i in ids if i in self]
+
+
+class SocialGraph(object):
+    '''Follow lookups over the followers table
+
+    Every query is answered from the followers indexes, in one statement
+    however many users it is asked about. The follower sets of accounts with
+    at least GRAPH_CACHE_MIN_FOLLOWERS followers are also kept in process as
+    IdSets, at most GRAPH_CACHE_SIZE of them, and dropped when a follow or
+    unfollow of the account commits.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('GRAPH_CACHE_SIZE', 256)
+        app.config.setdefault('GRAPH_CACHE_TTL', 300)
+        app.config.setdefault('GRAPH_CACHE_MIN_FOLLOWERS', 1000)
+        app.extensions['graph'] = TTLCache(app.config['GRAPH_CACHE_SIZE'],
+                                           app.config['GRAPH_CACHE_TTL'])
+
+    @property
+    def cache(self):
+        return current_app.extensions['graph']
+
+    def cached_followers(self, user):
+        '''IdSet of the followers of a hot account, None for everyone else'''
+        if user.followers_count < current_app.config['GRAPH_CACHE_MIN_FOLLOWERS']:
+            return None
+        ids = self.cache.get(user.id)
+        if ids is None:
+            # cached for GRAPH_CACHE_TTL, a lagging replica would hide new followers that long
+            with primary():
+                ids = IdSet(r[0] for r in db.session.query(followers.c.follower_id).filter(
+                    followers.c.followed_id == user.id))
+            self.cache.set(user.id, ids)
+        return ids
+
+    def following(self, user, targets):
+        '''{target id: whether user follows it} for many targets at once'''
+        result = {}
+        pending = []
+        for target in targets:
+            cached = self.cached_followers(target)
+            if cached is None:
+                pending.append(target.id)
+            else:
+                result[target.id] = user.id in cached
+        if pending:
+            followed = {r[0] for r in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == user.id, followers.c.followed_id.in_(pending))}
+            result.update((i, i in followed) for i in pending)
+        return result
+
+    def followed_by(self, user, target_ids):
+        '''{target id: whether it follows user}'''
+        cached = self.cached_followers(user)
+        if cached is None:
+            cached = {r[0] for r in db.session.query(followers.c.follower_id).filter(
+                followers.c.followed_id == user.id, followers.c.follower_id.in_(target_ids))}
+        return {i: i in cached for i in target_ids}
+
+    def mutuals(self, user):
+        '''Query of the users user follows that follow user back'''
+        back = db.session.query(followers.c.follower_id).filter(
+            followers.c.followed_id == user.id)
+        return User.query.join(followers, followers.c.followed_id == User.id).filter(
+            followers.c.follower_id == user.id, User.id.in_(back))
+
+    def followers_you_know(self, viewer, user):
+        '''Query of the followers of user that viewer follows'''
+        followed = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == viewer.id)
+        cached = self.cached_followers(user)
+        if cached is not None:
+            # the viewer follows far fewer accounts than a hot account has followers
+            return User.query.filter(User.id.in_(cached.intersection(r[0] for r in followed)))
+        return User.query.join(followers, followers.c.follower_id == User.id).filter(
+            followers.c.followed_id == user.id, User.id.in_(followed))
+
+    def invalidate(self, user_id):
+        self.cache.delete(user_id)
+
+
+graph = SocialGraph()
+
+
+def mark_followed(target, value, initiator):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('dirty_graph', set()).add(value.id)
+
+
+def invalidate_followed(session):
+    dirty = session.info.pop('dirty_graph', None)
+    if dirty and has_app_context() and 'graph' in current_app.extensions:
+        for user_id in dirty:
+            graph.invalidate(user_id)
+
+
+def forget_followed(session, previous_transaction):
+    session.info.pop('dirty_graph', None)
+
+
+event.listen(User.followed, 'append', mark_followed)
+event.listen(User.followed, 'remove', mark_followed)
+event.listen(SignallingSession, 'after_commit', invalidate_followed)
+event.listen(SignallingSession, 'after_soft_rollback', forget_followed)
@@ -0,0 +1,74 @@
+import atexit
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+    '''Hashes and checks passwords on a process pool with bounded concurrency
+
+    The request thread only waits on the result, the hashing itself runs in
+    PASSWORD_HASH_WORKERS processes (inline when it is 0). At most
+    PASSWORD_HASH_CONCURRENCY hashes are in flight per process, so a burst
+    of logins queues up here instead of piling onto the pool.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+        app.config.setdefault('PASSWORD_HASH_ITERATIONS', 150000)
+        app.config.setdefault('PASSWORD_SALT_LENGTH', 16)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('PASSWORD_HASH_CONCURRENCY',
+                              2 * app.config['PASSWORD_HASH_WORKERS'] or 1)
+        app.extensions['hasher'] = {
+            'pool': None,
+            'lock': threading.Lock(),
+            'slots': threading.BoundedSemaphore(app.config['PASSWORD_HASH_CONCURRENCY']),
+        }
+
+    @property
+    def method(self):
+        config = current_app.config
+        method = config['PASSWORD_HASH_METHOD']
+        if method.startswith('pbkdf2:'):
+            return f"{method}:{config['PASSWORD_HASH_ITERATIONS']}"
+        return method
+
+    def _pool(self, state):
+        with state['lock']:
+            if state['pool'] is None:
+                state['pool'] = ProcessPoolExecutor(
+                    current_app.config['PASSWORD_HASH_WORKERS'])
+                atexit.register(state['pool'].shutdown)
+            return state['pool']
+
+    def _run(self, fn, *args):
+        if not current_app.config['PASSWORD_HASH_WORKERS']:
+            return fn(*args)
+        state = current_app.extensions['hasher']
+        with state['slots']:
+            return self._pool(state).submit(fn, *args).result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method,
+                         current_app.config['PASSWORD_SALT_LENGTH'])
+
+    def check(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        if pwhash.count('$') < 2:
+            return True
+        method, salt, _ = pwhash.split('$', 2)
+        return method != self.method or len(salt) < current_app.config['PASSWORD_SALT_LENGTH']
+
+
+hasher = PasswordHasher()
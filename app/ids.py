@@ -0,0 +1,245 @@
+import atexit
+import os
+import socket
+import threading
+import time
+import click
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import event, exc, func, select, and_
+from app.models import db, Tweet, Favorites, TweetHashtag, Mention, IdWorker
+
+# 2020-01-01T00:00:00Z, 41 bits of milliseconds from it last until 2089
+EPOCH = 1577836800000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Snowflake(object):
+    '''k-sortable 64 bit ids: milliseconds since EPOCH, worker id and a per millisecond sequence
+
+    Ids of one worker strictly increase. When the clock steps back or the
+    sequence of a millisecond runs out the generator keeps counting from its
+    last millisecond instead of waiting, so it can run slightly ahead of the
+    clock but never repeats an id.
+    '''
+
+    def __init__(self, worker_id=None, epoch=EPOCH, clock=time.time):
+        self.worker_id = worker_id
+        self.epoch = epoch
+        self.clock = clock
+        self.last = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def millis(self):
+        return int(self.clock() * 1000) - self.epoch
+
+    def next_id(self):
+        with self.lock:
+            if self.worker_id is None:
+                raise LeaseLost('no worker id')
+            now = self.millis()
+            if now <= self.last:
+                now = self.last
+                self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+                if self.sequence == 0:
+                    now += 1
+            else:
+                self.sequence = 0
+            self.last = now
+            return (now << TIMESTAMP_SHIFT) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+    def timestamp(self, id):
+        '''When id was generated, as epoch seconds'''
+        return ((id >> TIMESTAMP_SHIFT) + self.epoch) / 1000.0
+
+    def first_id(self, seconds):
+        '''Smallest id generated at or after epoch seconds, for range queries on id'''
+        return max(0, int(seconds * 1000) - self.epoch) << TIMESTAMP_SHIFT
+
+
+class WorkerLease(object):
+    '''Leases a worker id in the id_worker table for SNOWFLAKE_LEASE_TTL seconds
+
+    A heartbeat renews the lease every third of its ttl, an id whose lease
+    expired can be taken over by another process. Until a lease is held the
+    generator refuses to hand out ids. The lease is claimed while a flush is
+    inserting a tweet, so it goes through its own connection, not the session.
+    '''
+
+    def __init__(self, generator, ttl):
+        self.generator = generator
+        self.ttl = ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{id(self)}'
+        self.renewed_at = None
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def claim(self, engine):
+        workers = IdWorker.__table__
+        now = datetime.utcnow()
+        expired = now - timedelta(seconds=self.ttl)
+        with engine.connect() as connection:
+            taken = {r[0] for r in connection.execute(select([workers.c.worker_id]))}
+            for worker_id in range(MAX_WORKER_ID + 1):
+                try:
+                    with connection.begin():
+                        if worker_id not in taken:
+                            connection.execute(workers.insert().values(
+                                worker_id=worker_id, owner=self.owner, renewed_at=now))
+                        # only one of the processes racing for an expired lease updates it
+                        elif not connection.execute(workers.update().where(and_(
+                                workers.c.worker_id == worker_id, workers.c.renewed_at < expired)).values(
+                                owner=self.owner, renewed_at=now)).rowcount:
+                            continue
+                except exc.IntegrityError:
+                    continue
+                with self.generator.lock:
+                    self.generator.worker_id = worker_id
+                self.renewed_at = time.monotonic()
+                return worker_id
+        raise LeaseLost('every worker id is leased')
+
+    def renew(self, engine):
+        workers = IdWorker.__table__
+        with self.generator.lock:
+            worker_id = self.generator.worker_id
+        with engine.begin() as connection:
+            renewed = connection.execute(workers.update().where(and_(
+                workers.c.worker_id == worker_id, workers.c.owner == self.owner)).values(
+                renewed_at=datetime.utcnow())).rowcount
+        if renewed:
+            self.renewed_at = time.monotonic()
+            return
+        # taken over after we missed renewals, the old id must not be used again
+        with self.generator.lock:
+            self.generator.worker_id = None
+        self.claim(engine)
+
+    def expired(self):
+        return self.renewed_at is None or time.monotonic() - self.renewed_at > self.ttl
+
+    def beat(self, app, engine):
+        while not self.stopped.wait(self.ttl / 3.0):
+            try:
+                self.renew(engine)
+            except Exception:
+                app.logger.exception('snowflake lease renewal failed')
+
+    def start(self, app):
+        engine = db.get_engine(app)
+        self.claim(engine)
+        self.heartbeat = threading.Thread(target=self.beat, args=(app, engine), name='snowflake-lease',
+                                          daemon=True)
+        self.heartbeat.start()
+        atexit.register(self.release, engine)
+
+    def release(self, engine):
+        atexit.unregister(self.release)
+        self.stopped.set()
+        workers = IdWorker.__table__
+        with engine.begin() as connection:
+            connection.execute(workers.delete().where(workers.c.owner == self.owner))
+
+
+class Ids(object):
+    '''Pluggable generator of tweet ids
+
+    TWEET_ID_GENERATOR = None leaves ids to the database sequence,
+    'snowflake' assigns Snowflake ids in the process before the insert.
+    SNOWFLAKE_WORKER_ID pins the worker id, otherwise every process leases
+    a free one, so nodes and workers never share a worker id.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TWEET_ID_GENERATOR', None)
+        app.config.setdefault('SNOWFLAKE_WORKER_ID', None)
+        app.config.setdefault('SNOWFLAKE_LEASE_TTL', 60)
+
+        state = {'generator': None, 'lease': None, 'lock': threading.Lock()}
+        if app.config['TWEET_ID_GENERATOR'] == 'snowflake':
+            worker_id = app.config['SNOWFLAKE_WORKER_ID']
+            if worker_id is not None and not 0 <= int(worker_id) <= MAX_WORKER_ID:
+                raise ValueError(f'SNOWFLAKE_WORKER_ID must be between 0 and {MAX_WORKER_ID}')
+            generator = Snowflake(None if worker_id is None else int(worker_id))
+            state['generator'] = generator
+            if worker_id is None:
+                state['lease'] = WorkerLease(generator, app.config['SNOWFLAKE_LEASE_TTL'])
+        app.extensions['ids'] = state
+
+    @property
+    def generator(self):
+        return current_app.extensions['ids']['generator']
+
+    def next_id(self):
+        state = current_app.extensions['ids']
+        lease = state['lease']
+        if lease is not None:
+            with state['lock']:
+                if lease.heartbeat is None:
+                    lease.start(current_app._get_current_object())
+            if lease.expired():
+                # another process may hold the worker id by now
+                raise LeaseLost('snowflake worker lease expired')
+        return state['generator'].next_id()
+
+
+ids = Ids()
+
+
+def assign_id(mapper, connection, target):
+    if target.id is None and has_app_context() and current_app.extensions.get('ids', {}).get('generator'):
+        target.id = ids.next_id()
+
+
+event.listen(Tweet, 'before_insert', assign_id)
+
+
+# every column holding a tweet id, they are all widened by migrate-tweet-ids
+TWEET_ID_COLUMNS = [Tweet.id, Tweet.retweet_status_id, Tweet.in_reply_to_status_id,
+                    Favorites.tweet_id, TweetHashtag.tweet_id, Mention.tweet_id]
+
+
+@click.command('migrate-tweet-ids')
+@with_appcontext
+@click.option('--dry-run', is_flag=True, help='Only print the statements.')
+def migrate_tweet_ids_command(dry_run):
+    '''Widen tweet id columns to 64 bits before switching to snowflake ids
+
+    Existing rows keep their ids. Every snowflake id is above any serial id,
+    so sorting by id still puts old rows before new ones and cursors into
+    old pages stay valid.
+    '''
+    dialect = db.engine.dialect.name
+    statements = []
+    if dialect == 'postgresql':
+        statements = [f'ALTER TABLE "{c.table.name}" ALTER COLUMN "{c.name}" TYPE BIGINT'
+                      for c in (column.property.columns[0] for column in TWEET_ID_COLUMNS)]
+        statements.append('ALTER SEQUENCE tweet_id_seq AS BIGINT')
+    for statement in statements:
+        click.echo(statement)
+        if not dry_run:
+            db.session.execute(statement)
+    if not dry_run:
+        db.session.commit()
+    if not statements:
+        click.echo(f'{dialect} integer keys are already 64 bits, nothing to alter')
+
+    highest = db.session.query(func.max(Tweet.id)).scalar() or 0
+    first = Snowflake().first_id(time.time())
+    if highest >= first:
+        raise click.ClickException(f'tweet id {highest} is above the first snowflake id {first}')
+    click.echo(f'highest tweet id {highest}, snowflake ids start at {first}')
@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import Counter
+from flask import g, request, current_app, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def expose(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Metrics(object):
+    '''Per-endpoint request and SQL histograms, exported in Prometheus text format'''
+
+    histograms = (
+        ('chatbird_request_duration_seconds', 'Request latency', DURATION_BUCKETS),
+        ('chatbird_request_sql_queries', 'SQL statements per request', QUERY_BUCKETS),
+        ('chatbird_request_sql_duration_seconds', 'SQL time per request', DURATION_BUCKETS),
+    )
+    counters = (
+        ('chatbird_slow_queries_total', 'SQL statements over SLOW_QUERY_THRESHOLD'),
+        ('chatbird_repeated_queries_total', 'Requests repeating one statement shape (likely N+1)'),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = {
+                'histograms': {metric: Histogram(buckets) for metric, _, buckets in self.histograms},
+                'counters': Counter(),
+            }
+        return self.endpoints[name]
+
+    def observe(self, name, duration, queries, sql_time, slow, repeated):
+        with self.lock:
+            endpoint = self.endpoint(name)
+            histograms = endpoint['histograms']
+            histograms['chatbird_request_duration_seconds'].observe(duration)
+            histograms['chatbird_request_sql_queries'].observe(queries)
+            histograms['chatbird_request_sql_duration_seconds'].observe(sql_time)
+            endpoint['counters']['chatbird_slow_queries_total'] += slow
+            endpoint['counters']['chatbird_repeated_queries_total'] += repeated
+
+    def expose(self):
+        lines = []
+        with self.lock:
+            for metric, description, _ in self.histograms:
+                lines.append(f'# HELP {metric} {description}')
+                lines.append(f'# TYPE {metric} histogram')
+                for name, endpoint in sorted(self.endpoints.items()):
+                    lines.extend(endpoint['histograms'][metric].expose(
+                        metric, f'endpoint="{name}"'))
+            for metric, description in self.counters:
+                lines.append(f'# HELP {metric} {description}')
+                lines.append(f'# TYPE {metric} counter')
+                for name, endpoint in sorted(self.endpoints.items()):
+                    lines.append(f'{metric}{{endpoint="{name}"}} {endpoint["counters"][metric]}')
+        return '\n'.join(lines) + '\n'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if not has_request_context() or 'sql' not in g:
+        return
+    sql = g.sql
+    sql['count'] += 1
+    sql['time'] += elapsed
+    # statements are already parameterized, the text is the shape
+    sql['shapes'][statement] += 1
+    if elapsed >= current_app.config['SLOW_QUERY_THRESHOLD']:
+        sql['slow'] += 1
+        current_app.logger.warning('slow query (%.1f ms) on %s: %s',
+                                   elapsed * 1000, request.endpoint, statement)
+
+
+def handle_error(context):
+    # a failed statement gets no after_cursor_execute, its start would be popped by the next one
+    if context.connection is None or context.execution_context is None:
+        return
+    starts = context.connection.info.get('query_start')
+    if starts:
+        starts.pop()
+
+
+class Instrumentation(object):
+    '''Counts and times the SQL of every request
+
+    Slow statements and statement shapes repeated within one request (the
+    N+1 pattern) are logged, debug responses carry X-SQL-Queries and
+    X-SQL-Time headers, and per-endpoint histograms are served at /metrics.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.1)
+        app.config.setdefault('REPEATED_QUERY_THRESHOLD', 5)
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.extensions['metrics'] = Metrics()
+
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        if app.config['METRICS_ENABLED']:
+            app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def start_request(self):
+        g.request_start = time.perf_counter()
+        g.sql = {'count': 0, 'time': 0.0, 'slow': 0, 'shapes': Counter()}
+
+    def finish_request(self, response):
+        if 'sql' not in g:
+            return response
+        sql = g.sql
+        duration = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or 'unmatched'
+
+        repeated = [(s, n) for s, n in sql['shapes'].items()
+                    if n >= current_app.config['REPEATED_QUERY_THRESHOLD']]
+        for statement, count in repeated:
+            current_app.logger.warning('statement repeated %d times on %s, likely N+1: %s',
+                                       count, endpoint, statement)
+        current_app.extensions['metrics'].observe(
+            endpoint, duration, sql['count'], sql['time'], sql['slow'], len(repeated))
+
+        if current_app.debug:
+            response.headers['X-SQL-Queries'] = str(sql['count'])
+            response.headers['X-SQL-Time'] = f"{sql['time'] * 1000:.2f}ms"
+        return response
+
+    def export(self):
+        return Response(current_app.extensions['metrics'].expose(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,268 @@
+import atexit
+import threading
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import select, and_, bindparam
+from app.models import db, Tweet, Favorites
+from app.bulk import insert_ignore
+from app.cache import object_cache, mark_dirty
+
+
+class LikeBuffer(object):
+    '''Like states not written yet, {(user_id, tweet_id): (liked, base)}
+
+    base is the state the database holds once every earlier flush lands, an
+    entry whose state goes back to its base cancels out and is dropped.
+    Entries move to inflight while a flush writes them.
+    '''
+
+    def __init__(self):
+        self.pending = {}
+        self.inflight = {}
+        self.deltas = defaultdict(int)
+        # written batches, a snapshot taken before the last one may count its likes twice
+        self.flushes = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def _entry(self, key):
+        return self.pending.get(key) or self.inflight.get(key)
+
+    def known(self, key):
+        with self.lock:
+            return self._entry(key) is not None
+
+    def set(self, key, liked, base):
+        '''Buffer a like state, returns the number of pending pairs
+
+        base, the state in the database, is needed when nothing is buffered
+        for key, without it None is returned and nothing is buffered.
+        '''
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                inflight = self.inflight.get(key)
+                if inflight is None and base is None:
+                    return None
+                entry = (inflight[0], inflight[0]) if inflight else (base, base)
+            current = self._entry(key)
+            before = current[0] if current else base
+            if liked == entry[1]:
+                self.pending.pop(key, None)
+            else:
+                self.pending[key] = (liked, entry[1])
+            self._count(key[1], liked - before)
+            return len(self.pending)
+
+    def _count(self, tweet_id, delta):
+        if delta:
+            self.deltas[tweet_id] += delta
+            if not self.deltas[tweet_id]:
+                del self.deltas[tweet_id]
+
+    def liked(self, user_id, tweet_ids):
+        '''Buffered like states of user_id among tweet_ids'''
+        with self.lock:
+            return {i: entry[0] for i, entry in ((i, self._entry((user_id, i))) for i in tweet_ids)
+                    if entry is not None}
+
+    def counts(self, tweet_ids):
+        '''like_count changes of tweet_ids not written yet'''
+        with self.lock:
+            return {i: self.deltas[i] for i in tweet_ids if i in self.deltas}
+
+    def snapshot(self, user_id=None):
+        '''(flushes, buffered like states of user_id by tweet id, like_count changes), read at once'''
+        with self.lock:
+            states = {}
+            if user_id is not None:
+                # pending entries are newer than inflight ones of the same pair
+                for entries in (self.inflight, self.pending):
+                    states.update((t, entry[0]) for (u, t), entry in entries.items() if u == user_id)
+            return self.flushes, states, dict(self.deltas)
+
+    def take(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.inflight.update(batch)
+            return batch
+
+    def done(self, batch, written):
+        with self.lock:
+            if written:
+                self.flushes += 1
+            for key, entry in batch.items():
+                if self.inflight.get(key) is entry:
+                    del self.inflight[key]
+                if written:
+                    self._count(key[1], entry[1] - entry[0])
+                    continue
+                # nothing landed, the batch goes back under newer states of the same pairs
+                liked = self.pending[key][0] if key in self.pending else entry[0]
+                if liked == entry[1]:
+                    self.pending.pop(key, None)
+                else:
+                    self.pending[key] = (liked, entry[1])
+
+
+class Likes(object):
+    '''Optional write-behind mode for likes
+
+    With LIKE_WRITE_BEHIND the like and unlike routes only buffer the new
+    state per (user, tweet), toggles of the same pair coalesce, and a worker
+    writes the buffer in one transaction every LIKE_FLUSH_INTERVAL seconds
+    or once LIKE_BUFFER_SIZE pairs are pending. is_liked and like_count
+    include buffered states. The buffer lives in the process, what it holds
+    is lost if the process is killed, a normal exit drains it. Every worker
+    process has its own buffer, so toggles of one pair sent to different
+    processes land in the order their flushes run, not the order they came.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LIKE_WRITE_BEHIND', False)
+        app.config.setdefault('LIKE_BUFFER_SIZE', 1000)
+        app.config.setdefault('LIKE_FLUSH_INTERVAL', 1.0)
+        app.extensions['like_buffer'] = LikeBuffer() if app.config['LIKE_WRITE_BEHIND'] else None
+
+    @property
+    def buffer(self):
+        return current_app.extensions['like_buffer']
+
+    def like(self, user, tweet):
+        self.set(user, tweet, True)
+
+    def unlike(self, user, tweet):
+        self.set(user, tweet, False)
+
+    def set(self, user, tweet, liked):
+        buffer = self.buffer
+        key = (user.id, tweet.id)
+        size = None
+        while size is None:
+            base = None if buffer.known(key) else user.has_liked_tweet(tweet)
+            size = buffer.set(key, liked, base)
+        self.buffered([tweet.id], size)
+
+    def like_many(self, user, tweet_ids):
+        '''Buffer likes of every tweet of tweet_ids, returns {id: result} like bulk.like_many'''
+        buffer = self.buffer
+        tweets = Tweet.__table__
+        found = {r[0] for r in db.session.execute(select([tweets.c.id]).where(tweets.c.id.in_(tweet_ids)))}
+        stored = {r[0] for r in db.session.query(Favorites.tweet_id).filter(
+            Favorites.user_id == user.id, Favorites.tweet_id.in_(found))} if found else set()
+        liked = [i for i in tweet_ids if i in found]
+        states = buffer.liked(user.id, liked)
+        size = 0
+        for i in liked:
+            # with a base given set always buffers, the base only counts when nothing is buffered yet
+            size = buffer.set((user.id, i), True, i in stored)
+        if liked:
+            self.buffered(liked, size)
+        return {i: 'not_found' if i not in found else 'already_liked' if states.get(i, i in stored) else 'liked'
+                for i in tweet_ids}
+
+    def buffered(self, tweet_ids, size):
+        # cached payloads were built without these states
+        for tweet_id in tweet_ids:
+            object_cache.invalidate('status', tweet_id)
+        self.start()
+        if size >= current_app.config['LIKE_BUFFER_SIZE']:
+            self.buffer.wakeup.set()
+
+    def flush(self):
+        '''Write every buffered like state in one transaction, returns how many pairs'''
+        buffer = self.buffer
+        with buffer.flush_lock:
+            batch = buffer.take()
+            if not batch:
+                return 0
+            try:
+                deltas = write_likes(batch)
+                for tweet_id in deltas:
+                    mark_dirty(db.session, 'status', tweet_id)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                buffer.done(batch, False)
+                raise
+            buffer.done(batch, True)
+            # a status built between the commit and done() counted the written likes twice
+            for tweet_id in {t for _, t in batch}:
+                object_cache.invalidate('status', tweet_id)
+            return len(batch)
+
+    def work(self, app):
+        buffer = app.extensions['like_buffer']
+        while not buffer.stopped.is_set():
+            buffer.wakeup.wait(app.config['LIKE_FLUSH_INTERVAL'])
+            buffer.wakeup.clear()
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception('like buffer flush failed')
+                finally:
+                    db.session.remove()
+
+    def start(self):
+        buffer = self.buffer
+        with buffer.lock:
+            if buffer.worker is not None or buffer.stopped.is_set():
+                return
+            app = current_app._get_current_object()
+            buffer.worker = threading.Thread(target=self.work, args=(app,), name='like-buffer', daemon=True)
+            buffer.worker.start()
+        atexit.register(self.stop, app)
+
+    def stop(self, app=None):
+        '''Stop the worker and drain the buffer'''
+        app = app or current_app._get_current_object()
+        buffer = app.extensions['like_buffer']
+        buffer.stopped.set()
+        buffer.wakeup.set()
+        if buffer.worker is not None:
+            buffer.worker.join()
+        with app.app_context():
+            try:
+                while self.flush():
+                    pass
+            finally:
+                db.session.remove()
+
+
+likes = Likes()
+
+
+def write_likes(batch):
+    '''Apply {(user_id, tweet_id): (liked, base)} with set-based statements, returns like_count deltas'''
+    favorites = Favorites.__table__
+    deltas = defaultdict(int)
+    inserted = insert_ignore(favorites, [{'user_id': u, 'tweet_id': t} for (u, t), (liked, _) in batch.items()
+                                         if liked], ['user_id', 'tweet_id'])
+    for row in inserted:
+        deltas[row['tweet_id']] += 1
+
+    unliked = {key for key, (liked, _) in batch.items() if not liked}
+    if unliked:
+        rows = [r for r in db.session.execute(select([favorites.c.id, favorites.c.user_id, favorites.c.tweet_id]).where(
+            and_(favorites.c.user_id.in_({u for u, _ in unliked}), favorites.c.tweet_id.in_({t for _, t in unliked}))))
+            if (r[1], r[2]) in unliked]
+        if rows:
+            db.session.execute(favorites.delete().where(favorites.c.id.in_([r[0] for r in rows])))
+        for row in rows:
+            deltas[row[2]] -= 1
+
+    deltas = {t: d for t, d in deltas.items() if d}
+    if deltas:
+        tweets = Tweet.__table__
+        db.session.execute(tweets.update().where(tweets.c.id == bindparam('tweet_id')).values(
+            like_count=tweets.c.like_count + bindparam('delta')),
+            [{'tweet_id': t, 'delta': d} for t, d in deltas.items()])
+    return deltas
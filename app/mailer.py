@@ -0,0 +1,174 @@
+import atexit
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import or_
+from app.models import db, OutboundMail
+
+
+class SMTPTransport(object):
+    '''Sends a batch of messages over a single SMTP connection'''
+
+    def send_batch(self, messages):
+        errors = []
+        with current_app.extensions['mail'].connect() as connection:
+            for message in messages:
+                try:
+                    connection.send(message)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(repr(e))
+        return errors
+
+
+class StubTransport(object):
+    '''Keeps sent messages in memory instead of talking to a mail server'''
+
+    def __init__(self):
+        self.outbox = []
+
+    def send_batch(self, messages):
+        self.outbox.extend(messages)
+        return [None] * len(messages)
+
+
+class Mailer(object):
+    '''Outbound mail queue, requests enqueue rows and a worker pool sends them
+
+    Workers claim due rows by leasing them for MAIL_CLAIM_TIMEOUT seconds,
+    so mail claimed by a worker that died is picked up again afterwards.
+    Failed sends are retried with exponential backoff up to
+    MAIL_MAX_ATTEMPTS times.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_TRANSPORT', 'smtp')
+        app.config.setdefault('MAIL_QUEUE_WORKERS', 2)
+        app.config.setdefault('MAIL_BATCH_SIZE', 50)
+        app.config.setdefault('MAIL_MAX_ATTEMPTS', 5)
+        app.config.setdefault('MAIL_RETRY_BACKOFF', 30)
+        app.config.setdefault('MAIL_CLAIM_TIMEOUT', 300)
+        app.config.setdefault('MAIL_POLL_INTERVAL', 5)
+
+        if app.config['MAIL_TRANSPORT'] == 'stub':
+            transport = StubTransport()
+        else:
+            transport = SMTPTransport()
+        app.extensions['mailer'] = {
+            'transport': transport,
+            'wakeup': threading.Event(),
+            'stopped': threading.Event(),
+            'workers': [],
+            'lock': threading.Lock(),
+        }
+
+        @app.cli.command('send-mail')
+        def send_mail_command():
+            '''Send every queued mail that is due'''
+            while self.process_queue():
+                pass
+
+    @property
+    def state(self):
+        return current_app.extensions['mailer']
+
+    @property
+    def transport(self):
+        return self.state['transport']
+
+    def enqueue(self, subject, recipient, html, sender=None):
+        mail = OutboundMail(subject=subject, recipient=recipient, html=html,
+                            sender=sender or current_app.config.get('MAIL_DEFAULT_SENDER'))
+        mail.insert()
+        self.start()
+        self.state['wakeup'].set()
+        return mail
+
+    def claim(self, limit):
+        now = datetime.utcnow()
+        query = OutboundMail.query.filter(
+            or_(OutboundMail.status == 'pending', OutboundMail.status == 'sending'),
+            OutboundMail.next_attempt_at <= now).order_by(OutboundMail.id).limit(limit)
+        # skip rows another worker holds, a no-op on databases without row locks
+        mails = query.with_for_update(skip_locked=True).all()
+        lease = now + timedelta(seconds=current_app.config['MAIL_CLAIM_TIMEOUT'])
+        for mail in mails:
+            mail.status = 'sending'
+            mail.next_attempt_at = lease
+        db.session.commit()
+        return mails
+
+    def process_queue(self):
+        '''Send one batch of due mail, returns how many were attempted'''
+        config = current_app.config
+        mails = self.claim(config['MAIL_BATCH_SIZE'])
+        if not mails:
+            return 0
+        messages = [Message(m.subject, sender=m.sender, recipients=[m.recipient], html=m.html)
+                    for m in mails]
+        try:
+            errors = self.transport.send_batch(messages)
+        except Exception as e:
+            errors = [repr(e)] * len(mails)
+
+        now = datetime.utcnow()
+        for mail, error in zip(mails, errors):
+            if error is None:
+                mail.status = 'sent'
+                mail.sent_at = now
+                continue
+            mail.attempts += 1
+            mail.last_error = error
+            if mail.attempts >= config['MAIL_MAX_ATTEMPTS']:
+                mail.status = 'failed'
+            else:
+                mail.status = 'pending'
+                mail.next_attempt_at = now + timedelta(
+                    seconds=config['MAIL_RETRY_BACKOFF'] * 2 ** (mail.attempts - 1))
+        db.session.commit()
+        return len(mails)
+
+    def work(self, app):
+        state = app.extensions['mailer']
+        while not state['stopped'].is_set():
+            with app.app_context():
+                try:
+                    sent = self.process_queue()
+                except Exception:
+                    app.logger.exception('mail queue worker failed')
+                    db.session.rollback()
+                    sent = 0
+                finally:
+                    db.session.remove()
+            if not sent:
+                state['wakeup'].wait(app.config['MAIL_POLL_INTERVAL'])
+                state['wakeup'].clear()
+
+    def start(self):
+        state = self.state
+        with state['lock']:
+            if state['workers'] or state['stopped'].is_set():
+                return
+            app = current_app._get_current_object()
+            for i in range(app.config['MAIL_QUEUE_WORKERS']):
+                worker = threading.Thread(
+                    target=self.work, args=(app,), name=f'mailer-{i}', daemon=True)
+                worker.start()
+                state['workers'].append(worker)
+            if state['workers']:
+                atexit.register(self.stop, state)
+
+    def stop(self, state=None):
+        state = state or self.state
+        state['stopped'].set()
+        state['wakeup'].set()
+        for worker in state['workers']:
+            worker.join()
+
+
+mailer = Mailer()
@@ -1,11 +1,13 @@
+import hashlib
 from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from flask import current_app, has_app_context
+from sqlalchemy import event, select, literal, union_all, exists, and_
 from flask_marshmallow import Marshmallow
 from marshmallow import fields
-from werkzeug.security import generate_password_hash
+from app.hashing import hasher
+from app.replicas import db
+from app.serializers import CompiledSchema
 
-db = SQLAlchemy()
 ma = Marshmallow()
 
 
@@ -20,23 +22,98 @@ class Token(db.Model):
         db.session.commit()
 
 
+# tweet ids are 64 bit for snowflake ids, sqlite only autoincrements an INTEGER primary key
+TweetId = db.BigInteger().with_variant(db.Integer, 'sqlite')
+
+
+class IdWorker(db.Model):
+    '''Lease of a snowflake worker id, see app.ids'''
+    worker_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    owner = db.Column(db.String(255), nullable=False)
+    renewed_at = db.Column(db.DateTime(), nullable=False)
+
+
+class OutboundMail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    sender = db.Column(db.String(120))
+    recipient = db.Column(db.String(120))
+    html = db.Column(db.Text)
+    status = db.Column(db.String(16), default='pending', index=True)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    next_attempt_at = db.Column(db.DateTime(), default=datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime(), default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime())
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer,
-                               db.ForeignKey('user.id')),
+                               db.ForeignKey('user.id'), nullable=False),
                      db.Column('followed_id', db.Integer,
-                               db.ForeignKey('user.id'))
+                               db.ForeignKey('user.id'), nullable=False),
+                     # one edge per pair, indexed from both ends of the edge
+                     db.UniqueConstraint('follower_id', 'followed_id',
+                                         name='uq_followers_follower_followed'),
+                     db.Index('ix_followers_followed_follower',
+                              'followed_id', 'follower_id', unique=True)
                      )
 
 
+class Suggestion(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    computed_at = db.Column(db.DateTime(), default=datetime.utcnow)
+
+
+class SuggestionRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    started_at = db.Column(db.DateTime(), nullable=False)
+    finished_at = db.Column(db.DateTime())
+    users = db.Column(db.Integer, default=0)
+
+
 class Favorites(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    tweet_id = db.Column(db.Integer, db.ForeignKey('tweet.id'))
+    tweet_id = db.Column(TweetId, db.ForeignKey('tweet.id'))
+    __table_args__ = (db.UniqueConstraint('user_id', 'tweet_id', name='uq_favorites_user_tweet'),)
 
     def __repr__(self):
         return '<Favorite {} {}>'.format(self.user_id, self.tweet_id)
 
 
+class TweetHashtag(db.Model):
+    tweet_id = db.Column(TweetId, db.ForeignKey('tweet.id', ondelete='CASCADE'), primary_key=True)
+    tag = db.Column(db.String(64), primary_key=True)
+    __table_args__ = (db.Index('ix_tweet_hashtag_tag_tweet', 'tag', 'tweet_id'),)
+
+
+class Mention(db.Model):
+    tweet_id = db.Column(TweetId, db.ForeignKey('tweet.id', ondelete='CASCADE'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    __table_args__ = (db.Index('ix_mention_user_tweet', 'user_id', 'tweet_id'),)
+
+
+class TrendBucket(db.Model):
+    tag = db.Column(db.String(64), primary_key=True)
+    # epoch seconds // TRENDS_BUCKET_SECONDS
+    bucket = db.Column(db.Integer, primary_key=True, index=True)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+
+class Trend(db.Model):
+    tag = db.Column(db.String(64), primary_key=True)
+    score = db.Column(db.Float, nullable=False, index=True)
+    count = db.Column(db.Integer, nullable=False)
+    computed_at = db.Column(db.DateTime(), default=datetime.utcnow)
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
@@ -45,6 +122,10 @@ class User(db.Model):
     password_hash = db.Column(db.String(128))
     code = db.Column(db.String(6))
     verified = db.Column(db.Boolean, default=False)
+    followers_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # last follow or unfollow, suggestions are recomputed around users changed since the last run
+    graph_updated_at = db.Column(db.DateTime(), index=True)
     tweets = db.relationship('Tweet', backref='user', lazy='dynamic')
     followed = db.relationship('User', secondary=followers, primaryjoin=(followers.c.follower_id == id), secondaryjoin=(
         followers.c.followed_id == id), backref=db.backref('followers', lazy='dynamic'), lazy='dynamic')
@@ -63,30 +144,39 @@ class User(db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_count = User.followed_count + 1
+            self.graph_updated_at = datetime.utcnow()
+            user.followers_count = User.followers_count + 1
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_count = User.followed_count - 1
+            self.graph_updated_at = datetime.utcnow()
+            user.followers_count = User.followers_count - 1
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return db.session.query(exists().where(and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))).scalar()
 
     def get_followed_tweets(self):
         return Tweet.query.join(followers, followers.c.followed_id == Tweet.user_id).filter(
             followers.c.follower_id == self.id).order_by(
-            Tweet.timestamp.desc())
+            Tweet.id.desc())
 
     def like(self, tweet):
         if not self.has_liked_tweet(tweet):
             like = Favorites(user_id=self.id, tweet_id=tweet.id)
             db.session.add(like)
+            tweet.like_count = Tweet.like_count + 1
 
     def unlike(self, tweet):
-        if self.has_liked_tweet(tweet):
-            Favorites.query.filter_by(
-                user_id=self.id,
-                tweet_id=tweet.id).delete()
+        deleted = Favorites.query.filter_by(
+            user_id=self.id,
+            tweet_id=tweet.id).delete()
+        if deleted:
+            tweet.like_count = Tweet.like_count - deleted
 
     def has_liked_tweet(self, tweet):
         return Favorites.query.filter(
@@ -95,68 +185,253 @@ class User(db.Model):
 
 
 def hashPassword(mapper, connection, target):
-    target.password_hash = generate_password_hash(target.password_hash)
+    target.password_hash = hasher.hash(target.password_hash)
 
 
 event.listen(
     User, 'before_insert', hashPassword)
 
+# mentions look usernames up ignoring case
+db.Index('ix_user_username_lower', db.func.lower(User.username))
+
 
-class UserSchema(ma.Schema):
+class UserSchema(CompiledSchema, ma.Schema):
     # followers =ma.Nested("self",many=True, exclude=('followers',"followed","tweets"))
     # followed =ma.Nested("self",many=True, exclude=('followers',"followed","tweets"))
     # tweets =ma.Nested(lambda:TweetSchema(),many=True)
 
-    followers_count = fields.Function(lambda obj: obj.followers.count())
-    followed_count = fields.Function(lambda obj: obj.followed.count())
-
     class Meta:
         fields = ("email", "id", "username",
                   "followed_count", "followers_count")
 
 
 class Tweet(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(TweetId, primary_key=True)
     text = db.Column(db.String(140))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     timestamp = db.Column(db.DateTime(), default=datetime.utcnow, index=True)
-    retweet_status_id = db.Column(db.Integer, db.ForeignKey('tweet.id'))
+    retweet_status_id = db.Column(TweetId, db.ForeignKey('tweet.id'))
     retweets = db.relationship(
         'Tweet', foreign_keys=[retweet_status_id], backref=db.backref('retweet_status', remote_side=[id]),
         lazy='dynamic')
 
-    in_reply_to_status_id = db.Column(db.Integer, db.ForeignKey('tweet.id'))
+    in_reply_to_status_id = db.Column(TweetId, db.ForeignKey('tweet.id'))
 
     replies = db.relationship(
         'Tweet', foreign_keys=[in_reply_to_status_id], backref=db.backref('in_reply_to_status', remote_side=[id]),
         lazy='dynamic')
     favorites = db.relationship('Favorites', backref='tweet', lazy='dynamic')
+    __table_args__ = (db.Index('ix_tweet_reply_to_id', 'in_reply_to_status_id', 'id'),)
+
+    reply_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    retweet_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    like_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     def insert(self):
         db.session.add(self)
         db.session.commit()
 
 
+def update_parent_counts(connection, target, step):
+    tweets = Tweet.__table__
+    for parent_id, column in ((target.in_reply_to_status_id, tweets.c.reply_count),
+                              (target.retweet_status_id, tweets.c.retweet_count)):
+        if parent_id is not None:
+            connection.execute(tweets.update().where(
+                tweets.c.id == parent_id).values({column: column + step}))
+
+
+def countReply(mapper, connection, target):
+    update_parent_counts(connection, target, 1)
+
+
+def uncountReply(mapper, connection, target):
+    update_parent_counts(connection, target, -1)
+
+
+event.listen(
+    Tweet, 'after_insert', countReply)
+event.listen(
+    Tweet, 'after_delete', uncountReply)
+
+
+def get_thread(status_id, max_depth, max_size):
+    '''Load a status with its ancestors and up to max_size descendants in one query
+
+    Returns (tweet, depth) pairs ordered by depth, ancestors have a negative
+    depth, the status itself 0 and replies count up from 1. Each level of
+    replies keeps only the first max_size replies to the level above it, so a
+    large reply tree is never read past max_depth * max_size rows.
+    '''
+    tweets = Tweet.__table__
+    root = select([tweets.c.id, tweets.c.in_reply_to_status_id, literal(0).label('depth')]).where(
+        tweets.c.id == status_id)
+
+    ancestors = root.cte('ancestors', recursive=True)
+    parent = ancestors.alias('parent')
+    ancestors = ancestors.union_all(
+        select([tweets.c.id, tweets.c.in_reply_to_status_id, parent.c.depth - 1]).where(
+            tweets.c.id == parent.c.in_reply_to_status_id).where(parent.c.depth > -max_depth))
+
+    level = root.cte('replies_0')
+    parts = [select([ancestors.c.id, ancestors.c.depth]).where(ancestors.c.depth < 0),
+             select([level.c.id, level.c.depth])]
+    levels = []
+    for depth in range(1, max_depth + 1):
+        level = select([tweets.c.id, literal(depth).label('depth')]).where(
+            tweets.c.in_reply_to_status_id.in_(select([level.c.id]))).order_by(
+            tweets.c.id).limit(max_size).cte('replies_%d' % depth)
+        levels.append(select([level.c.id, level.c.depth]))
+    if levels:
+        replies = union_all(*levels)
+        replies = replies.order_by(replies.c.depth, replies.c.id).limit(max_size).alias('replies')
+        parts.append(select([replies.c.id, replies.c.depth]))
+
+    thread = union_all(*parts).alias('thread')
+    return db.session.query(Tweet, thread.c.depth).join(thread, thread.c.id == Tweet.id).order_by(
+        thread.c.depth, Tweet.id).all()
+
+
 def get_Like_state(obj, context):
     if not context.get('user', None):
         return False
-    else:
-        return context['user'].has_liked_tweet(obj)
-
-
-class TweetSchema(ma.Schema):
+    liked = context.get('liked')
+    if liked is not None and obj.id in liked:
+        return liked[obj.id]
+    return context['user'].has_liked_tweet(obj)
+
+
+FINGERPRINT_COLUMNS = (Tweet.id, Tweet.retweet_status_id, Tweet.in_reply_to_status_id, Tweet.user_id,
+                       Tweet.like_count, Tweet.reply_count, Tweet.retweet_count,
+                       User.followers_count, User.followed_count)
+
+
+def get_tweet_fingerprint(tweet_ids, user=None, extra=None):
+    '''Digest of everything a page of tweets serializes to, without loading the tweets
+
+    Covers the ids in page order, the counters of every tweet on the page and
+    of the statuses nested in them, their authors' counters, the viewer's
+    like state and anything else passed as extra.
+    '''
+    def read():
+        rows = {}
+        pending = set(tweet_ids)
+        # the page and the two levels of nested statuses TweetSchema renders
+        for _ in range(3):
+            if not pending:
+                break
+            rows.update((r[0], tuple(r)) for r in db.session.query(*FINGERPRINT_COLUMNS).outerjoin(
+                User, User.id == Tweet.user_id).filter(Tweet.id.in_(pending)))
+            pending = {i for r in rows.values() for i in r[1:3]
+                       if i is not None and i not in rows}
+        liked = set()
+        if user is not None and rows:
+            liked = {r[0] for r in db.session.query(Favorites.tweet_id).filter(
+                Favorites.user_id == user.id, Favorites.tweet_id.in_(list(rows)))}
+        return rows, liked
+
+    (rows, liked), states, counts = read_with_pending_likes(read, user)
+    rows = {i: r[:4] + (r[4] + counts.get(i, 0),) + r[5:] for i, r in rows.items()}
+    liked = [i for i in rows if states.get(i, i in liked)]
+    return fingerprint(tweet_ids, rows.values(), liked, extra)
+
+
+def fingerprint(tweet_ids, rows, liked, extra=None):
+    '''Hash of a page from rows of FINGERPRINT_COLUMNS and the ids the viewer liked'''
+    digest = hashlib.sha1(repr((list(tweet_ids), sorted(rows), sorted(liked), extra)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def pending_likes():
+    '''The write-behind like buffer of app.likes, None when it is off'''
+    if has_app_context():
+        return current_app.extensions.get('like_buffer')
+    return None
+
+
+def read_with_pending_likes(read, user=None, attempts=3):
+    '''read() with the write-behind buffer laid over it, returns (result, like states of user, like_count changes)
+
+    The buffer is read first and its states win over the database, so a
+    flush landing before read() cannot hide one. A flush finishing in
+    between would have its likes counted twice, read() is repeated then.
+    '''
+    buffer = pending_likes()
+    if buffer is None:
+        return read(), {}, {}
+    for _ in range(attempts):
+        flushes, states, counts = buffer.snapshot(None if user is None else user.id)
+        result = read()
+        if buffer.flushes == flushes:
+            break
+    return result, states, counts
+
+
+def get_tweet_context(tweets, user=None):
+    '''Collect everything TweetSchema needs for a page of tweets in a fixed number of queries'''
+    context = {'user': user}
+    loaded = {t.id: t for t in tweets}
+    if not loaded:
+        return context
+
+    # nested statuses go at most two levels deep (a reply to a retweet),
+    # loading them here puts them in the identity map for the schema
+    for _ in range(2):
+        missing = {i for t in loaded.values()
+                   for i in (t.retweet_status_id, t.in_reply_to_status_id)
+                   if i is not None and i not in loaded}
+        if not missing:
+            break
+        loaded.update(
+            (t.id, t) for t in Tweet.query.filter(Tweet.id.in_(missing)))
+    user_ids = {t.user_id for t in loaded.values() if t.user_id is not None}
+    users = User.query.filter(User.id.in_(user_ids)).all() if user_ids else []
+
+    # the session only holds weak references, keep the batch alive until dumped
+    context['preloaded'] = (loaded, users)
+    add_viewer_state(context, list(loaded.values()), user)
+    return context
+
+
+def add_viewer_state(context, tweets, user=None):
+    '''Put the like states of user and the buffered like counts of tweets in a TweetSchema context'''
+    ids = [t.id for t in tweets]
+    buffered = pending_likes() is not None
+
+    def read():
+        liked = set()
+        if user is not None:
+            liked = {r[0] for r in db.session.query(Favorites.tweet_id).filter(
+                Favorites.user_id == user.id, Favorites.tweet_id.in_(ids))}
+        # tweets were loaded before the buffer was read, their counts are read again after it
+        stored = dict(db.session.query(Tweet.id, Tweet.like_count).filter(Tweet.id.in_(ids))) if buffered else {}
+        return liked, stored
+
+    (liked, stored), states, counts = read_with_pending_likes(read, user)
+    if user is not None:
+        context['liked'] = {i: states.get(i, i in liked) for i in ids}
+    if buffered:
+        context['like_counts'] = {t.id: stored.get(t.id, t.like_count) - t.like_count + counts.get(t.id, 0)
+                                  for t in tweets}
+    return context
+
+
+class TweetSchema(CompiledSchema, ma.Schema):
     in_reply_to_status = ma.Nested(
         lambda: TweetSchema(exclude=('in_reply_to_status', )))
     retweet_status = ma.Nested(
         lambda: TweetSchema(exclude=('retweet_status', 'in_reply_to_status')))
     # user=ma.Nested(UserSchema,exclude=("followers","followed","tweets"))
     # user = ma.Nested(UserSchema, exclude=("tweets",))
-    reply_count = fields.Function(lambda obj: obj.replies.count())
-    like_count = fields.Function(lambda obj: obj.favorites.count())
     is_liked = fields.Function(
         lambda obj, context: get_Like_state(obj, context))
+    # plus likes still in the write-behind buffer
+    like_count = fields.Function(
+        lambda obj, context: obj.like_count + context.get('like_counts', {}).get(obj.id, 0))
     user = ma.Nested(UserSchema)
+    # snowflake ids do not fit the 53 bits a javascript number holds exactly
+    id_str = fields.Function(lambda obj: str(obj.id))
 
     class Meta:
-        fields = ("text", "id", "timestamp",
-                  "in_reply_to_status", "user", "reply_count", "is_liked", "like_count", 'retweet_status')
+        fields = ("text", "id", "id_str", "timestamp",
+                  "in_reply_to_status", "user", "reply_count", "is_liked", "like_count", "retweet_count", 'retweet_status')
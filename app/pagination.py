@@ -0,0 +1,72 @@
+import base64
+import json
+from datetime import datetime
+from flask import request, current_app, jsonify
+from sqlalchemy import and_, or_
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('utf-8')
+
+
+def load_cursor_value(column, value):
+    # variants leave python_type to the type they wrap
+    python_type = getattr(column.type, 'impl', column.type).python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    return python_type(value)
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return [load_cursor_value(c, v) for c, v in zip(columns, values)]
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def get_page_size():
+    count = request.args.get('count', type=int) or current_app.config['PAGE_SIZE']
+    return max(1, min(count, current_app.config['MAX_PAGE_SIZE']))
+
+
+def after(columns, values, descending=True):
+    # (a, b) < (x, y) spelled out so it also runs where row values are not supported
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column < value if descending else column > value
+    return or_(column < value if descending else column > value,
+               and_(column == value, after(columns[1:], values[1:], descending)))
+
+
+def paginate(query, columns, descending=True):
+    '''Keyset paginate query on columns, reading count and cursor from the request
+
+    Returns the items of the page and the cursor of the next page, or None
+    when this is the last one.
+    '''
+    count = get_page_size()
+    cursor = request.args.get('cursor')
+    if cursor:
+        query = query.filter(
+            after(columns, decode_cursor(cursor, columns), descending))
+    order = [c.desc() if descending else c.asc() for c in columns]
+    items = query.order_by(None).order_by(*order).limit(count + 1).all()
+    next_cursor = None
+    if len(items) > count:
+        items = items[:count]
+        next_cursor = encode_cursor(
+            [getattr(items[-1], c.key) for c in columns])
+    return items, next_cursor
+
+
+def handle_invalid_cursor(e):
+    return jsonify({'error': {'message': 'invalid cursor'}, 'data': None}), 400
@@ -0,0 +1,168 @@
+import random
+from contextlib import contextmanager
+from functools import wraps
+import sqlalchemy
+from flask import current_app, g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import SelectBase
+
+POOL_OPTIONS = {
+    'pool_size': 'DB_POOL_SIZE',
+    'max_overflow': 'DB_MAX_OVERFLOW',
+    'pool_timeout': 'DB_POOL_TIMEOUT',
+    'pool_recycle': 'DB_POOL_RECYCLE',
+    'pool_pre_ping': 'DB_POOL_PRE_PING',
+}
+
+
+class RedisStickiness(object):
+    '''Stickiness shared by every worker through redis'''
+
+    def __init__(self, url, prefix='sticky:'):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def set(self, user_id, value, ttl):
+        if ttl > 0:
+            self.redis.set(f'{self.prefix}{user_id}', 1, px=int(ttl * 1000))
+
+    def __contains__(self, user_id):
+        return bool(self.redis.exists(f'{self.prefix}{user_id}'))
+
+
+class RoutingSession(SignallingSession):
+    '''Sends plain selects of read only requests to a replica, everything else to the primary'''
+
+    def get_bind(self, mapper=None, clause=None):
+        if db.reads_from_replica(self, clause):
+            return random.choice(current_app.extensions['replicas']['engines'])
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''SQLAlchemy with configurable pools and read replicas
+
+    Views wrapped in read_only send their selects to one of the
+    SQLALCHEMY_REPLICA_URIS, writes and every other request stay on the
+    primary. A user whose request committed a write reads from the primary
+    for REPLICA_STICKY_SECONDS afterwards, so they see their own writes
+    while replicas catch up. Stickiness is per process unless
+    REPLICA_STICKY_SHARED = 'redis'.
+    '''
+
+    def init_app(self, app):
+        app.config.setdefault('DB_POOL_SIZE', 10)
+        app.config.setdefault('DB_MAX_OVERFLOW', 20)
+        app.config.setdefault('DB_POOL_TIMEOUT', 30)
+        app.config.setdefault('DB_POOL_RECYCLE', 1800)
+        app.config.setdefault('DB_POOL_PRE_PING', True)
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        app.config.setdefault('REPLICA_STICKY_SHARED', None)
+        app.config.setdefault('REPLICA_STICKY_SIZE', 10000)
+        SQLAlchemy.init_app(self, app)
+
+        from app.cache import TTLCache
+        if app.config['REPLICA_STICKY_SHARED'] == 'redis':
+            sticky = RedisStickiness(app.config['REDIS_URL'])
+        else:
+            sticky = TTLCache(app.config['REPLICA_STICKY_SIZE'], app.config['REPLICA_STICKY_SECONDS'])
+        app.extensions['replicas'] = {
+            'engines': [self.create_replica_engine(app, uri) for uri in app.config['SQLALCHEMY_REPLICA_URIS']],
+            'sticky': sticky,
+        }
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_replica_engine(self, app, uri):
+        sa_url = make_url(uri)
+        options = {}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, sa_url, options)
+        options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        return sqlalchemy.create_engine(sa_url, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        # sqlite gets its own pool class above, it takes none of these
+        if sa_url.drivername != 'sqlite':
+            for option, key in POOL_OPTIONS.items():
+                options.setdefault(option, app.config[key])
+
+    def reads_from_replica(self, session, clause):
+        if not (has_request_context() and g.get('read_only') and not g.get('primary')):
+            return False
+        if session._flushing or session.info.get('wrote'):
+            return False
+        # select ... for update takes locks, only the primary can
+        if not isinstance(clause, SelectBase) or getattr(clause, '_for_update_arg', None) is not None:
+            return False
+        state = current_app.extensions['replicas']
+        if not state['engines']:
+            return False
+        user_id = g.get('user_id')
+        return user_id is None or user_id not in state['sticky']
+
+    def stick(self, user_id):
+        '''Read user_id's requests from the primary for REPLICA_STICKY_SECONDS'''
+        current_app.extensions['replicas']['sticky'].set(
+            user_id, True, current_app.config['REPLICA_STICKY_SECONDS'])
+
+
+db = RoutingSQLAlchemy()
+
+
+def read_only(f):
+    '''Let the view read from a replica, put it below protected'''
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@contextmanager
+def primary():
+    '''Read from the primary inside the block, even in a read only view'''
+    if not has_request_context():
+        yield
+        return
+    previous = g.get('primary')
+    g.primary = True
+    try:
+        yield
+    finally:
+        g.primary = previous
+
+
+def written(session):
+    '''Keep session on the primary, for writes made with Core statements that flush nothing'''
+    session.info['wrote'] = True
+
+
+def mark_wrote(session, flush_context):
+    written(session)
+
+
+def mark_bulk_wrote(update_context):
+    written(update_context.session)
+
+
+def stick_writer(session):
+    if session.info.pop('wrote', False) and has_request_context() and g.get('user_id') is not None:
+        db.stick(g.user_id)
+
+
+def forget_wrote(session, previous_transaction):
+    session.info.pop('wrote', None)
+
+
+event.listen(RoutingSession, 'after_flush', mark_wrote)
+event.listen(RoutingSession, 'after_bulk_update', mark_bulk_wrote)
+event.listen(RoutingSession, 'after_bulk_delete', mark_bulk_wrote)
+event.listen(RoutingSession, 'after_commit', stick_writer)
+event.listen(RoutingSession, 'after_soft_rollback', forget_wrote)
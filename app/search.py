@@ -0,0 +1,243 @@
+import math
+import re
+import threading
+import click
+from collections import Counter
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, func, cast, inspect, literal_column, DDL, Integer
+from sqlalchemy.orm import object_session
+from sqlalchemy.sql import column
+from app.models import db, User, Tweet
+from app.pagination import encode_cursor, decode_cursor, after
+
+# ranks are scaled to integers so cursors compare exactly on every backend
+RANK_SCALE = 1000000
+rank_column = column('rank', Integer)
+
+# kind: (model, searched column, text search configuration)
+FIELDS = {
+    'status': (Tweet, Tweet.text, 'english'),
+    'user': (User, User.username, 'simple'),
+}
+
+
+def create_search_index(model, searched, config, concurrently=False):
+    '''The CREATE INDEX statement of the GIN index PostgresSearchIndex searches'''
+    return (f'CREATE INDEX {"CONCURRENTLY " if concurrently else ""}IF NOT EXISTS '
+            f'ix_{model.__tablename__}_{searched.key}_search ON "{model.__tablename__}" USING gin '
+            f"""(to_tsvector('{config}', coalesce("{searched.key}", '')))""")
+
+
+for _model, _column, _config in FIELDS.values():
+    event.listen(_model.__table__, 'after_create', DDL(
+        create_search_index(_model, _column, _config)).execute_if(dialect='postgresql'))
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+class PostgresSearchIndex(object):
+    '''Search on GIN expression indexes over to_tsvector, PostgreSQL keeps them in sync'''
+
+    def search(self, kind, q, count, cursor=None):
+        model, searched, config = FIELDS[kind]
+        # spelled like the index expression so the planner can use it
+        config = literal_column(f"'{config}'::regconfig")
+        vector = func.to_tsvector(config, func.coalesce(searched, ''))
+        query = func.plainto_tsquery(config, q)
+        rank = cast(func.ts_rank_cd(vector, query) * RANK_SCALE, Integer)
+        rows = db.session.query(model.id, rank).filter(vector.op('@@')(query))
+        if cursor is not None:
+            rows = rows.filter(after([rank, model.id], cursor))
+        return rows.order_by(rank.desc(), model.id.desc()).limit(count).all()
+
+    def changed(self, kind, id, text):
+        pass
+
+
+class InvertedIndex(object):
+    '''In-process inverted index, {token: {doc id: term frequency}}'''
+
+    def __init__(self):
+        self.postings = {}
+        self.docs = {}
+        self.built = False
+        self.lock = threading.Lock()
+
+    def add(self, id, text):
+        self.remove(id)
+        tokens = Counter(tokenize(text))
+        self.docs[id] = tokens
+        for token, tf in tokens.items():
+            self.postings.setdefault(token, {})[id] = tf
+
+    def remove(self, id):
+        for token in self.docs.pop(id, ()):
+            postings = self.postings[token]
+            postings.pop(id, None)
+            if not postings:
+                del self.postings[token]
+
+    def search(self, q):
+        '''(id, rank) of the docs holding every token of q, ranked by tf-idf'''
+        tokens = set(tokenize(q))
+        lists = sorted((self.postings.get(t, {}) for t in tokens), key=len)
+        if not lists:
+            return []
+        # intersect starting from the rarest token, the work is bounded by its postings
+        ids = set(lists[0])
+        for postings in lists[1:]:
+            if not ids:
+                break
+            ids.intersection_update(postings)
+        if not ids:
+            return []
+        n = len(self.docs)
+        idf = [math.log(1 + n / len(postings)) for postings in lists]
+        return [(id, int(sum(p[id] * w for p, w in zip(lists, idf)) * RANK_SCALE)) for id in ids]
+
+
+class MemorySearchIndex(object):
+    '''Inverted index fallback for databases without full-text search
+
+    Each kind is built from the database on its first search and kept in
+    sync by the commits of this process.
+    '''
+
+    def __init__(self):
+        self.indexes = {kind: InvertedIndex() for kind in FIELDS}
+
+    def _index(self, kind):
+        index = self.indexes[kind]
+        with index.lock:
+            if not index.built:
+                model, searched, _ = FIELDS[kind]
+                for id, text in db.session.query(model.id, searched).yield_per(1000):
+                    index.add(id, text)
+                index.built = True
+        return index
+
+    def search(self, kind, q, count, cursor=None):
+        index = self._index(kind)
+        with index.lock:
+            rows = index.search(q)
+        if cursor is not None:
+            rank, id = cursor
+            rows = [r for r in rows if (r[1], r[0]) < (rank, id)]
+        rows.sort(key=lambda r: (r[1], r[0]), reverse=True)
+        return rows[:count]
+
+    def changed(self, kind, id, text):
+        index = self.indexes[kind]
+        with index.lock:
+            if not index.built:
+                return
+            if text is None:
+                index.remove(id)
+            else:
+                index.add(id, text)
+
+
+class Search(object):
+    '''Full-text search over tweet text and usernames
+
+    SEARCH_BACKEND is 'postgres' for tsvector GIN indexes or 'memory' for the
+    inverted index fallback, by default it follows the database in use.
+    Results are ranked and keyset paginated on (rank, id).
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.setdefault('SEARCH_BACKEND', None)
+        if backend is None:
+            uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+            backend = 'postgres' if uri.startswith('postgres') else 'memory'
+        if backend == 'postgres':
+            index = PostgresSearchIndex()
+        else:
+            index = MemorySearchIndex()
+        app.extensions['search'] = index
+
+    @property
+    def index(self):
+        return current_app.extensions['search']
+
+    def search(self, kind, q, count, cursor=None):
+        '''Ids of a page of matches for q, best first, and the next cursor'''
+        if cursor is not None:
+            cursor = tuple(decode_cursor(cursor, [rank_column, FIELDS[kind][0].id]))
+        rows = self.index.search(kind, q, count + 1, cursor)
+        next_cursor = None
+        if len(rows) > count:
+            rows = rows[:count]
+            next_cursor = encode_cursor([rows[-1][1], rows[-1][0]])
+        return [r[0] for r in rows], next_cursor
+
+
+search = Search()
+
+
+def mark_indexed(kind, key):
+    def mark(mapper, connection, target):
+        session = object_session(target)
+        if session is not None and inspect(target).attrs[key].history.has_changes():
+            session.info.setdefault('search_changes', {})[(kind, target.id)] = getattr(target, key)
+    return mark
+
+
+def mark_unindexed(kind):
+    def mark(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('search_changes', {})[(kind, target.id)] = None
+    return mark
+
+
+def apply_indexed(session):
+    changes = session.info.pop('search_changes', None)
+    if changes and has_app_context() and 'search' in current_app.extensions:
+        for (kind, id), text in changes.items():
+            search.index.changed(kind, id, text)
+
+
+def forget_indexed(session, previous_transaction):
+    session.info.pop('search_changes', None)
+
+
+for _kind, (_model, _column, _) in FIELDS.items():
+    event.listen(_model, 'after_insert', mark_indexed(_kind, _column.key))
+    event.listen(_model, 'after_update', mark_indexed(_kind, _column.key))
+    event.listen(_model, 'after_delete', mark_unindexed(_kind))
+event.listen(SignallingSession, 'after_commit', apply_indexed)
+event.listen(SignallingSession, 'after_soft_rollback', forget_indexed)
+
+
+@click.command('create-search-indexes')
+@with_appcontext
+@click.option('--dry-run', is_flag=True, help='Only print the statements.')
+def create_search_indexes_command(dry_run):
+    '''Add the full-text search indexes to tables created before they existed
+
+    create_all only adds them to new tables. The indexes are built
+    CONCURRENTLY, so writes go on while a large table is indexed.
+    '''
+    dialect = db.engine.dialect.name
+    if dialect != 'postgresql':
+        click.echo(f'{dialect} searches the in-process index, nothing to create')
+        return
+    statements = [create_search_index(*fields, concurrently=True) for fields in FIELDS.values()]
+    if dry_run:
+        for statement in statements:
+            click.echo(statement)
+        return
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for statement in statements:
+            click.echo(statement)
+            connection.execute(statement)
@@ -0,0 +1,238 @@
+import atexit
+import json
+import select
+import threading
+from collections import deque
+from flask import current_app
+from sqlalchemy import func
+from app.models import db, followers
+
+
+class Subscription(object):
+    '''Bounded queue of one connected client
+
+    A client that falls more than STREAM_QUEUE_SIZE messages behind loses
+    the oldest ones and is told to resync, publishers never block on it.
+    '''
+
+    def __init__(self, user_id, followed_ids, maxsize):
+        self.user_id = user_id
+        self.followed_ids = frozenset(followed_ids)
+        self.messages = deque(maxlen=maxsize)
+        self.overflowed = False
+        self.ready = threading.Event()
+        # called from the publishing thread on every put, the ASGI side wakes its event loop with it
+        self.notify = None
+
+    def put(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.overflowed = True
+        self.messages.append(message)
+        self.ready.set()
+        if self.notify is not None:
+            self.notify()
+
+    def get(self, timeout):
+        '''Pending messages, waiting up to timeout, and whether some were dropped'''
+        if not self.messages:
+            self.ready.wait(timeout)
+        self.ready.clear()
+        return self.take()
+
+    def take(self):
+        '''Pending messages without waiting, and whether some were dropped'''
+        messages = []
+        while self.messages:
+            messages.append(self.messages.popleft())
+        overflowed, self.overflowed = self.overflowed, False
+        return messages, overflowed
+
+
+class Hub(object):
+    '''In-process pub/sub, subscriptions are indexed by the authors they follow'''
+
+    def __init__(self):
+        self.by_author = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, subscription):
+        with self.lock:
+            for author_id in subscription.followed_ids:
+                self.by_author.setdefault(author_id, set()).add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for author_id in subscription.followed_ids:
+                subscriptions = self.by_author.get(author_id)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self.by_author[author_id]
+
+    def dispatch(self, message):
+        with self.lock:
+            subscriptions = list(self.by_author.get(message['user_id'], ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+
+class LocalBroker(object):
+    '''Delivers straight to the hub of this process'''
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, message):
+        self.hub.dispatch(message)
+
+    def start(self, app):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PostgresBroker(object):
+    '''Fans messages out to every worker through LISTEN/NOTIFY on one channel'''
+
+    def __init__(self, hub, channel):
+        self.hub = hub
+        self.channel = channel
+        self.listener = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def publish(self, message):
+        with db.engine.connect() as connection:
+            connection.execution_options(autocommit=True).execute(
+                db.select([func.pg_notify(self.channel, json.dumps(message))]))
+
+    def start(self, app):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(
+                    target=self.listen, args=(app,), name='stream-listener', daemon=True)
+                self.listener.start()
+                atexit.register(self.stop)
+
+    def listen(self, app):
+        with app.app_context():
+            connection = db.engine.raw_connection()
+        try:
+            connection.connection.set_session(autocommit=True)
+            cursor = connection.cursor()
+            cursor.execute(f'LISTEN "{self.channel}"')
+            raw = connection.connection
+            while not self.stopped.is_set():
+                if select.select([raw], [], [], 5) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    self.hub.dispatch(json.loads(raw.notifies.pop(0).payload))
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Stream(object):
+    '''Pushes new statuses to the connected followers of their author
+
+    Connections wait on their own bounded queue, nothing runs per connection
+    until a message or a heartbeat is due. Served by Flask every open stream
+    still holds a server thread, the ASGI entry point (app.asgi) serves
+    /statuses/stream on its event loop instead, so a process holds
+    thousands of idle streams without a thread each. STREAM_BROKER = 'postgres' relays messages between workers with
+    LISTEN/NOTIFY, 'local' only reaches clients of the publishing process.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STREAM_BROKER', 'local')
+        app.config.setdefault('STREAM_CHANNEL', 'chatbird_statuses')
+        app.config.setdefault('STREAM_QUEUE_SIZE', 100)
+        app.config.setdefault('STREAM_HEARTBEAT', 15)
+
+        hub = Hub()
+        if app.config['STREAM_BROKER'] == 'postgres':
+            broker = PostgresBroker(hub, app.config['STREAM_CHANNEL'])
+        else:
+            broker = LocalBroker(hub)
+        app.extensions['stream'] = {'hub': hub, 'broker': broker}
+
+    @property
+    def state(self):
+        return current_app.extensions['stream']
+
+    def publish(self, tweet):
+        '''Announce a committed status to the followers of its author'''
+        self.state['broker'].publish({'id': tweet.id, 'user_id': tweet.user_id})
+
+    def subscribe(self, user, notify=None):
+        '''Subscribe user to the authors they follow, notify is set before the first message can arrive'''
+        state = self.state
+        state['broker'].start(current_app._get_current_object())
+        followed_ids = [r[0] for r in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == user.id)]
+        subscription = Subscription(user.id, followed_ids, current_app.config['STREAM_QUEUE_SIZE'])
+        subscription.notify = notify
+        state['hub'].subscribe(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.state['hub'].unsubscribe(subscription)
+
+    def events(self, subscription, missed_ids=()):
+        '''SSE body for a subscription, it needs no app context while streaming'''
+        heartbeat = current_app.config['STREAM_HEARTBEAT']
+
+        def generate():
+            yield opening_events(missed_ids)
+            while True:
+                yield from format_messages(*subscription.get(heartbeat))
+        return generate()
+
+    def response(self, subscription, missed_ids=()):
+        '''SSE response for a subscription
+
+        Closing it unsubscribes, a generator that never started would not
+        run its finally when a client leaves before the first chunk.
+        '''
+        hub = self.state['hub']
+        response = current_app.response_class(
+            self.events(subscription, missed_ids), mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(lambda: hub.unsubscribe(subscription))
+        return response
+
+
+stream = Stream()
+
+
+def opening_events(missed_ids=()):
+    '''Start of a stream, the reconnect delay and the statuses missed since Last-Event-ID'''
+    return 'retry: 3000\n\n' + ''.join(format_event({'id': id}, 'status', id) for id in missed_ids)
+
+
+def format_messages(messages, overflowed):
+    if overflowed:
+        # messages were dropped, the client refetches with since_id
+        yield format_event({}, 'resync')
+    for message in messages:
+        yield format_event(message, 'status', message['id'])
+    if not messages and not overflowed:
+        yield ': keepalive\n\n'
+
+
+def format_event(data, event=None, id=None):
+    lines = []
+    if id is not None:
+        lines.append(f'id: {id}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
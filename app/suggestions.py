@@ -0,0 +1,109 @@
+import heapq
+import math
+import click
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func
+from app.models import db, User, Suggestion, SuggestionRun, followers
+
+
+def chunked(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_rows(user_ids, size):
+    '''Sparse rows of the follow matrix, {follower id: set of followed ids}'''
+    rows = defaultdict(set)
+    for chunk in chunked(user_ids, size):
+        for follower_id, followed_id in db.session.query(
+                followers.c.follower_id, followers.c.followed_id).filter(
+                followers.c.follower_id.in_(chunk)):
+            rows[follower_id].add(followed_id)
+    return rows
+
+
+def score_chunk(user_ids, limit, size):
+    '''Top friends of friends for a chunk of users, {user id: [(candidate id, score)]}
+
+    This is the chunk's rows of the sparse product A.A, where A is the follow
+    matrix. Every path u -> f -> c adds 1 / log(2 + out-degree of f) to c, so
+    accounts that follow everyone count for less.
+    '''
+    rows = load_rows(user_ids, size)
+    middle = load_rows({f for u in user_ids for f in rows.get(u, ())}, size)
+    weights = {f: 1.0 / math.log(2 + len(out)) for f, out in middle.items()}
+    scored = {}
+    for user_id in user_ids:
+        followed = rows.get(user_id, set())
+        scores = defaultdict(float)
+        for f in followed:
+            for candidate in middle.get(f, ()):
+                scores[candidate] += weights[f]
+        for known in followed | {user_id}:
+            scores.pop(known, None)
+        scored[user_id] = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+    return scored
+
+
+def changed_users(since, size):
+    '''Users whose friends of friends may have changed since the last run
+
+    That is everyone who followed or unfollowed since, and everyone who
+    follows one of them.
+    '''
+    changed = [r[0] for r in db.session.query(User.id).filter(User.graph_updated_at >= since)]
+    affected = set(changed)
+    for chunk in chunked(changed, size):
+        affected.update(r[0] for r in db.session.query(followers.c.follower_id).filter(
+            followers.c.followed_id.in_(chunk)))
+    return sorted(affected)
+
+
+def compute_suggestions(full=False):
+    '''Recompute the suggestions table, returns the number of users recomputed
+
+    Only users whose neighbourhood changed since the start of the last
+    finished run are recomputed unless full is set.
+    '''
+    config = current_app.config
+    size = config['SUGGESTIONS_CHUNK_SIZE']
+    started = datetime.utcnow()
+    since = None if full else db.session.query(func.max(SuggestionRun.started_at)).filter(
+        SuggestionRun.finished_at.isnot(None)).scalar()
+    if since is None:
+        user_ids = [r[0] for r in db.session.query(User.id).order_by(User.id)]
+    else:
+        user_ids = changed_users(since, size)
+
+    for chunk in chunked(user_ids, size):
+        scored = score_chunk(chunk, config['SUGGESTIONS_PER_USER'], size)
+        Suggestion.query.filter(Suggestion.user_id.in_(chunk)).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(Suggestion, [
+            {'user_id': u, 'suggested_id': c, 'score': score, 'computed_at': started}
+            for u, top in scored.items() for c, score in top])
+        db.session.commit()
+
+    db.session.add(SuggestionRun(started_at=started, finished_at=datetime.utcnow(), users=len(user_ids)))
+    db.session.commit()
+    return len(user_ids)
+
+
+def suggested_users(user, count):
+    '''Best precomputed suggestions for user, minus accounts followed since'''
+    followed = db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user.id)
+    return User.query.join(Suggestion, Suggestion.suggested_id == User.id).filter(
+        Suggestion.user_id == user.id, ~User.id.in_(followed)).order_by(
+        Suggestion.score.desc(), User.id).limit(count).all()
+
+
+@click.command('compute-suggestions')
+@with_appcontext
+@click.option('--full', is_flag=True, help='Recompute every user, not only changed ones.')
+def compute_suggestions_command(full):
+    '''Compute who to follow suggestions from the follower graph'''
+    click.echo(f'{compute_suggestions(full=full)} users recomputed')
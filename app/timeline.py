@@ -0,0 +1,284 @@
+import bisect
+import threading
+from flask import current_app
+from app.models import db, User, Tweet, followers, add_viewer_state
+from app.replicas import primary
+from app.ids import SEQUENCE_BITS
+
+
+class MemoryTimelineStore(object):
+    '''In-process timeline store, every list is kept sorted newest first'''
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self._timelines = {}
+        self._lock = threading.Lock()
+
+    def push(self, user_ids, tweet_id):
+        with self._lock:
+            for user_id in user_ids:
+                ids = self._timelines.get(user_id)
+                if ids is None:
+                    # never built, the next read rebuilds it from the database
+                    continue
+                # ids are stored negated so bisect keeps the newest first
+                position = bisect.bisect_left(ids, -tweet_id)
+                if position < len(ids) and ids[position] == -tweet_id:
+                    continue
+                ids.insert(position, -tweet_id)
+                del ids[self.max_length:]
+
+    def get(self, user_id, count, max_id=None):
+        with self._lock:
+            ids = self._timelines.get(user_id, [])
+            start = 0 if max_id is None else bisect.bisect_right(ids, -max_id)
+            return [-i for i in ids[start:start + count]]
+
+    def replace(self, user_id, tweet_ids):
+        ids = sorted(-i for i in set(tweet_ids))[:self.max_length]
+        with self._lock:
+            self._timelines[user_id] = ids
+
+    def exists(self, user_id):
+        with self._lock:
+            return user_id in self._timelines
+
+    def clear(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._timelines.clear()
+            else:
+                self._timelines.pop(user_id, None)
+
+
+class RedisTimelineStore(object):
+    '''Timeline store on a redis sorted set per user
+
+    Scores are doubles, which cannot tell snowflake ids apart. A tweet is
+    scored by its id without the sequence bits, which stays exact, and
+    members are zero padded ids so redis orders equal scores by id.
+    '''
+
+    def __init__(self, url, max_length, prefix='timeline:'):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.max_length = max_length
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f'{self.prefix}{user_id}'
+
+    @staticmethod
+    def score(tweet_id):
+        return tweet_id >> SEQUENCE_BITS
+
+    @staticmethod
+    def member(tweet_id):
+        return f'{tweet_id:020d}'
+
+    def push(self, user_ids, tweet_id):
+        user_ids = list(user_ids)
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.exists(self._key(user_id))
+        built = [u for u, e in zip(user_ids, pipe.execute()) if e]
+
+        # timelines that were never built are left for the next read to rebuild
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in built:
+            key = self._key(user_id)
+            pipe.zadd(key, {self.member(tweet_id): self.score(tweet_id)})
+            pipe.zremrangebyrank(key, 0, -self.max_length - 1)
+        pipe.execute()
+
+    def get(self, user_id, count, max_id=None):
+        key = self._key(user_id)
+        if max_id is None:
+            ids = self.redis.zrevrangebyscore(key, '+inf', 0, start=0, num=count)
+        else:
+            # ids sharing max_id's score come first, at most one sequence worth
+            score = self.score(max_id)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zrevrangebyscore(key, score, score)
+            pipe.zrevrangebyscore(key, f'({score}', 0, start=0, num=count)
+            tied, below = pipe.execute()
+            ids = [i for i in tied if int(i) < max_id] + below
+        return [int(i) for i in ids[:count]]
+
+    def replace(self, user_id, tweet_ids):
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        if tweet_ids:
+            pipe.zadd(key, {self.member(i): self.score(i) for i in tweet_ids})
+            pipe.zremrangebyrank(key, 0, -self.max_length - 1)
+        else:
+            # an empty marker member keeps "built but empty" apart from "missing", get skips its score
+            pipe.zadd(key, {'empty': -1})
+        pipe.execute()
+
+    def exists(self, user_id):
+        return self.redis.exists(self._key(user_id)) > 0
+
+    def clear(self, user_id=None):
+        if user_id is not None:
+            self.redis.delete(self._key(user_id))
+            return
+        keys = list(self.redis.scan_iter(f'{self.prefix}*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+class Timeline(object):
+    '''Materialized home timelines, filled by fan-out when a tweet is written
+
+    Authors with more than TIMELINE_FANOUT_LIMIT followers are not fanned
+    out, their tweets are merged into the timeline when it is read.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TIMELINE_STORE', 'memory')
+        app.config.setdefault('TIMELINE_MAX_LENGTH', 800)
+        app.config.setdefault('TIMELINE_FANOUT_LIMIT', 10000)
+        app.config.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+
+        max_length = app.config['TIMELINE_MAX_LENGTH']
+        if app.config['TIMELINE_STORE'] == 'redis':
+            store = RedisTimelineStore(app.config['REDIS_URL'], max_length)
+        else:
+            store = MemoryTimelineStore(max_length)
+        app.extensions['timeline'] = store
+
+        @app.cli.command('rebuild-timelines')
+        def rebuild_timelines():
+            '''Rebuild the home timeline of every user'''
+            for user in User.query.yield_per(500):
+                self.rebuild(user)
+
+    @property
+    def store(self):
+        return current_app.extensions['timeline']
+
+    def _follower_ids(self, user_id):
+        rows = db.session.query(followers.c.follower_id).filter(
+            followers.c.followed_id == user_id)
+        return [r[0] for r in rows]
+
+    def _followed_over_limit(self, user):
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        rows = db.session.query(User.id).join(
+            followers, followers.c.followed_id == User.id).filter(
+            followers.c.follower_id == user.id, User.followers_count > limit)
+        return [r[0] for r in rows]
+
+    def fan_out(self, tweet):
+        if tweet.user.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+            return
+        self.store.push(self._follower_ids(tweet.user_id), tweet.id)
+
+    def rebuild(self, user):
+        limit = current_app.config['TIMELINE_MAX_LENGTH']
+        # the list is kept and only fan-out adds to it, a lagging replica would lose tweets for good
+        with primary():
+            rows = user.get_followed_tweets().with_entities(
+                Tweet.id).order_by(None).order_by(Tweet.id.desc()).limit(limit).all()
+        self.store.replace(user.id, [r[0] for r in rows])
+
+    def get_tweet_ids(self, user, count=None, max_id=None, since_id=None):
+        if count is None:
+            count = current_app.config['TIMELINE_MAX_LENGTH']
+        if not self.store.exists(user.id):
+            self.rebuild(user)
+        ids = self.store.get(user.id, count, max_id=max_id)
+
+        over_limit = self._followed_over_limit(user)
+        if over_limit:
+            query = db.session.query(Tweet.id).filter(
+                Tweet.user_id.in_(over_limit))
+            if max_id is not None:
+                query = query.filter(Tweet.id < max_id)
+            if since_id is not None:
+                query = query.filter(Tweet.id > since_id)
+            rows = query.order_by(Tweet.id.desc()).limit(count)
+            ids = sorted(set(ids).union(r[0] for r in rows),
+                         reverse=True)[:count]
+        if since_id is not None:
+            ids = [i for i in ids if i > since_id]
+        return ids
+
+    def get_tweets(self, user, count=None, max_id=None, since_id=None):
+        return get_tweets_by_ids(self.get_tweet_ids(
+            user, count=count, max_id=max_id, since_id=since_id))
+
+
+def get_tweets_by_ids(ids):
+    if not ids:
+        return []
+    tweets = {t.id: t for t in Tweet.query.filter(Tweet.id.in_(ids))}
+    return [tweets[i] for i in ids if i in tweets]
+
+
+# what TweetSchema and UserSchema read, nothing else is fetched for a page
+TWEET_ROW_COLUMNS = (Tweet.id, Tweet.text, Tweet.timestamp, Tweet.user_id, Tweet.retweet_status_id,
+                     Tweet.in_reply_to_status_id, Tweet.reply_count, Tweet.retweet_count, Tweet.like_count)
+AUTHOR_ROW_COLUMNS = (User.id, User.email, User.username, User.followed_count, User.followers_count)
+
+
+class AuthorRow(object):
+    '''Author of a TweetRow, the UserSchema fields of a user'''
+    __slots__ = tuple(c.key for c in AUTHOR_ROW_COLUMNS)
+
+    def __init__(self, values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+
+class TweetRow(object):
+    '''Untracked tweet with what TweetSchema dumps, nested statuses linked in'''
+    __slots__ = tuple(c.key for c in TWEET_ROW_COLUMNS) + ('user', 'retweet_status', 'in_reply_to_status')
+
+    def __init__(self, values, user):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+        self.user = user
+        self.retweet_status = None
+        self.in_reply_to_status = None
+
+
+def load_tweet_rows(ids, viewer=None):
+    '''TweetRows of ids in order and the TweetSchema context for them
+
+    Each level of the page and the two levels of nested statuses
+    TweetSchema renders is one select of the needed tweet columns joined
+    to their authors', plus one for the viewer's likes, however big the
+    page. Nothing lands in the session's identity map.
+    '''
+    context = {'user': viewer}
+    loaded = {}
+    authors = {}
+    pending = set(ids)
+    width = len(TWEET_ROW_COLUMNS)
+    for _ in range(3):
+        if not pending:
+            break
+        for row in db.session.query(*TWEET_ROW_COLUMNS, *AUTHOR_ROW_COLUMNS).outerjoin(
+                User, User.id == Tweet.user_id).filter(Tweet.id.in_(pending)):
+            author = None
+            if row[width] is not None:
+                author = authors.get(row[width]) or authors.setdefault(row[width], AuthorRow(row[width:]))
+            loaded[row[0]] = TweetRow(row[:width], author)
+        pending = {i for t in loaded.values() for i in (t.retweet_status_id, t.in_reply_to_status_id)
+                   if i is not None and i not in loaded}
+    for t in loaded.values():
+        t.retweet_status = loaded.get(t.retweet_status_id)
+        t.in_reply_to_status = loaded.get(t.in_reply_to_status_id)
+    if loaded:
+        add_viewer_state(context, list(loaded.values()), viewer)
+    return [loaded[i] for i in ids if i in loaded], context
+
+
+timeline = Timeline()
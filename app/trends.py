@@ -0,0 +1,124 @@
+import re
+import time
+import click
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, exc, func, select, text, and_
+from app.models import db, User, Tweet, TweetHashtag, Mention, TrendBucket, Trend
+
+HASHTAG = re.compile(r'(?<![\w&])#(\w{1,64})')
+MENTION = re.compile(r'(?<![\w@])@(\w{1,64})')
+
+
+def extract_hashtags(text):
+    '''Normalized hashtags of text, in order of appearance'''
+    return list(dict.fromkeys(t.lower() for t in HASHTAG.findall(text or '')))
+
+
+def extract_mentions(text):
+    '''Lowercased mentioned usernames of text, they are matched like logins, ignoring case'''
+    return list(dict.fromkeys(n.lower() for n in MENTION.findall(text or '')))
+
+
+# upserts the postgresql dialect of this sqlalchemy version cannot build for the others
+UPSERT_BUCKET = {
+    'sqlite': 'INSERT INTO trend_bucket (tag, bucket, count) VALUES (:tag, :bucket, :count) '
+              'ON CONFLICT (tag, bucket) DO UPDATE SET count = trend_bucket.count + excluded.count',
+    'mysql': 'INSERT INTO trend_bucket (tag, bucket, count) VALUES (:tag, :bucket, :count) '
+             'ON DUPLICATE KEY UPDATE count = count + VALUES(count)',
+}
+
+
+def increment_buckets(connection, counts):
+    '''Add counts, {(tag, bucket): n}, to the trend buckets
+
+    One upsert, so tweets of the same tag and bucket racing each other
+    cannot both insert. SQLite before 3.24 has no upsert, there the insert
+    losing the race is retried as an update.
+    '''
+    buckets = TrendBucket.__table__
+    rows = [{'tag': tag, 'bucket': bucket, 'count': n} for (tag, bucket), n in counts.items()]
+    dialect = connection.dialect
+    if dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(buckets)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[buckets.c.tag, buckets.c.bucket],
+            set_={'count': buckets.c.count + statement.excluded.count}), rows)
+        return
+    if dialect.name in UPSERT_BUCKET and (
+            dialect.name != 'sqlite' or dialect.dbapi.sqlite_version_info >= (3, 24)):
+        connection.execute(text(UPSERT_BUCKET[dialect.name]), rows)
+        return
+    for row in rows:
+        while True:
+            updated = connection.execute(buckets.update().where(and_(
+                buckets.c.tag == row['tag'], buckets.c.bucket == row['bucket'])).values(
+                count=buckets.c.count + row['count']))
+            if updated.rowcount:
+                break
+            try:
+                connection.execute(buckets.insert(), row)
+                break
+            except exc.IntegrityError:
+                continue
+
+
+def index_entities(mapper, connection, target):
+    '''Store the hashtags and mentions of a new tweet and count its hashtags'''
+    tags = extract_hashtags(target.text)
+    names = extract_mentions(target.text)
+    if tags:
+        connection.execute(TweetHashtag.__table__.insert(), [
+            {'tweet_id': target.id, 'tag': tag} for tag in tags])
+        bucket = int(time.time() // current_app.config['TRENDS_BUCKET_SECONDS'])
+        increment_buckets(connection, {(tag, bucket): 1 for tag in tags})
+    if names:
+        users = User.__table__
+        mentioned = connection.execute(select([users.c.id]).where(func.lower(users.c.username).in_(names)))
+        rows = [{'tweet_id': target.id, 'user_id': r[0]} for r in mentioned]
+        if rows:
+            connection.execute(Mention.__table__.insert(), rows)
+
+
+event.listen(Tweet, 'after_insert', index_entities)
+
+
+def compute_trends(now=None):
+    '''Rebuild the trending snapshot from the trend buckets, returns it best first
+
+    Every bucket in the last TRENDS_WINDOW seconds adds its count decayed by
+    half every TRENDS_HALF_LIFE seconds of age. Older buckets are dropped.
+    '''
+    config = current_app.config
+    size = config['TRENDS_BUCKET_SECONDS']
+    now = time.time() if now is None else now
+    oldest = int((now - config['TRENDS_WINDOW']) // size)
+
+    scores = defaultdict(float)
+    counts = defaultdict(int)
+    for tag, bucket, count in db.session.query(
+            TrendBucket.tag, TrendBucket.bucket, TrendBucket.count).filter(TrendBucket.bucket >= oldest):
+        age = max(0.0, now - (bucket + 1) * size)
+        scores[tag] += count * 0.5 ** (age / config['TRENDS_HALF_LIFE'])
+        counts[tag] += count
+    top = sorted(scores, key=lambda tag: (-scores[tag], tag))[:config['TRENDS_SIZE']]
+
+    TrendBucket.query.filter(TrendBucket.bucket < oldest).delete(synchronize_session=False)
+    Trend.query.delete(synchronize_session=False)
+    computed_at = datetime.utcnow()
+    db.session.bulk_insert_mappings(Trend, [
+        {'tag': tag, 'score': scores[tag], 'count': counts[tag], 'computed_at': computed_at}
+        for tag in top])
+    db.session.commit()
+    return [(tag, scores[tag], counts[tag]) for tag in top]
+
+
+@click.command('compute-trends')
+@with_appcontext
+def compute_trends_command():
+    '''Rebuild the trending hashtags snapshot, run it every TRENDS_BUCKET_SECONDS'''
+    for tag, score, count in compute_trends():
+        click.echo(f'#{tag} {score:.2f} ({count})')
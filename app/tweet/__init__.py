@@ -1,14 +1,39 @@
 from datetime import datetime
-from flask import request, jsonify, Blueprint
+from flask import request, Blueprint, current_app
 from sqlalchemy import exc
-from app.models import db, User, TweetSchema, Tweet, Favorites
+from app.models import db, User, TweetSchema, Tweet, Favorites, Mention, Trend, get_tweet_context, \
+    get_thread, get_tweet_fingerprint
 from app.utils import generate_token, protected
+from app.timeline import timeline, get_tweets_by_ids, load_tweet_rows
+from app.pagination import paginate, get_page_size, encode_cursor, decode_cursor
+from app.cache import object_cache
+from app.export import ndjson_response
+from app.search import search
+from app.stream import stream
+from app.replicas import read_only
+from app.bulk import parse_ids, like_many, InvalidIds
+from app.likes import likes
+from app.serializers import jsonify
 
 status = Blueprint('status', __name__, url_prefix='/statuses')
 
 
-tweet_serializer = TweetSchema()
-tweets_serializer = TweetSchema(many=True)
+# ids grow with time, serial and snowflake alike
+tweet_order = [Tweet.id]
+
+
+def not_modified(etag):
+    '''Empty 304 when the client already holds the representation tagged etag'''
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
 
 
 @status.route('/', methods=['POST'])
@@ -17,6 +42,8 @@ def create_status(current_user):
     data = request.get_json()
     s = Tweet(text=data['text'], user=current_user)
     s.insert()
+    timeline.fan_out(s)
+    stream.publish(s)
     return jsonify({'data': 'success', 'error': None}), 201
 
 
@@ -30,6 +57,8 @@ def reply_status(current_user):
     reply = Tweet(text=data['text'], user=current_user, in_reply_to_status=s)
     reply.insert()
     db.session.commit()
+    timeline.fan_out(reply)
+    stream.publish(reply)
     return jsonify({'data': 'success', 'error': None}), 201
 
 
@@ -44,36 +73,133 @@ def share_a_status(current_user):
                     user=current_user, retweet_status=s)
     retweet.insert()
     db.session.commit()
+    timeline.fan_out(retweet)
+    stream.publish(retweet)
     return jsonify({'data': 'success', 'error': None}), 201
 
 
+@status.route('/search', methods=['GET'])
+@read_only
+def search_statuses():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'data': None, 'error': {'message': 'missing query'}}), 400
+    ids, next_cursor = search.search('status', q, get_page_size(), request.args.get('cursor'))
+    s = get_tweets_by_ids(ids)
+    statuses = TweetSchema(many=True, context=get_tweet_context(s)).dump(s)
+    return jsonify({'data': {'statuses': statuses}, 'next_cursor': next_cursor, 'error': None}), 200
+
+
 @status.route('/<int:status_id>', methods=['GET'])
+@read_only
 def get_a_status(status_id):
-    s = Tweet.query.filter_by(id=status_id).first()
-    if not s:
+    def build():
+        s = Tweet.query.filter_by(id=status_id).first()
+        if not s:
+            return None
+        # tagged like the home timeline, so the ASGI view can answer a poll without loading the status
+        etag = get_tweet_fingerprint([s.id])
+        status = TweetSchema(context=get_tweet_context([s])).dump(s)
+        return {'status': status, 'etag': etag}
+    cached = object_cache.get_or_build('status', status_id, build)
+    if not cached:
         return jsonify({'data': 'Resource not found', 'error': None}), 404
-    status = tweet_serializer.dump(s)
-    return jsonify({'data': {'status': status}, 'error': None}), 200
+    return not_modified(cached['etag']) or with_etag(
+        jsonify({'data': {'status': cached['status']}, 'error': None}), cached['etag'])
 
 
 @status.route('/<int:status_id>/replies', methods=['GET'])
+@read_only
 def get_replies_for_status(status_id):
     data = request.get_json()
     s = Tweet.query.filter_by(id=status_id).first()
     if not s:
         return jsonify({'data': 'Resource not found', 'error': None}), 404
-    r = Tweet.query.filter_by(in_reply_to_status=s).all()
-    replies = tweets_serializer.dump(r)
-    return jsonify({'data': {'replies': replies}, 'error': None}), 200
+    r, next_cursor = paginate(
+        Tweet.query.filter_by(in_reply_to_status=s), tweet_order)
+    replies = TweetSchema(many=True, context=get_tweet_context(r)).dump(r)
+    return jsonify({'data': {'replies': replies}, 'next_cursor': next_cursor, 'error': None}), 200
+
+
+@status.route('/<int:status_id>/thread', methods=['GET'])
+@read_only
+def get_status_thread(status_id):
+    config = current_app.config
+    depth = min(request.args.get('depth', config['THREAD_MAX_DEPTH'], type=int), config['THREAD_MAX_DEPTH'])
+    size = min(request.args.get('count', config['THREAD_MAX_SIZE'], type=int), config['THREAD_MAX_SIZE'])
+    rows = get_thread(status_id, max(depth, 0), max(size, 0))
+    if not any(d == 0 for _, d in rows):
+        return jsonify({'data': 'Resource not found', 'error': None}), 404
+
+    tweets = [t for t, _ in rows]
+    serialized = TweetSchema(many=True, context=get_tweet_context(tweets)).dump(tweets)
+    nodes = {}
+    ancestors = []
+    for (tweet, d), node in zip(rows, serialized):
+        if d < 0:
+            ancestors.append(node)
+            continue
+        node['replies'] = []
+        nodes[tweet.id] = node
+        if d > 0:
+            nodes[tweet.in_reply_to_status_id]['replies'].append(node)
+    return jsonify({'data': {'ancestors': ancestors, 'status': nodes[status_id]}, 'error': None}), 200
 
 
 @status.route('/home_timeline', methods=['GET'])
 @protected
+@read_only
 def get_followed_statuses(current_user):
-    s = current_user.get_followed_tweets()
-    tweets_serializer.context = {"user": current_user}
-    followed_tweets = tweets_serializer.dump(s)
-    return jsonify({'data': {'tweets': followed_tweets}, 'error': None}), 200
+    count = get_page_size()
+    cursor = request.args.get('cursor')
+    max_id = decode_cursor(cursor, [Tweet.id])[0] if cursor else None
+    since_id = request.args.get('since_id', type=int)
+    ids = timeline.get_tweet_ids(current_user, count + 1, max_id=max_id, since_id=since_id)
+    next_cursor = None
+    if len(ids) > count:
+        ids = ids[:count]
+        next_cursor = encode_cursor([ids[-1]])
+    # the fingerprint only reads ids and counters, a matching poll skips loading the page
+    etag = get_tweet_fingerprint(ids, current_user, extra=next_cursor)
+    response = not_modified(etag)
+    if response:
+        return response
+    s, context = load_tweet_rows(ids, current_user)
+    followed_tweets = TweetSchema(many=True, context=context).dump(s)
+    return with_etag(jsonify(
+        {'data': {'tweets': followed_tweets}, 'next_cursor': next_cursor, 'error': None}), etag)
+
+
+@status.route('/stream', methods=['GET'])
+@protected
+def stream_statuses(current_user):
+    subscription = stream.subscribe(current_user)
+    # a reconnecting client first gets what it missed while it was away
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    try:
+        missed = timeline.get_tweet_ids(current_user, since_id=last_id)[::-1] if last_id else []
+    except Exception:
+        stream.unsubscribe(subscription)
+        raise
+    return stream.response(subscription, missed)
+
+
+@status.route('/mentions_timeline', methods=['GET'])
+@protected
+@read_only
+def get_mentions(current_user):
+    m, next_cursor = paginate(Tweet.query.join(Mention, Mention.tweet_id == Tweet.id).filter(
+        Mention.user_id == current_user.id), [Tweet.id])
+    mentions = TweetSchema(many=True, context=get_tweet_context(m, current_user)).dump(m)
+    return jsonify({'data': {'tweets': mentions}, 'next_cursor': next_cursor, 'error': None}), 200
+
+
+@status.route('/trending', methods=['GET'])
+@read_only
+def get_trending():
+    trends = [{'tag': t.tag, 'score': t.score, 'count': t.count, 'computed_at': t.computed_at}
+              for t in Trend.query.order_by(Trend.score.desc(), Trend.tag).limit(get_page_size())]
+    return jsonify({'data': {'trends': trends}, 'error': None}), 200
 
 
 @status.route('/like/<int:status_id>', methods=['POST'])
@@ -82,17 +208,39 @@ def favorite_status(current_user, status_id):
     s = Tweet.query.filter_by(id=status_id).first()
     if not s:
         return jsonify({'data': 'Resource not found', 'error': None}), 404
+    if current_app.config['LIKE_WRITE_BEHIND']:
+        likes.like(current_user, s)
+        return jsonify({'data': "success", 'error': None}), 200
     current_user.like(s)
     db.session.commit()
     return jsonify({'data': "success", 'error': None}), 200
 
 
+@status.route('/like/batch', methods=['POST'])
+@protected
+def favorite_statuses(current_user):
+    try:
+        ids = parse_ids(request.get_json(silent=True), current_app.config['BULK_MAX_IDS'])
+    except InvalidIds as e:
+        return jsonify({'data': None, 'error': {'message': str(e)}}), 400
+    if current_app.config['LIKE_WRITE_BEHIND']:
+        # like_many would miss buffered states, a pending unlike would delete its row afterwards
+        results = likes.like_many(current_user, ids)
+    else:
+        results = like_many(current_user, ids)
+        db.session.commit()
+    return jsonify({'data': [{'id': i, 'result': results[i]} for i in ids], 'error': None}), 200
+
+
 @status.route('/unlike/<int:status_id>', methods=['POST'])
 @protected
 def unfavorite_status(current_user, status_id):
     s = Tweet.query.filter_by(id=status_id).first()
     if not s:
         return jsonify({'data': 'Resource not found', 'error': None}), 404
+    if current_app.config['LIKE_WRITE_BEHIND']:
+        likes.unlike(current_user, s)
+        return jsonify({'data': "success", 'error': None}), 200
     current_user.unlike(s)
     db.session.commit()
     return jsonify({'data': "success", 'error': None}), 200
@@ -100,18 +248,30 @@ def unfavorite_status(current_user, status_id):
 
 @status.route('/favorites', methods=['GET'])
 @protected
+@read_only
 def get_favorite_statuses(current_user):
-    f = Tweet.query.join(Favorites, Favorites.tweet_id == Tweet.id).filter(
-        Favorites.user_id == current_user.id).all()
-    tweets_serializer.context = {"user": current_user}
-    favorite_tweets = tweets_serializer.dump(f)
-    return jsonify({'data': {"statuses": favorite_tweets}, 'error': None}), 200
+    f, next_cursor = paginate(Tweet.query.join(Favorites, Favorites.tweet_id == Tweet.id).filter(
+        Favorites.user_id == current_user.id), tweet_order)
+    favorite_tweets = TweetSchema(many=True, context=get_tweet_context(f, current_user)).dump(f)
+    return jsonify({'data': {"statuses": favorite_tweets}, 'next_cursor': next_cursor, 'error': None}), 200
 
 
 @status.route('/', methods=['GET'])
 @protected
+@read_only
 def get_a_statuses(current_user):
-    u = Tweet.query.all()
-    tweets_serializer.context = {"user": current_user}
-    tweets = tweets_serializer.dump(u)
-    return jsonify({'data': {"statuses": tweets}, 'error': None}), 200
+    query = Tweet.query
+    since_id = request.args.get('since_id', type=int)
+    if since_id is not None:
+        query = query.filter(Tweet.id > since_id)
+    u, next_cursor = paginate(query, tweet_order)
+    tweets = TweetSchema(many=True, context=get_tweet_context(u, current_user)).dump(u)
+    return jsonify({'data': {"statuses": tweets}, 'next_cursor': next_cursor, 'error': None}), 200
+
+
+@status.route('/export', methods=['GET'])
+@protected
+@read_only
+def export_statuses(current_user):
+    return ndjson_response(Tweet.query.order_by(Tweet.id), lambda chunk: TweetSchema(
+        many=True, context=get_tweet_context(chunk, current_user)).dump(chunk))
@@ -1,8 +1,26 @@
+import asyncio
+import os
+import tempfile
 import unittest
 import json
 from app import create_app
-from app.models import User, db, Tweet
+from app.config import TestingConfig
+from app.models import User, db, Tweet, Favorites, TrendBucket, TweetSchema, get_tweet_context
+from app.counters import reconcile_counters
+from app.trends import compute_trends, increment_buckets
+from app.asgi import ASGIApp
+from app.likes import likes, LikeBuffer
+from app.ids import Snowflake, SEQUENCE_MASK
+from app.timeline import TweetRow, RedisTimelineStore, load_tweet_rows, get_tweets_by_ids
+from app.graph import graph
+from app.stream import Stream, stream
+from app.search import create_search_index
+from flask import g
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from marshmallow import Schema
 
 
 class TweetRouteTestCase(unittest.TestCase):
@@ -193,6 +211,1014 @@ class TweetRouteTestCase(unittest.TestCase):
         pass
 
 
+class FollowingTestCase(unittest.TestCase):
+    '''Base of the test cases between a reader following a writer'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app('app.config.TestingConfig')
+        cls.client = cls.app.test_client
+        cls.test_users = [{
+            'username': "reader",
+            'email': "reader@ymail.com",
+            'password': "password"
+        }, {
+            'username': "writer",
+            'email': "writer@ymail.com",
+            'password': "password"
+        }]
+        cls.tokens = []
+        with cls.app.app_context():
+            db.create_all()
+            for user in cls.test_users:
+                u = User(email=user['email'], password_hash=user['password'],
+                         username=user['username'], verified=True)
+                u.insert()
+        for user in cls.test_users:
+            rv = cls.client().post('/user/auth', data=json.dumps(user),
+                                   content_type='application/json')
+            cls.tokens.append(json.loads(rv.data)['data']['token'])
+        with cls.app.app_context():
+            writer = User.query.filter_by(
+                email=cls.test_users[1]['email']).first()
+            cls.writer_id = writer.id
+        cls.client().post('/user/friendships/create', data=json.dumps({'id': cls.writer_id}),
+                          content_type='application/json', headers={'x-access-token': cls.tokens[0]})
+
+    def post_status(self, text):
+        self.client().post(
+            '/statuses/', data=json.dumps({'text': text}),
+            content_type='application/json', headers={'x-access-token': self.tokens[1]})
+
+    def get_home_timeline(self):
+        rv = self.client().get(
+            '/statuses/home_timeline', headers={'x-access-token': self.tokens[0]})
+        return [t['text'] for t in json.loads(rv.data)['data']['tweets']]
+
+    def asgi_get(self, asgi_app, path, headers=None):
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+                 'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]}
+        messages = []
+        requests = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # the client stays connected until the response is sent
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+        asyncio.run(asgi_app(scope, receive, send))
+        body = b''.join(m.get('body', b'') for m in messages[1:])
+        return messages[0]['status'], dict(messages[0]['headers']), body
+
+    def count_queries(self, url):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = db.get_engine()
+            event.listen(engine, 'before_cursor_execute', count)
+            try:
+                rv = self.client().get(
+                    url, headers={'x-access-token': self.tokens[0]})
+            finally:
+                event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(rv.status_code, 200)
+        return statements
+
+    @classmethod
+    def tearDownClass(cls):
+        """teardown all initialized variables."""
+        with cls.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class TimelineTestCase(FollowingTestCase):
+    '''This class represents the materialized home timeline test case'''
+
+    def test_fan_out_pushes_new_status_to_followers(self):
+        '''Test a new status shows up first in the followers home timeline'''
+        self.post_status('first post')
+        self.assertEqual(self.get_home_timeline()[0], 'first post')
+        self.post_status('second post')
+        self.assertEqual(self.get_home_timeline()[:2],
+                         ['second post', 'first post'])
+
+    def test_large_accounts_are_merged_on_read(self):
+        '''Test statuses of accounts over the fan-out limit are merged on read'''
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        try:
+            self.post_status('not fanned out')
+            with self.app.app_context():
+                self.assertEqual(
+                    Tweet.query.filter_by(text='not fanned out').count(), 1)
+            self.assertEqual(self.get_home_timeline()[0], 'not fanned out')
+        finally:
+            self.app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+    def test_unfollow_rebuilds_home_timeline(self):
+        '''Test unfollowing removes the statuses of that user'''
+        self.post_status('before unfollow')
+        self.client().post('/user/friendships/delete', data=json.dumps({'id': self.writer_id}),
+                           content_type='application/json', headers={'x-access-token': self.tokens[0]})
+        self.assertEqual(self.get_home_timeline(), [])
+
+
+class PaginationTestCase(FollowingTestCase):
+    '''This class represents the cursor pagination test case'''
+
+    def test_statuses_are_paginated_with_cursor(self):
+        '''Test API can walk every status page by page with next_cursor'''
+        for i in range(5):
+            self.post_status(f'page post {i}')
+        seen = []
+        cursor = None
+        while True:
+            url = '/statuses/?count=2' + (f'&cursor={cursor}' if cursor else '')
+            rv = self.client().get(url, headers={'x-access-token': self.tokens[0]})
+            result_in_json = json.loads(rv.data)
+            self.assertEqual(rv.status_code, 200)
+            self.assertLessEqual(len(result_in_json['data']['statuses']), 2)
+            seen.extend(t['id'] for t in result_in_json['data']['statuses'])
+            cursor = result_in_json['next_cursor']
+            if not cursor:
+                break
+        with self.app.app_context():
+            self.assertEqual(len(seen), Tweet.query.count())
+        self.assertEqual(len(seen), len(set(seen)))
+
+        rv = self.client().get('/statuses/?cursor=nonsense',
+                               headers={'x-access-token': self.tokens[0]})
+        self.assertEqual(rv.status_code, 400)
+
+
+class SerializationTestCase(FollowingTestCase):
+    '''This class represents the batch loaded serialization test case'''
+
+    def test_serializing_a_page_runs_a_fixed_number_of_queries(self):
+        '''Test the queries for a status page do not grow with its size'''
+        # the replied status is left off both pages, so both load it nested
+        for i in range(7):
+            self.post_status(f'counted post {i}')
+        with self.app.app_context():
+            status = Tweet.query.first()
+        self.client().post(
+            '/statuses/reply', data=json.dumps({'id': status.id, 'text': 'counted reply'}),
+            content_type='application/json', headers={'x-access-token': self.tokens[1]})
+        self.client().post(
+            '/statuses/retweet', data=json.dumps({'id': status.id}),
+            content_type='application/json', headers={'x-access-token': self.tokens[1]})
+        self.client().post(
+            f'/statuses/like/{status.id}', headers={'x-access-token': self.tokens[0]})
+
+        # the first request also loads the cached user
+        self.count_queries('/statuses/?count=2')
+        self.assertEqual(len(self.count_queries('/statuses/?count=2')),
+                         len(self.count_queries('/statuses/?count=8')))
+
+
+class CountersTestCase(FollowingTestCase):
+    '''This class represents the stored counters test case'''
+
+    def test_counters_follow_writes_and_can_be_reconciled(self):
+        '''Test stored counters are kept up to date and drift is repaired'''
+        self.post_status('counter post')
+        with self.app.app_context():
+            status_id = Tweet.query.filter_by(text='counter post').first().id
+        self.client().post(
+            f'/statuses/like/{status_id}', headers={'x-access-token': self.tokens[0]})
+        self.client().post(
+            '/statuses/reply', data=json.dumps({'id': status_id, 'text': 'counter reply'}),
+            content_type='application/json', headers={'x-access-token': self.tokens[0]})
+        self.client().post(
+            '/statuses/retweet', data=json.dumps({'id': status_id}),
+            content_type='application/json', headers={'x-access-token': self.tokens[0]})
+
+        def get_status():
+            rv = self.client().get(f'/statuses/{status_id}')
+            return json.loads(rv.data)['data']['status']
+        status = get_status()
+        self.assertEqual(status['like_count'], 1)
+        self.assertEqual(status['reply_count'], 1)
+        self.assertEqual(status['retweet_count'], 1)
+        self.assertEqual(status['user']['followers_count'], 1)
+
+        with self.app.app_context():
+            self.assertEqual(sum(reconcile_counters().values()), 0)
+            Tweet.query.filter_by(id=status_id).update({'like_count': 7})
+            User.query.filter_by(id=self.writer_id).update({'followers_count': 0})
+            db.session.commit()
+            drifted = reconcile_counters(repair=False)
+            self.assertEqual(drifted['tweet.like_count'], 1)
+            self.assertEqual(drifted['user.followers_count'], 1)
+            reconcile_counters()
+        status = get_status()
+        self.assertEqual(status['like_count'], 1)
+        self.assertEqual(status['user']['followers_count'], 1)
+
+        self.client().post(
+            f'/statuses/unlike/{status_id}', headers={'x-access-token': self.tokens[0]})
+        self.assertEqual(get_status()['like_count'], 0)
+
+
+class ThreadTestCase(FollowingTestCase):
+    '''This class represents the conversation thread test case'''
+
+    def test_thread_returns_ancestors_and_reply_tree(self):
+        '''Test API returns a whole conversation around a status in one call'''
+        def reply(status_id, text):
+            self.client().post(
+                '/statuses/reply', data=json.dumps({'id': status_id, 'text': text}),
+                content_type='application/json', headers={'x-access-token': self.tokens[0]})
+            with self.app.app_context():
+                return Tweet.query.filter_by(text=text).first().id
+
+        self.post_status('thread root')
+        with self.app.app_context():
+            root_id = Tweet.query.filter_by(text='thread root').first().id
+        middle_id = reply(root_id, 'thread middle')
+        reply(middle_id, 'thread leaf one')
+        reply(middle_id, 'thread leaf two')
+
+        rv = self.client().get(f'/statuses/{middle_id}/thread')
+        self.assertEqual(rv.status_code, 200)
+        thread = json.loads(rv.data)['data']
+        self.assertEqual([t['text'] for t in thread['ancestors']], ['thread root'])
+        self.assertEqual(thread['status']['text'], 'thread middle')
+        self.assertEqual([t['text'] for t in thread['status']['replies']],
+                         ['thread leaf one', 'thread leaf two'])
+
+        rv = self.client().get(f'/statuses/{root_id}/thread?depth=1')
+        thread = json.loads(rv.data)['data']
+        self.assertEqual(thread['ancestors'], [])
+        self.assertEqual(thread['status']['replies'][0]['replies'], [])
+
+        rv = self.client().get(f'/statuses/{root_id}/thread?count=2')
+        thread = json.loads(rv.data)['data']
+        self.assertEqual(thread['status']['replies'][0]['text'], 'thread middle')
+        self.assertEqual([t['text'] for t in thread['status']['replies'][0]['replies']], ['thread leaf one'])
+        statement, = [s for s in self.count_queries(f'/statuses/{root_id}/thread?depth=3&count=2')
+                      if 'replies_1' in s]
+        self.assertEqual(statement.count('LIMIT'), 4)
+
+        rv = self.client().get('/statuses/999999/thread')
+        self.assertEqual(rv.status_code, 404)
+
+
+class StatusCacheTestCase(FollowingTestCase):
+    '''This class represents the cached status test case'''
+
+    def test_cached_status_is_invalidated_by_writes(self):
+        '''Test a single status is served from cache until it is written to'''
+        self.post_status('cached post')
+        with self.app.app_context():
+            status_id = Tweet.query.filter_by(text='cached post').first().id
+        self.count_queries(f'/statuses/{status_id}')
+        self.assertEqual(self.count_queries(f'/statuses/{status_id}'), [])
+
+        self.client().post(
+            f'/statuses/like/{status_id}', headers={'x-access-token': self.tokens[0]})
+        self.assertTrue(self.count_queries(f'/statuses/{status_id}'))
+        rv = self.client().get(f'/statuses/{status_id}')
+        self.assertEqual(json.loads(rv.data)['data']['status']['like_count'], 1)
+
+
+class ConditionalGetTestCase(FollowingTestCase):
+    '''This class represents the conditional GET test case'''
+
+    def test_conditional_get_and_since_id(self):
+        '''Test polling with If-None-Match returns 304 until the page changes'''
+        self.post_status('etag post')
+        headers = {'x-access-token': self.tokens[0]}
+        rv = self.client().get('/statuses/home_timeline', headers=headers)
+        etag = rv.headers['ETag']
+        head_id = json.loads(rv.data)['data']['tweets'][0]['id']
+        rv = self.client().get('/statuses/home_timeline', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+
+        rv = self.client().get(f'/statuses/{head_id}')
+        rv = self.client().get(f'/statuses/{head_id}', headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+        self.client().post(f'/statuses/like/{head_id}', headers=headers)
+        rv = self.client().get('/statuses/home_timeline', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+        self.post_status('newer post')
+        rv = self.client().get(f'/statuses/home_timeline?since_id={head_id}', headers=headers)
+        self.assertEqual([t['text'] for t in json.loads(rv.data)['data']['tweets']], ['newer post'])
+
+
+class SearchTestCase(FollowingTestCase):
+    '''This class represents the full text search test case'''
+
+    def test_search_indexes_can_be_added_to_existing_tables(self):
+        '''Test the search index command builds the after_create indexes without locking writes'''
+        statement = create_search_index(Tweet, Tweet.text, 'english', concurrently=True)
+        self.assertTrue(statement.startswith('CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tweet_text_search'))
+        result = self.app.test_cli_runner().invoke(args=['create-search-indexes', '--dry-run'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('nothing to create', result.output)
+
+    def test_search_ranks_and_paginates_matches(self):
+        '''Test statuses and users are found by text, new statuses included'''
+        rv = self.client().get('/statuses/search?q=orchard')
+        self.assertEqual(json.loads(rv.data)['data']['statuses'], [])
+        self.post_status('orchard apple')
+        self.post_status('orchard apple apple')
+        self.post_status('orchard banana')
+
+        found, cursor = [], None
+        while True:
+            rv = self.client().get('/statuses/search?q=Apple+orchard&count=1' + (f'&cursor={cursor}' if cursor else ''))
+            result = json.loads(rv.data)
+            found.extend(t['text'] for t in result['data']['statuses'])
+            cursor = result['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(found, ['orchard apple apple', 'orchard apple'])
+
+        rv = self.client().get('/user/search?q=writer')
+        self.assertEqual([u['id'] for u in json.loads(rv.data)['data']], [self.writer_id])
+        self.assertEqual(self.client().get('/user/search?q=').status_code, 400)
+
+
+class TrendsTestCase(FollowingTestCase):
+    '''This class represents the hashtag, mention and trends test case'''
+
+    def test_hashtags_and_mentions_are_indexed(self):
+        '''Test hashtags feed the trending snapshot and mentions the mentions timeline'''
+        self.post_status('hello @Reader #Harvest #harvest')
+        with self.app.app_context():
+            compute_trends()
+        rv = self.client().get('/statuses/trending')
+        trends = {t['tag']: t for t in json.loads(rv.data)['data']['trends']}
+        self.assertEqual(trends['harvest']['count'], 1)
+
+        rv = self.client().get(
+            '/statuses/mentions_timeline', headers={'x-access-token': self.tokens[0]})
+        self.assertEqual([t['text'] for t in json.loads(rv.data)['data']['tweets']],
+                         ['hello @Reader #Harvest #harvest'])
+
+    def test_trend_buckets_are_upserted(self):
+        '''Test a bucket row inserted by a racing tweet is added to, not inserted again'''
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                increment_buckets(connection, {('upserted', 1): 2})
+                increment_buckets(connection, {('upserted', 1): 3, ('upserted', 2): 1})
+            self.assertEqual(sorted((b.bucket, b.count) for b in TrendBucket.query.filter_by(tag='upserted')),
+                             [(1, 5), (2, 1)])
+            TrendBucket.query.filter_by(tag='upserted').delete()
+            db.session.commit()
+
+
+class StreamTestCase(FollowingTestCase):
+    '''This class represents the server-sent status stream test case'''
+
+    def test_asgi_stream_wakes_for_a_status_published_while_subscribing(self):
+        '''Test a status published right after subscribing is sent without waiting for a heartbeat'''
+        asgi_app = ASGIApp(self.app)
+        scope = {'type': 'http', 'method': 'GET', 'path': '/statuses/stream', 'query_string': b'',
+                 'headers': [(b'x-access-token', self.tokens[0].encode())]}
+        subscribe = Stream.subscribe
+
+        def subscribe_then_publish(stream, user, *args):
+            subscription = subscribe(stream, user, *args)
+            self.app.extensions['stream']['hub'].dispatch({'id': 424242, 'user_id': self.writer_id})
+            return subscription
+
+        async def run():
+            bodies = []
+            requests = [{'type': 'http.request', 'body': b''}]
+            disconnect = asyncio.Event()
+
+            async def receive():
+                if requests:
+                    return requests.pop()
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                bodies.append(message.get('body', b''))
+            task = asyncio.ensure_future(asgi_app(scope, receive, send))
+            try:
+                for _ in range(200):
+                    if any(b'id: 424242' in b for b in bodies):
+                        break
+                    await asyncio.sleep(0.01)
+            finally:
+                disconnect.set()
+                await task
+            return bodies
+        with patch.dict(self.app.config, STREAM_HEARTBEAT=30), \
+                patch.object(Stream, 'subscribe', subscribe_then_publish):
+            bodies = asyncio.run(run())
+        self.assertIn(b'id: 424242\nevent: status\n', b''.join(bodies))
+
+    def test_asgi_streams_statuses_on_the_event_loop(self):
+        '''Test the ASGI entry point serves the stream itself and unsubscribes on disconnect'''
+        asgi_app = ASGIApp(self.app)
+        hub = self.app.extensions['stream']['hub']
+        scope = {'type': 'http', 'method': 'GET', 'path': '/statuses/stream', 'query_string': b'',
+                 'headers': [(b'x-access-token', self.tokens[0].encode())]}
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            bodies = []
+            requests = [{'type': 'http.request', 'body': b''}]
+            disconnect = asyncio.Event()
+
+            async def receive():
+                if requests:
+                    return requests.pop()
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                bodies.append(message.get('body', b''))
+
+            async def until(condition):
+                for _ in range(500):
+                    if condition():
+                        return
+                    await asyncio.sleep(0.01)
+                self.fail(bodies)
+            task = asyncio.ensure_future(asgi_app(scope, receive, send))
+            await until(lambda: any(b'retry' in b for b in bodies))
+            # posting goes through the thread pool, the stream needs none while it waits
+            await loop.run_in_executor(None, self.post_status, 'asgi streamed post')
+            await until(lambda: any(b'event: status' in b for b in bodies))
+            disconnect.set()
+            await task
+            return bodies
+        bodies = asyncio.run(run())
+        with self.app.app_context():
+            status_id = Tweet.query.filter_by(text='asgi streamed post').first().id
+        self.assertIn(f'id: {status_id}\nevent: status\n'.encode(), b''.join(bodies))
+        self.assertFalse(any(s.user_id for subscriptions in hub.by_author.values() for s in subscriptions))
+
+    def test_stream_pushes_new_statuses_to_followers(self):
+        '''Test connected followers receive new statuses as server-sent events'''
+        self.app.config['STREAM_HEARTBEAT'] = 0.01
+        try:
+            rv = self.client().get('/statuses/stream', buffered=False,
+                                   headers={'x-access-token': self.tokens[0]})
+            self.assertEqual(rv.mimetype, 'text/event-stream')
+            events = iter(rv.response)
+            self.assertIn(b'retry', next(events))
+            self.assertEqual(next(events), b': keepalive\n\n')
+            self.post_status('streamed post')
+            with self.app.app_context():
+                status_id = Tweet.query.filter_by(text='streamed post').first().id
+            event = next(events).decode('utf-8')
+            self.assertIn(f'id: {status_id}\nevent: status\n', event)
+            rv.close()
+            hub = self.app.extensions['stream']['hub']
+            self.assertFalse(hub.by_author)
+
+            # a client leaving before the first chunk is unsubscribed too
+            with self.app.test_request_context():
+                response = stream.response(stream.subscribe(User.query.filter_by(
+                    email=self.test_users[0]['email']).first()))
+                self.assertTrue(hub.by_author)
+                response.close()
+            self.assertFalse(hub.by_author)
+        finally:
+            self.app.config['STREAM_HEARTBEAT'] = 15
+
+
+class ASGITestCase(FollowingTestCase):
+    '''This class represents the ASGI entry point test case'''
+
+    def test_asgi_entry_point_serves_the_same_payloads(self):
+        '''Test the async endpoints answer like the sync ones and the rest falls through'''
+        self.post_status('async post')
+        headers = {'x-access-token': self.tokens[0]}
+        with self.app.app_context():
+            status_id = Tweet.query.filter_by(text='async post').first().id
+        self.client().post(f'/statuses/like/{status_id}', headers=headers)
+        asgi_app = ASGIApp(self.app)
+        for path in ['/statuses/home_timeline', '/statuses/?count=1', f'/statuses/{status_id}',
+                     f'/user/{self.writer_id}', '/statuses/trending']:
+            rv = self.client().get(path, headers=headers)
+            status, response_headers, body = self.asgi_get(asgi_app, path, headers)
+            self.assertEqual(status, rv.status_code, path)
+            self.assertEqual(json.loads(body), json.loads(rv.data), path)
+            if 'ETag' in rv.headers:
+                self.assertEqual(response_headers[b'etag'].decode(), rv.headers['ETag'], path)
+
+        # a matching poll is answered from the fingerprint, the page is never loaded
+        with patch('app.asgi.load_tweets', side_effect=AssertionError('page loaded')):
+            for path in ['/statuses/home_timeline', f'/statuses/{status_id}']:
+                rv = self.client().get(path, headers=headers)
+                status, _, body = self.asgi_get(asgi_app, path, dict(
+                    headers, **{'If-None-Match': rv.headers['ETag']}))
+                self.assertEqual((status, body), (304, b''), path)
+        status, _, body = self.asgi_get(asgi_app, '/statuses/home_timeline')
+        self.assertEqual(json.loads(body)['error']['message'], 'token is missing')
+
+
+class BatchLikeTestCase(FollowingTestCase):
+    '''This class represents the batch like test case'''
+
+    def test_batch_like_applies_each_id_once(self):
+        '''Test liking a list of statuses in one request reports a result per id'''
+        self.post_status('batch like one')
+        self.post_status('batch like two')
+        with self.app.app_context():
+            ids = [t.id for t in Tweet.query.filter(Tweet.text.like('batch like %')).order_by(Tweet.id)]
+        headers = {'x-access-token': self.tokens[0]}
+        self.client().post(f'/statuses/like/{ids[0]}', headers=headers)
+        self.client().get(f'/statuses/{ids[1]}')
+
+        rv = self.client().post('/statuses/like/batch', data=json.dumps({'ids': [ids[0], ids[1], ids[1], 0]}),
+                                content_type='application/json', headers=headers)
+        self.assertEqual(json.loads(rv.data)['data'], [
+            {'id': ids[0], 'result': 'already_liked'}, {'id': ids[1], 'result': 'liked'},
+            {'id': 0, 'result': 'not_found'}])
+        rv = self.client().get(f'/statuses/{ids[1]}')
+        self.assertEqual(json.loads(rv.data)['data']['status']['like_count'], 1)
+        with self.app.app_context():
+            self.assertEqual(reconcile_counters(repair=False)['tweet.like_count'], 0)
+
+    def test_batch_like_skips_a_like_written_concurrently(self):
+        '''Test a like landing between the batch's read and its insert is not counted twice'''
+        self.post_status('batch like race')
+        with self.app.app_context():
+            status_id = Tweet.query.filter_by(text='batch like race').first().id
+            user_id = self.writer_id
+            engine = db.engine
+        favorites, tweets = Favorites.__table__, Tweet.__table__
+        raced = []
+
+        def like_concurrently(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT favorites.user_id') and not raced:
+                raced.append(statement)
+                with engine.begin() as other:
+                    other.execute(favorites.insert().values(user_id=user_id, tweet_id=status_id))
+                    other.execute(tweets.update().where(tweets.c.id == status_id).values(
+                        like_count=tweets.c.like_count + 1))
+        event.listen(engine, 'after_cursor_execute', like_concurrently)
+        try:
+            rv = self.client().post('/statuses/like/batch', data=json.dumps({'ids': [status_id]}),
+                                    content_type='application/json', headers={'x-access-token': self.tokens[1]})
+        finally:
+            event.remove(engine, 'after_cursor_execute', like_concurrently)
+        self.assertTrue(raced)
+        self.assertEqual(json.loads(rv.data)['data'], [{'id': status_id, 'result': 'already_liked'}])
+        with self.app.app_context():
+            self.assertEqual(Favorites.query.filter_by(tweet_id=status_id).count(), 1)
+            self.assertEqual(reconcile_counters(repair=False)['tweet.like_count'], 0)
+
+
+class FastSerializationTestCase(FollowingTestCase):
+    '''This class represents the fast serialization test case'''
+
+    def test_fast_serialization_matches_the_default_output(self):
+        '''Test compiled dumps and the fast encoder return the same bodies'''
+        self.post_status('fast post')
+        headers = {'x-access-token': self.tokens[0]}
+        with self.app.app_context():
+            status_id = Tweet.query.filter_by(text='fast post').first().id
+        self.client().post('/statuses/retweet', data=json.dumps({'id': status_id}),
+                           content_type='application/json', headers=headers)
+        self.client().post('/statuses/reply', data=json.dumps({'id': status_id, 'text': 'fast reply'}),
+                           content_type='application/json', headers=headers)
+        paths = ['/statuses/home_timeline', '/statuses/', f'/statuses/{status_id}/replies', '/user/']
+        default = [self.client().get(path, headers=headers).data for path in paths]
+        state = self.app.extensions['serialization']
+        state['fast'] = True
+        try:
+            fast = [self.client().get(path, headers=headers).data for path in paths]
+            with self.app.app_context():
+                tweets = Tweet.query.all()
+                context = get_tweet_context(tweets)
+                self.assertEqual(TweetSchema(many=True, context=context).dump(tweets),
+                                 Schema.dump(TweetSchema(many=True, context=context), tweets))
+        finally:
+            state['fast'] = False
+        for path, body, fast_body in zip(paths, default, fast):
+            self.assertEqual(fast_body, body, path)
+
+
+class ProjectedTimelineTestCase(FollowingTestCase):
+    '''This class represents the projected home timeline rows test case'''
+
+    def test_home_timeline_loads_untracked_rows_in_fixed_queries(self):
+        '''Test home timeline pages are projected rows dumped like the ORM tweets'''
+        for i in range(6):
+            self.post_status(f'projected post {i}')
+        with self.app.app_context():
+            status_id = Tweet.query.filter_by(text='projected post 0').first().id
+        writer = {'x-access-token': self.tokens[1]}
+        self.client().post('/statuses/reply', data=json.dumps({'id': status_id, 'text': 'projected reply'}),
+                           content_type='application/json', headers=writer)
+        self.client().post('/statuses/retweet', data=json.dumps({'id': status_id}),
+                           content_type='application/json', headers=writer)
+        # the first request also loads the cached user
+        self.count_queries('/statuses/home_timeline?count=2')
+        # the small page needs a query for the nested statuses the big one already holds
+        self.assertLessEqual(len(self.count_queries('/statuses/home_timeline?count=8')),
+                             len(self.count_queries('/statuses/home_timeline?count=2')))
+
+        with self.app.app_context():
+            viewer = User.query.filter_by(username='reader').first()
+            ids = [t.id for t in Tweet.query.order_by(Tweet.id.desc()).limit(8)]
+            db.session.expunge_all()
+            rows, context = load_tweet_rows(ids, viewer)
+            self.assertTrue(all(isinstance(r, TweetRow) for r in rows))
+            self.assertEqual(len(db.session.identity_map), 0)
+            self.assertEqual(rows[0].in_reply_to_status.id if rows[0].in_reply_to_status else
+                             rows[0].retweet_status.id, status_id)
+            tweets = get_tweets_by_ids(ids)
+            self.assertEqual(TweetSchema(many=True, context=context).dump(rows), TweetSchema(
+                many=True, context=get_tweet_context(tweets, viewer)).dump(tweets))
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    '''This class represents the test case for per request SQL instrumentation'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app('app.config.TestingConfig')
+        cls.client = cls.app.test_client
+        cls.user = {'username': "metrics", 'email': "metrics@ymail.com", 'password': "password"}
+        with cls.app.app_context():
+            db.create_all()
+            User(email=cls.user['email'], password_hash=cls.user['password'],
+                 username=cls.user['username'], verified=True).insert()
+        rv = cls.client().post('/user/auth', data=json.dumps(cls.user),
+                               content_type='application/json')
+        cls.token = json.loads(rv.data)['data']['token']
+
+    def test_failed_statements_are_not_left_timing(self):
+        '''Test a statement that raises does not leave its start time on the connection'''
+        with self.app.app_context():
+            connection = db.session.connection()
+            with self.assertRaises(Exception):
+                connection.execute('SELECT missing FROM nowhere')
+            self.assertEqual(connection.info['query_start'], [])
+            db.session.rollback()
+
+    def test_requests_report_sql_metrics(self):
+        '''Test SQL statements are counted per request and exported as metrics'''
+        self.client().post('/statuses/', data=json.dumps({'text': 'metrics post'}),
+                           content_type='application/json', headers={'x-access-token': self.token})
+        self.app.debug = True
+        try:
+            rv = self.client().get(
+                '/statuses/home_timeline', headers={'x-access-token': self.token})
+        finally:
+            self.app.debug = False
+        self.assertGreater(int(rv.headers['X-SQL-Queries']), 0)
+        self.assertIn('X-SQL-Time', rv.headers)
+
+        rv = self.client().get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        metrics = rv.data.decode('utf-8')
+        self.assertIn('chatbird_request_sql_queries_count{endpoint="status.get_followed_statuses"}', metrics)
+        self.assertIn('# TYPE chatbird_request_duration_seconds histogram', metrics)
+
+    @classmethod
+    def tearDownClass(cls):
+        """teardown all initialized variables."""
+        with cls.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class ReplicaConfig(TestingConfig):
+    SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')]
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    '''This class represents the test case for reads routed to an empty replica'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(ReplicaConfig)
+        cls.client = cls.app.test_client
+        cls.user = {'username': "replica", 'email': "replica@ymail.com", 'password': "password"}
+        with cls.app.app_context():
+            db.create_all()
+            db.Model.metadata.create_all(cls.app.extensions['replicas']['engines'][0])
+            u = User(email=cls.user['email'], password_hash=cls.user['password'],
+                     username=cls.user['username'], verified=True)
+            u.insert()
+            cls.user_id = u.id
+        rv = cls.client().post('/user/auth', data=json.dumps(cls.user),
+                               content_type='application/json')
+        cls.token = json.loads(rv.data)['data']['token']
+
+    def get_statuses(self):
+        rv = self.client().get('/statuses/', headers={'x-access-token': self.token})
+        return [t['text'] for t in json.loads(rv.data)['data']['statuses']]
+
+    def test_reads_go_to_the_replica_until_the_user_writes(self):
+        '''Test read only views use the replica except right after a write'''
+        self.assertEqual(self.get_statuses(), [])
+        self.client().post('/statuses/', data=json.dumps({'text': 'primary only'}),
+                           content_type='application/json', headers={'x-access-token': self.token})
+        self.assertEqual(self.get_statuses(), ['primary only'])
+
+        self.app.extensions['replicas']['sticky'].clear()
+        self.assertEqual(self.get_statuses(), [])
+        # cached payloads are always built from the primary
+        rv = self.client().get(f'/user/{self.user_id}')
+        self.assertEqual(json.loads(rv.data)['data']['username'], 'replica')
+
+    def test_follower_cache_is_loaded_from_the_primary(self):
+        '''Test the cached followers of a hot account are not read from a lagging replica'''
+        with self.app.app_context():
+            author = User(email='hot@ymail.com', password_hash='password', username='hot', verified=True)
+            author.insert()
+            User.query.get(self.user_id).follow(author)
+            db.session.commit()
+            author_id = author.id
+        with patch.dict(self.app.config, GRAPH_CACHE_MIN_FOLLOWERS=1), self.app.test_request_context():
+            author = User.query.get(author_id)
+            g.read_only = True
+            self.assertIn(self.user_id, graph.cached_followers(author))
+            g.read_only = False
+            User.query.get(self.user_id).unfollow(author)
+            db.session.delete(author)
+            db.session.commit()
+
+    def test_home_timeline_is_built_from_the_primary(self):
+        '''Test a timeline built during a read only request misses nothing the replica lags on'''
+        with self.app.app_context():
+            author = User(email='lagged@ymail.com', password_hash='password', username='lagged', verified=True)
+            author.insert()
+            tweet = Tweet(text='hello', user=author)
+            db.session.add(tweet)
+            User.query.get(self.user_id).follow(author)
+            db.session.commit()
+            tweet_id = tweet.id
+        self.app.extensions['replicas']['sticky'].clear()
+        self.app.extensions['timeline'].clear(self.user_id)
+        self.client().get('/statuses/home_timeline', headers={'x-access-token': self.token})
+        # the page itself comes from the empty replica, the stored list from the primary
+        self.assertEqual(self.app.extensions['timeline'].get(self.user_id, 10), [tweet_id])
+
+        with self.app.app_context():
+            author = User.query.filter_by(username='lagged').first()
+            User.query.get(self.user_id).unfollow(author)
+            Tweet.query.filter_by(id=tweet_id).delete()
+            db.session.delete(author)
+            db.session.commit()
+
+    def test_pool_options_come_from_the_config(self):
+        '''Test pool settings reach server engines but not sqlite'''
+        options = {}
+        db.apply_driver_hacks(self.app, make_url('postgresql://localhost/chatbird'), options)
+        self.assertEqual(options['pool_size'], self.app.config['DB_POOL_SIZE'])
+        self.assertTrue(options['pool_pre_ping'])
+        options = {}
+        db.apply_driver_hacks(self.app, make_url('sqlite:///replica.db'), options)
+        self.assertNotIn('pool_size', options)
+
+    @classmethod
+    def tearDownClass(cls):
+        """teardown all initialized variables."""
+        with cls.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class WriteBehindConfig(TestingConfig):
+    LIKE_WRITE_BEHIND = True
+    LIKE_BUFFER_SIZE = 5
+    LIKE_FLUSH_INTERVAL = 0.01
+
+
+class WriteBehindLikesTestCase(unittest.TestCase):
+    '''This class represents the test case for likes buffered before they are written'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(WriteBehindConfig)
+        cls.client = cls.app.test_client
+        cls.tokens = []
+        with cls.app.app_context():
+            db.create_all()
+            users = [User(email=f'liker{i}@ymail.com', password_hash='password', username=f'liker{i}',
+                          verified=True) for i in range(4)]
+            for u in users:
+                u.insert()
+            tweet = Tweet(text='toggled', user=users[0])
+            db.session.add(tweet)
+            db.session.commit()
+            cls.tweet_id = tweet.id
+            cls.user_ids = [u.id for u in users]
+        for i in range(4):
+            rv = cls.client().post('/user/auth', data=json.dumps({'email': f'liker{i}@ymail.com',
+                                                                   'password': 'password'}),
+                                   content_type='application/json')
+            cls.tokens.append(json.loads(rv.data)['data']['token'])
+
+    def test_batch_like_goes_through_the_buffer(self):
+        '''Test a batch like after a buffered unlike keeps the like'''
+        headers = {'x-access-token': self.tokens[2]}
+        with self.app.app_context():
+            tweet = Tweet(text='batched', user_id=self.user_ids[0])
+            db.session.add(tweet)
+            db.session.commit()
+            tweet_id = tweet.id
+            User.query.get(self.user_ids[2]).like(tweet)
+            db.session.commit()
+        self.client().post(f'/statuses/unlike/{tweet_id}', headers=headers)
+        rv = self.client().post('/statuses/like/batch', data=json.dumps({'ids': [tweet_id, tweet_id + 1000]}),
+                                content_type='application/json', headers=headers)
+        self.assertEqual(json.loads(rv.data)['data'], [{'id': tweet_id, 'result': 'liked'},
+                                                       {'id': tweet_id + 1000, 'result': 'not_found'}])
+        with self.app.app_context():
+            likes.flush()
+            self.assertEqual(Favorites.query.filter_by(user_id=self.user_ids[2], tweet_id=tweet_id).count(), 1)
+            self.assertEqual(Tweet.query.get(tweet_id).like_count, 1)
+
+    def test_buffer_coalesces_toggles_of_a_pair(self):
+        '''Test a like undone before it is written leaves nothing to write'''
+        buffer = LikeBuffer()
+        buffer.set((1, 2), True, False)
+        self.assertEqual((buffer.liked(1, [2]), buffer.counts([2])), ({2: True}, {2: 1}))
+        buffer.set((1, 2), False, None)
+        self.assertEqual((buffer.pending, buffer.counts([2])), ({}, {}))
+
+        buffer.set((1, 2), True, False)
+        batch = buffer.take()
+        # a toggle while the batch is written is relative to the batch
+        buffer.set((1, 2), False, None)
+        self.assertEqual((buffer.liked(1, [2]), buffer.counts([2])), ({2: False}, {}))
+        buffer.done(batch, True)
+        self.assertEqual((buffer.pending, buffer.counts([2])), ({(1, 2): (False, True)}, {2: -1}))
+
+    def test_flush_between_buffer_and_database_reads_keeps_the_toggle(self):
+        '''Test a flush landing while a page is read does not hide the caller's own unlike'''
+        headers = {'x-access-token': self.tokens[3]}
+        buffer = self.app.extensions['like_buffer']
+        # only the flush forced below may write the unlike
+        likes.stop(self.app)
+        self.addCleanup(setattr, buffer, 'worker', None)
+        self.addCleanup(buffer.stopped.clear)
+        with self.app.app_context():
+            tweet = Tweet(text='unliked during a flush', user_id=self.user_ids[0])
+            db.session.add(tweet)
+            db.session.commit()
+            tweet_id = tweet.id
+            User.query.get(self.user_ids[3]).like(tweet)
+            db.session.commit()
+        self.client().post(f'/statuses/unlike/{tweet_id}', headers=headers)
+
+        def read():
+            rv = self.client().get('/statuses/', headers=headers)
+            status = next(t for t in json.loads(rv.data)['data']['statuses'] if t['id'] == tweet_id)
+            return status['is_liked'], status['like_count']
+        snapshot = LikeBuffer.snapshot
+        flushed = []
+
+        def snapshot_then_flush(buffer, user_id=None):
+            taken = snapshot(buffer, user_id)
+            if not flushed:
+                # the flush writes the unlike after the buffer was read, before the database is
+                def flush():
+                    with self.app.app_context():
+                        flushed.append(likes.flush())
+                with ThreadPoolExecutor(1) as executor:
+                    executor.submit(flush).result()
+            return taken
+        with patch.object(LikeBuffer, 'snapshot', snapshot_then_flush):
+            self.assertEqual(read(), (False, 0))
+        self.assertTrue(flushed[0])
+        self.assertEqual(read(), (False, 0))
+        with self.app.app_context():
+            self.assertEqual(Favorites.query.filter_by(user_id=self.user_ids[3], tweet_id=tweet_id).count(), 0)
+
+    def test_status_read_during_a_flush_is_not_cached(self):
+        '''Test a status built while a flush lands does not keep counting the likes twice'''
+        with self.app.app_context():
+            tweet = Tweet(text='flushed', user_id=self.user_ids[0])
+            db.session.add(tweet)
+            db.session.commit()
+            tweet_id = tweet.id
+        self.client().post(f'/statuses/like/{tweet_id}', headers={'x-access-token': self.tokens[1]})
+
+        def like_count():
+            rv = self.client().get(f'/statuses/{tweet_id}')
+            return json.loads(rv.data)['data']['status']['like_count']
+        done = LikeBuffer.done
+
+        def read_then_done(buffer, batch, written):
+            # committed but still buffered, the read sees the like twice
+            with ThreadPoolExecutor(1) as executor:
+                self.assertEqual(executor.submit(like_count).result(), 2)
+            done(buffer, batch, written)
+        with patch.object(LikeBuffer, 'done', read_then_done), self.app.app_context():
+            likes.flush()
+        self.assertEqual(like_count(), 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        """teardown all initialized variables."""
+        with cls.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class SnowflakeConfig(TestingConfig):
+    TWEET_ID_GENERATOR = 'snowflake'
+
+
+class SnowflakeIdsTestCase(unittest.TestCase):
+    '''This class represents the test case for tweet ids generated in the process'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(SnowflakeConfig)
+        cls.client = cls.app.test_client
+        cls.user = {'username': "flake", 'email': "flake@ymail.com", 'password': "password"}
+        with cls.app.app_context():
+            db.create_all()
+            User(email=cls.user['email'], password_hash=cls.user['password'],
+                 username=cls.user['username'], verified=True).insert()
+        rv = cls.client().post('/user/auth', data=json.dumps(cls.user),
+                               content_type='application/json')
+        cls.token = json.loads(rv.data)['data']['token']
+
+    def test_generator_is_monotonic_across_clock_steps(self):
+        '''Test ids keep increasing when the sequence runs out or the clock goes back'''
+        now = [1700000000.0]
+        generator = Snowflake(worker_id=3, clock=lambda: now[0])
+        generated = [generator.next_id() for _ in range(SEQUENCE_MASK + 2)]
+        now[0] -= 5
+        generated += [generator.next_id() for _ in range(10)]
+        now[0] += 10
+        generated.append(generator.next_id())
+        self.assertTrue(all(a < b for a, b in zip(generated, generated[1:])))
+        self.assertEqual(generated[0] >> 12 & 1023, 3)
+        self.assertAlmostEqual(generator.timestamp(generated[-1]), now[0])
+        self.assertEqual(generator.first_id(now[0]) >> 22, generated[-1] >> 22)
+
+    def test_statuses_get_time_ordered_ids(self):
+        '''Test posted statuses get leased snowflake ids and page by id alone'''
+        headers = {'x-access-token': self.token}
+        texts = [f'flake {i}' for i in range(5)]
+        for text in texts:
+            self.client().post('/statuses/', data=json.dumps({'text': text}),
+                               content_type='application/json', headers=headers)
+        with self.app.app_context():
+            first = Tweet.query.filter_by(text=texts[0]).first().id
+        self.client().post('/statuses/reply', data=json.dumps({'id': first, 'text': 'flake reply'}),
+                           content_type='application/json', headers=headers)
+        with self.app.app_context():
+            ids = {t.text: t.id for t in Tweet.query}
+            self.assertEqual(Tweet.query.get(ids['flake reply']).in_reply_to_status_id, first)
+        posted = [ids[text] for text in texts + ['flake reply']]
+        self.assertTrue(all(a < b for a, b in zip(posted, posted[1:])))
+        self.assertGreater(posted[0], 2 ** 32)
+        self.assertEqual(self.app.extensions['ids']['generator'].worker_id, 0)
+
+        seen = []
+        cursor = None
+        while True:
+            url = '/statuses/?count=4' + (f'&cursor={cursor}' if cursor else '')
+            result_in_json = json.loads(self.client().get(url, headers=headers).data)
+            seen.extend(t['id'] for t in result_in_json['data']['statuses'])
+            cursor = result_in_json['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, posted[::-1])
+
+        result_in_json = json.loads(self.client().get(f'/statuses/{posted[-1]}', headers=headers).data)
+        self.assertEqual(result_in_json['data']['status']['id_str'], str(posted[-1]))
+        self.assertEqual(result_in_json['data']['status']['in_reply_to_status']['id_str'], str(first))
+
+    def test_timeline_scores_are_exact_for_snowflake_ids(self):
+        '''Test redis timeline scores survive the double and members order ties by id'''
+        generator = Snowflake(worker_id=5, clock=lambda: 1700000000.0)
+        generated = [generator.next_id() for _ in range(3)]
+        scores = [RedisTimelineStore.score(i) for i in generated]
+        self.assertTrue(all(float(s) == s for s in scores))
+        self.assertEqual(len(set(float(i) for i in generated)), 1)
+        self.assertEqual(len(set(scores)), 1)
+        members = [RedisTimelineStore.member(i) for i in generated + [7]]
+        self.assertEqual(sorted(members), [members[-1]] + members[:-1])
+
+    @classmethod
+    def tearDownClass(cls):
+        """teardown all initialized variables."""
+        with cls.app.app_context():
+            cls.app.extensions['ids']['lease'].release(db.engine)
+            db.session.remove()
+            db.drop_all()
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
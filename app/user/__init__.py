@@ -1,9 +1,19 @@
 from datetime import datetime
-from werkzeug.security import check_password_hash, generate_password_hash
-from flask import request, jsonify, Blueprint
+from flask import request, Blueprint, current_app
 from sqlalchemy import exc
 from app.models import db, User, UserSchema, Token
 from app.utils import generate_token, protected, send_mail, generate_code, decode_token
+from app.timeline import timeline
+from app.pagination import paginate, get_page_size
+from app.hashing import hasher
+from app.cache import object_cache
+from app.export import ndjson_response
+from app.graph import graph
+from app.suggestions import suggested_users
+from app.search import search
+from app.replicas import read_only
+from app.bulk import parse_ids, follow_many, InvalidIds
+from app.serializers import jsonify
 
 user = Blueprint('user', __name__, url_prefix='/user')
 
@@ -38,10 +48,13 @@ def authenticate_user():
     user = User.query.filter_by(email=data['email']).first()
     if not user:
         return jsonify({'error': {'message': 'Invalid Credentials'}, 'data': None}), 400
-    if not check_password_hash(user.password_hash, data['password']):
+    if not hasher.check(user.password_hash, data['password']):
         return jsonify({'error': {'message': 'Invalid Credentials'}, 'data': None}), 400
     if not user.verified:
         return jsonify({'error': {'message': 'please verify account'}}), 400
+    if hasher.needs_rehash(user.password_hash):
+        user.password_hash = hasher.hash(data['password'])
+        db.session.commit()
     token = generate_token({'id': user.id, 'username': user.username})
     return jsonify({'error': None, 'data': {'token': token}}), 200
 
@@ -85,18 +98,41 @@ def send_verification_code():
 
 @user.route('/')
 @user.route('/index', methods=['GET'])
+@read_only
 def get_all_users():
-    u = User.query.filter_by(verified=True).all()
+    u, next_cursor = paginate(
+        User.query.filter_by(verified=True), [User.id], descending=False)
     users = users_serializer.dump(u)
-    return jsonify({'error': None, 'data': users}), 200
+    return jsonify({'error': None, 'data': users, 'next_cursor': next_cursor}), 200
+
+
+@user.route('/export', methods=['GET'])
+@read_only
+def export_users():
+    return ndjson_response(User.query.filter_by(verified=True).order_by(User.id), users_serializer.dump)
+
+
+@user.route('/search', methods=['GET'])
+@read_only
+def search_users():
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': {'message': 'missing query'}, 'data': None}), 400
+    ids, next_cursor = search.search('user', q, get_page_size(), request.args.get('cursor'))
+    found = {u.id: u for u in User.query.filter(User.id.in_(ids), User.verified.is_(True))}
+    users = users_serializer.dump([found[i] for i in ids if i in found])
+    return jsonify({'error': None, 'data': users, 'next_cursor': next_cursor}), 200
 
 
 @user.route('/<int:user_id>', methods=['GET'])
+@read_only
 def get_a_user(user_id):
-    u = User.query.filter_by(verified=True, id=user_id).first()
-    if not u:
+    def build():
+        u = User.query.filter_by(verified=True, id=user_id).first()
+        return user_serializer.dump(u) if u else None
+    users = object_cache.get_or_build('user', user_id, build)
+    if not users:
         return jsonify({'error': {'message': 'Invalid User', }, 'data': None}), 404
-    users = user_serializer.dump(u)
     return jsonify({'error': None, 'data': users}), 200
 
 
@@ -122,7 +158,7 @@ def reset_pssword(token):
     u = User.query.filter_by(id=d_token['id']).first()
     if not u:
         return jsonify({'error': {'message': 'malformed token'}, 'data': None}), 401
-    u.password_hash = generate_password_hash(data['password'])
+    u.password_hash = hasher.hash(data['password'])
     db.session.commit()
     return jsonify({'error': None, 'data': "success"}), 200
 
@@ -136,9 +172,24 @@ def follow_user(current_user):
         return jsonify({'error': {'message': 'Invalid User', }, 'data': None}), 404
     current_user.follow(u)
     db.session.commit()
+    timeline.rebuild(current_user)
     return jsonify({'error': None, 'data': "success"}), 200
 
 
+@user.route('/friendships/create/batch', methods=['POST'])
+@protected
+def follow_users(current_user):
+    try:
+        ids = parse_ids(request.get_json(silent=True), current_app.config['BULK_MAX_IDS'])
+    except InvalidIds as e:
+        return jsonify({'error': {'message': str(e)}, 'data': None}), 400
+    results = follow_many(current_user, ids)
+    db.session.commit()
+    if 'following' in results.values():
+        timeline.rebuild(current_user)
+    return jsonify({'error': None, 'data': [{'id': i, 'result': results[i]} for i in ids]}), 200
+
+
 @user.route('/friendships/delete', methods=['POST'])
 @protected
 def unfollow_user(current_user):
@@ -148,9 +199,50 @@ def unfollow_user(current_user):
         return jsonify({'error': {'message': 'Invalid User', }, 'data': None}), 404
     current_user.unfollow(u)
     db.session.commit()
+    timeline.rebuild(current_user)
     return jsonify({'error': None, 'data': "success"}), 200
 
 
+@user.route('/friendships/lookup', methods=['GET'])
+@protected
+@read_only
+def lookup_friendships(current_user):
+    ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip().isdigit()]
+    targets = User.query.filter(User.id.in_(ids[:get_page_size()])).all()
+    following = graph.following(current_user, targets)
+    followed_by = graph.followed_by(current_user, [t.id for t in targets])
+    data = [{'id': t.id, 'following': following[t.id], 'followed_by': followed_by[t.id]}
+            for t in targets]
+    return jsonify({'error': None, 'data': data}), 200
+
+
+@user.route('/mutuals', methods=['GET'])
+@protected
+@read_only
+def get_mutuals(current_user):
+    u, next_cursor = paginate(graph.mutuals(current_user), [User.id], descending=False)
+    return jsonify({'error': None, 'data': users_serializer.dump(u), 'next_cursor': next_cursor}), 200
+
+
+@user.route('/suggestions', methods=['GET'])
+@protected
+@read_only
+def get_suggestions(current_user):
+    users = users_serializer.dump(suggested_users(current_user, get_page_size()))
+    return jsonify({'error': None, 'data': users}), 200
+
+
+@user.route('/<int:user_id>/followers_you_know', methods=['GET'])
+@protected
+@read_only
+def get_followers_you_know(current_user, user_id):
+    u = User.query.filter_by(id=user_id).first()
+    if not u:
+        return jsonify({'error': {'message': 'Invalid User', }, 'data': None}), 404
+    known, next_cursor = paginate(graph.followers_you_know(current_user, u), [User.id], descending=False)
+    return jsonify({'error': None, 'data': users_serializer.dump(known), 'next_cursor': next_cursor}), 200
+
+
 @user.route('/followers')
 def get_followers():
     u = User.query.all()[0].followers.all()
@@ -1,10 +1,17 @@
+import gzip
+import re
 import unittest
 import json
 from app import create_app
-from app.models import User, db, Token
+from app.models import User, db, Token, OutboundMail
+from app.mailer import mailer
 from unittest.mock import patch
+from sqlalchemy import event
 from app.utils import mail, generate_token
 from flask_mail import email_dispatched
+from werkzeug.security import generate_password_hash
+from app.hashing import hasher
+from app.suggestions import compute_suggestions
 
 
 class UserRouteTestCase(unittest.TestCase):
@@ -47,6 +54,34 @@ class UserRouteTestCase(unittest.TestCase):
             user = User.query.filter_by(email=new_user['email']).first()
             self.assertIsNotNone(user)
 
+    def test_api_queues_mail_and_worker_sends_it(self):
+        """Test API only queues mail and the queue worker delivers or retries it"""
+        new_user = {
+            'username': "queued",
+            'email': "queued@Email",
+            'password': "password"
+        }
+        rv = self.client().post('/user/create', data=json.dumps(new_user),
+                                content_type='application/json')
+        self.assertEqual(rv.status_code, 201)
+        with self.app.app_context():
+            queued = OutboundMail.query.filter_by(recipient=new_user['email']).first()
+            self.assertEqual(queued.status, 'pending')
+
+            with patch.object(mailer.transport, 'send_batch', side_effect=OSError('down')):
+                self.assertGreaterEqual(mailer.process_queue(), 1)
+            queued = OutboundMail.query.filter_by(recipient=new_user['email']).first()
+            self.assertEqual(queued.status, 'pending')
+            self.assertEqual(queued.attempts, 1)
+            self.assertEqual(mailer.process_queue(), 0)
+
+            queued.next_attempt_at = queued.created_at
+            db.session.commit()
+            self.assertEqual(mailer.process_queue(), 1)
+            queued = OutboundMail.query.filter_by(recipient=new_user['email']).first()
+            self.assertEqual(queued.status, 'sent')
+            self.assertIn(new_user['email'], mailer.transport.outbox[-1].recipients)
+
     def test_api_can_verify_user(self):
         """Test API can verify a new User"""
         new_user = {
@@ -101,6 +136,30 @@ class UserRouteTestCase(unittest.TestCase):
             self.assertIn(self.test_users[0]['email'], str(
                 result_in_json['data']))
 
+    def test_api_can_paginate_users(self):
+        """Test API can return Users one page at a time"""
+        rv = self.client().get('/user/index?count=1')
+        result_in_json = json.loads(rv.data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(result_in_json['data']), 1)
+        self.assertIsNotNone(result_in_json['next_cursor'])
+        rv = self.client().get(
+            f"/user/index?count=1&cursor={result_in_json['next_cursor']}")
+        page = json.loads(rv.data)['data']
+        self.assertGreater(page[0]['id'], result_in_json['data'][0]['id'])
+
+    def test_api_can_export_users_as_ndjson(self):
+        """Test API can stream all Users as NDJSON, optionally gzipped"""
+        rv = self.client().get('/user/export')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        lines = rv.data.decode('utf-8').splitlines()
+        self.assertIn(self.test_users[0]['email'], [json.loads(l)['email'] for l in lines])
+
+        rv = self.client().get('/user/export', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(rv.data).decode('utf-8').splitlines(), lines)
+
     def test_api_can_reset_user_password(self):
         """Test API can return  reset_ Users"""
         rv1 = self.client().post('/user/forgot_password', data=json.dumps({'email': self.test_users[0]['email']}),
@@ -115,6 +174,38 @@ class UserRouteTestCase(unittest.TestCase):
                                     content_type='application/json')
             self.assertEqual(rv.status_code, 200)
 
+    def test_api_can_batch_create_friendships(self):
+        """Test API can follow a list of users in one request with per id results"""
+        with self.app.app_context():
+            targets = [User(email=f'bulk{i}@Email', password_hash='password', username=f'bulk{i}', verified=True)
+                       for i in range(2)]
+            for u in targets:
+                u.insert()
+            ids = [u.id for u in targets]
+        rv = self.client().post('/user/auth', data=json.dumps(self.test_users[0]),
+                                content_type='application/json')
+        headers = {'x-access-token': json.loads(rv.data)['data']['token']}
+
+        rv = self.client().post('/user/friendships/create/batch', data=json.dumps({'ids': ids + [ids[0], 999999]}),
+                                content_type='application/json', headers=headers)
+        self.assertEqual(json.loads(rv.data)['data'], [
+            {'id': ids[0], 'result': 'following'}, {'id': ids[1], 'result': 'following'},
+            {'id': 999999, 'result': 'not_found'}])
+        rv = self.client().post('/user/friendships/create/batch', data=json.dumps({'ids': ids[:1]}),
+                                content_type='application/json', headers=headers)
+        self.assertEqual(json.loads(rv.data)['data'], [{'id': ids[0], 'result': 'already_following'}])
+        rv = self.client().post('/user/friendships/create/batch', data=json.dumps({'ids': 'all'}),
+                                content_type='application/json', headers=headers)
+        self.assertEqual(rv.status_code, 400)
+
+        with self.app.app_context():
+            self.assertEqual([User.query.get(i).followers_count for i in ids], [1, 1])
+            user = User.query.filter_by(email=self.test_users[0]['email']).first()
+            self.assertEqual(user.followed_count, user.followed.count())
+            for u in User.query.filter(User.id.in_(ids)):
+                user.unfollow(u)
+            db.session.commit()
+
     def test_api_can_create_friendships(self):
         """Test API can return  reset_ Users"""
         with self.app.app_context():
@@ -157,6 +248,30 @@ class UserRouteTestCase(unittest.TestCase):
                 email=self.test_users[0]['email']).first()
             self.assertFalse(user.is_following(u))
 
+    def test_api_rehashes_outdated_password_on_login(self):
+        """Test API upgrades a password hash with outdated parameters on login"""
+        old_user = {
+            'username': "oldhash",
+            'email': "oldhash@Email",
+            'password': "password"
+        }
+        with self.app.app_context():
+            u = User(email=old_user['email'], password_hash=old_user['password'],
+                     username=old_user['username'], verified=True)
+            u.insert()
+            u.password_hash = generate_password_hash(
+                old_user['password'], 'pbkdf2:sha256:1000', 8)
+            db.session.commit()
+            self.assertTrue(hasher.needs_rehash(u.password_hash))
+
+        rv = self.client().post('/user/auth', data=json.dumps(old_user),
+                                content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        with self.app.app_context():
+            u = User.query.filter_by(email=old_user['email']).first()
+            self.assertFalse(hasher.needs_rehash(u.password_hash))
+            self.assertTrue(hasher.check(u.password_hash, old_user['password']))
+
     @classmethod
     def tearDownClass(cls):
         """teardown all initialized variables."""
@@ -169,6 +284,137 @@ class UserRouteTestCase(unittest.TestCase):
         pass
 
 
+class FollowingTestCase(unittest.TestCase):
+    """Base of the test cases between a reader following a writer"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app('app.config.TestingConfig')
+        cls.client = cls.app.test_client
+        cls.test_users = [{
+            'username': "reader",
+            'email': "reader@ymail.com",
+            'password': "password"
+        }, {
+            'username': "writer",
+            'email': "writer@ymail.com",
+            'password': "password"
+        }]
+        cls.tokens = []
+        with cls.app.app_context():
+            db.create_all()
+            for user in cls.test_users:
+                User(email=user['email'], password_hash=user['password'],
+                     username=user['username'], verified=True).insert()
+        for user in cls.test_users:
+            rv = cls.client().post('/user/auth', data=json.dumps(user),
+                                   content_type='application/json')
+            cls.tokens.append(json.loads(rv.data)['data']['token'])
+        with cls.app.app_context():
+            cls.writer_id = User.query.filter_by(email=cls.test_users[1]['email']).first().id
+        cls.client().post('/user/friendships/create', data=json.dumps({'id': cls.writer_id}),
+                          content_type='application/json', headers={'x-access-token': cls.tokens[0]})
+
+    @classmethod
+    def tearDownClass(cls):
+        """teardown all initialized variables."""
+        with cls.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+class GraphTestCase(FollowingTestCase):
+    """This class represents the social graph test case"""
+
+    def test_graph_lookups_with_and_without_adjacency_cache(self):
+        """Test batch follow lookups, mutuals and followers you know"""
+        with self.app.app_context():
+            reader_id = User.query.filter_by(email=self.test_users[0]['email']).first().id
+        reader, writer = ({'x-access-token': t} for t in self.tokens)
+        self.client().post('/user/friendships/create', data=json.dumps({'id': reader_id}),
+                           content_type='application/json', headers=writer)
+        try:
+            for min_followers in (1000, 0):
+                self.app.config['GRAPH_CACHE_MIN_FOLLOWERS'] = min_followers
+                rv = self.client().get(f'/user/friendships/lookup?ids={self.writer_id},{reader_id}',
+                                       headers=reader)
+                lookup = {u['id']: u for u in json.loads(rv.data)['data']}
+                self.assertTrue(lookup[self.writer_id]['following'])
+                self.assertTrue(lookup[self.writer_id]['followed_by'])
+                self.assertFalse(lookup[reader_id]['following'])
+
+                rv = self.client().get('/user/mutuals', headers=reader)
+                self.assertEqual([u['id'] for u in json.loads(rv.data)['data']], [self.writer_id])
+                rv = self.client().get(f'/user/{reader_id}/followers_you_know', headers=reader)
+                self.assertEqual([u['id'] for u in json.loads(rv.data)['data']], [self.writer_id])
+
+            self.client().post('/user/friendships/delete', data=json.dumps({'id': reader_id}),
+                               content_type='application/json', headers=writer)
+            rv = self.client().get(f'/user/friendships/lookup?ids={self.writer_id}', headers=reader)
+            self.assertFalse(json.loads(rv.data)['data'][0]['followed_by'])
+        finally:
+            self.app.config['GRAPH_CACHE_MIN_FOLLOWERS'] = 1000
+
+
+class AuthCacheTestCase(FollowingTestCase):
+    """This class represents the test case for the users cached by protected"""
+
+    def count_queries(self, url):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            engine = db.get_engine()
+            event.listen(engine, 'before_cursor_execute', count)
+            try:
+                rv = self.client().get(
+                    url, headers={'x-access-token': self.tokens[0]})
+            finally:
+                event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(rv.status_code, 200)
+        return statements
+
+    def test_protected_routes_reuse_the_cached_user(self):
+        """Test a verified user is not loaded again on every protected request"""
+        self.count_queries('/statuses/favorites')
+        statements = self.count_queries('/statuses/favorites')
+        self.assertFalse([q for q in statements if re.search(r'user"?\.id = ', q)])
+
+        with self.app.app_context():
+            user = User.query.filter_by(email=self.test_users[0]['email']).first()
+            user.avatar = 'new avatar'
+            db.session.commit()
+        statements = self.count_queries('/statuses/favorites')
+        self.assertTrue([q for q in statements if re.search(r'user"?\.id = ', q)])
+
+
+class SuggestionsTestCase(FollowingTestCase):
+    """This class represents the who to follow suggestions test case"""
+
+    def test_suggestions_are_computed_offline_and_incrementally(self):
+        """Test friends of friends are suggested and only changed users are recomputed"""
+        with self.app.app_context():
+            u = User(email='suggested@ymail.com', password_hash='password',
+                     username='suggested', verified=True)
+            u.insert()
+            suggested_id = u.id
+            User.query.get(self.writer_id).follow(u)
+            db.session.commit()
+            compute_suggestions(full=True)
+            self.assertEqual(compute_suggestions(), 0)
+        headers = {'x-access-token': self.tokens[0]}
+        rv = self.client().get('/user/suggestions', headers=headers)
+        self.assertEqual([u['id'] for u in json.loads(rv.data)['data']], [suggested_id])
+
+        self.client().post('/user/friendships/create', data=json.dumps({'id': suggested_id}),
+                           content_type='application/json', headers=headers)
+        rv = self.client().get('/user/suggestions', headers=headers)
+        self.assertEqual(json.loads(rv.data)['data'], [])
+        with self.app.app_context():
+            self.assertEqual(compute_suggestions(), 1)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,14 @@
 import jwt
+import time
 from functools import wraps
-from flask import jsonify, request, render_template, current_app
+from flask import jsonify, request, render_template, current_app, has_app_context, g
 from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
 from app.models import User, db
-from flask_mail import Message, Mail
-from concurrent.futures import ThreadPoolExecutor
+from app.cache import TTLCache
+from app.mailer import mailer
+from flask_mail import Mail
 import random
 import math
 
@@ -12,6 +16,75 @@ mail = Mail()
 SECRET = "myownsecret"
 
 
+class AuthCache(object):
+    '''Caches verified users and decoded tokens so protected routes skip the database
+
+    Users are cached as their column values and merged back into the
+    session without a query, any flushed change to a user drops its entry.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('AUTH_CACHE_SIZE', 1024)
+        app.config.setdefault('AUTH_CACHE_TTL', 60)
+        app.config.setdefault('TOKEN_CACHE_SIZE', 4096)
+        app.extensions['auth_cache'] = {
+            'users': TTLCache(app.config['AUTH_CACHE_SIZE'], app.config['AUTH_CACHE_TTL']),
+            'tokens': TTLCache(app.config['TOKEN_CACHE_SIZE'], app.config['AUTH_CACHE_TTL']),
+        }
+
+    @property
+    def users(self):
+        return current_app.extensions['auth_cache']['users']
+
+    @property
+    def tokens(self):
+        return current_app.extensions['auth_cache']['tokens']
+
+    def decode_token(self, token):
+        data = self.tokens.get(token)
+        if data is not None:
+            return data
+        try:
+            payload = jwt.decode(token, SECRET, algorithms='HS256')
+        except jwt.ExpiredSignatureError:
+            return 'Signature expired'
+        except jwt.InvalidTokenError:
+            return 'Invalid token'
+        self.tokens.set(token, payload['sub'], ttl=payload['exp'] - time.time())
+        return payload['sub']
+
+    def get_user(self, user_id):
+        values = self.users.get(user_id)
+        if values is None:
+            user = User.query.filter_by(id=user_id).first()
+            if user and user.verified:
+                self.users.set(user_id, {c.key: getattr(user, c.key)
+                                         for c in User.__table__.columns})
+            return user
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, user_id):
+        self.users.delete(user_id)
+
+
+auth_cache = AuthCache()
+
+
+def invalidate_cached_user(mapper, connection, target):
+    if has_app_context() and 'auth_cache' in current_app.extensions:
+        auth_cache.invalidate(target.id)
+
+
+event.listen(User, 'after_update', invalidate_cached_user)
+event.listen(User, 'after_delete', invalidate_cached_user)
+
+
 def protected(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -22,17 +95,18 @@ def protected(f):
         if not token:
             return jsonify({'error': {'message': 'token is missing', 'code': 401}, 'data': None})
 
-        data = decode_token(token)
+        data = auth_cache.decode_token(token)
 
         if data == 'Invalid token' or data == 'Signature expired':
             return jsonify({'error': {'message': 'malformed token', 'code': 401}, 'data': None})
 
-        current_user = User.query.filter_by(id=data['id']).first()
+        current_user = auth_cache.get_user(data['id'])
         if not current_user:
             return jsonify({'error': {'message': 'malformed token', 'code': 401}, 'data': None})
         if not current_user.verified:
             return jsonify({'error': {'message': 'please verify account', 'code': 400}, 'data': None})
 
+        g.user_id = current_user.id
         return f(current_user, *args, **kwargs)
 
     return decorated_function
@@ -74,16 +148,6 @@ def generate_code():
     return random_str
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-    # print('sent')
-
-
 def send_mail(subject, recipient, template, **kwargs):
-    app = current_app._get_current_object()
-    msg = Message(
-        subject, sender='igwedanielchi@gmail.com', recipients=[recipient])
-    msg.html = render_template(template, **kwargs)
-    with ThreadPoolExecutor(3) as executor:
-        executor.submit(lambda arg: send_async_email(*arg), [app, msg])
+    html = render_template(template, **kwargs)
+    mailer.enqueue(subject, recipient, html, sender='igwedanielchi@gmail.com')
@@ -0,0 +1,2 @@
+from app.asgi import create_asgi_app
+app = create_asgi_app('app.config.DevelopmentConfig')
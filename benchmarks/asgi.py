@@ -0,0 +1,133 @@
+'''Compare the WSGI app and the ASGI entry point on the hot read endpoints
+
+Both run in process against the same seeded database, the WSGI app from
+a thread pool through the Flask test client and the ASGI app from one
+event loop with at most --concurrency requests in flight. Reports
+p50/p95/p99 latency and throughput per endpoint and mode.
+
+    python -m benchmarks.asgi --users 500 --requests 2000 --concurrency 64
+'''
+import argparse
+import asyncio
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from app import create_app
+from app.asgi import ASGIApp
+from app.models import db, Tweet
+from app.utils import generate_token
+from benchmarks.loadtest import percentile
+from benchmarks.seed import seed_graph
+
+ENDPOINTS = ['home_timeline', 'statuses', 'status', 'user']
+
+
+def make_plan(rng, user_ids, tweet_ids, tokens, requests):
+    plan = []
+    for _ in range(requests):
+        endpoint = rng.choice(ENDPOINTS)
+        index = rng.randrange(len(user_ids))
+        path = {
+            'home_timeline': '/statuses/home_timeline',
+            'statuses': '/statuses/',
+            'status': f'/statuses/{rng.choice(tweet_ids)}',
+            'user': f'/user/{user_ids[index]}',
+        }[endpoint]
+        plan.append((endpoint, path, tokens[index]))
+    return plan
+
+
+def run_wsgi(app, plan, concurrency):
+    def call(item):
+        endpoint, path, token = item
+        start = time.perf_counter()
+        rv = app.test_client().get(path, headers={'x-access-token': token})
+        return endpoint, time.perf_counter() - start, rv.status_code < 400
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(call, plan))
+    return results, time.perf_counter() - start
+
+
+async def asgi_get(asgi_app, path, token):
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'headers': [(b'x-access-token', token.encode())]}
+    received = []
+    status = []
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {'type': 'http.request', 'body': b''}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+    await asgi_app(scope, receive, send)
+    return status[0]
+
+
+async def run_asgi(asgi_app, plan, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(item):
+        endpoint, path, token = item
+        async with semaphore:
+            start = time.perf_counter()
+            status = await asgi_get(asgi_app, path, token)
+            return endpoint, time.perf_counter() - start, status < 400
+
+    await asgi_app.startup()
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(call(item) for item in plan))
+        return results, time.perf_counter() - start
+    finally:
+        await asgi_app.shutdown()
+
+
+def report(mode, results, wall):
+    by_endpoint = defaultdict(list)
+    errors = defaultdict(int)
+    for endpoint, elapsed, ok in results:
+        by_endpoint[endpoint].append(elapsed)
+        errors[endpoint] += not ok
+    for endpoint, latencies in sorted(by_endpoint.items()):
+        print(f'{mode:>5} {endpoint:>14}  requests={len(latencies)}  errors={errors[endpoint]}  '
+              f'p50_ms={percentile(latencies, 50) * 1000:.2f}  p95_ms={percentile(latencies, 95) * 1000:.2f}  '
+              f'p99_ms={percentile(latencies, 99) * 1000:.2f}')
+    print(f'{mode:>5} {"total":>14}  requests={len(results)}  throughput_rps={len(results) / wall:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='app.config.BenchmarkConfig')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--tweets', type=int, default=2000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user_ids = seed_graph(args.users, args.tweets, args.likes, seed=args.seed)
+        tweet_ids = [r[0] for r in db.session.query(Tweet.id)]
+    tokens = [generate_token({'id': i, 'username': f'bench{n}'}) for n, i in enumerate(user_ids)]
+    plan = make_plan(random.Random(args.seed), user_ids, tweet_ids, tokens, args.requests)
+
+    # warm both modes up on the same plan so timelines are built and caches equal
+    run_wsgi(app, plan, args.concurrency)
+    report('wsgi', *run_wsgi(app, plan, args.concurrency))
+    report('asgi', *asyncio.run(run_asgi(ASGIApp(app), plan, args.concurrency)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+'''Snowflake ids generated per second in one process
+
+    python -m benchmarks.ids --ids 1000000 --threads 4
+'''
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.ids import Snowflake
+
+
+def run(count, threads):
+    generator = Snowflake(worker_id=1)
+
+    def generate(n):
+        return [generator.next_id() for _ in range(n)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        chunks = list(executor.map(generate, [count // threads] * threads))
+    elapsed = time.perf_counter() - start
+
+    generated = [i for chunk in chunks for i in chunk]
+    assert len(set(generated)) == len(generated), 'duplicate ids'
+    assert all(a < b for chunk in chunks for a, b in zip(chunk, chunk[1:])), 'ids out of order'
+    ahead = generator.timestamp(generator.next_id()) - time.time()
+    print(f'threads={threads} ids={len(generated)}')
+    print(f'{len(generated) / elapsed:,.0f} ids/sec, clock ahead by {max(ahead, 0) * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ids', type=int, default=1000000)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+    run(args.ids, args.threads)
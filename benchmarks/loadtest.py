@@ -0,0 +1,217 @@
+'''Load test the API against a seeded social graph
+
+Seeds users, follows, tweets and likes through the models, then drives the
+real endpoints from concurrent threads, either through the Flask test
+client or against a running server with --url. Reports p50/p95/p99
+latency, throughput and SQL queries per request (test client only) for
+every scenario, and compares them to a saved baseline. The database of
+--config is dropped and seeded again on every run.
+
+    python -m benchmarks.loadtest --users 500 --requests 2000 --save baseline.json
+    python -m benchmarks.loadtest --users 500 --requests 2000 --baseline baseline.json
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from app import create_app
+from app.models import db, Tweet
+from app.utils import generate_token
+from benchmarks.seed import seed_graph, PASSWORD
+
+SCENARIOS = {
+    'home_timeline': 50,
+    'statuses': 20,
+    'like': 15,
+    'follow': 10,
+    'auth': 5,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class QueryCounter(object):
+    '''Counts SQL statements per thread'''
+
+    def __init__(self, engine):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    @property
+    def value(self):
+        return getattr(self.local, 'count', 0)
+
+
+class TestClientTransport(object):
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        headers = {'x-access-token': token} if token else {}
+        rv = self.local.client.open(path, method=method, headers=headers, data=json.dumps(body) if body else None,
+                                    content_type='application/json')
+        return rv.status_code
+
+
+class HTTPTransport(object):
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['x-access-token'] = token
+        data = json.dumps(body).encode('utf-8') if body else None
+        req = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+        with urllib.request.urlopen(req) as response:
+            response.read()
+            return response.status
+
+
+def make_request(scenario, rng, user_ids, tweet_ids, tokens):
+    user_index = rng.randrange(len(user_ids))
+    token = tokens[user_index]
+    if scenario == 'home_timeline':
+        return 'GET', '/statuses/home_timeline', None, token
+    if scenario == 'statuses':
+        return 'GET', '/statuses/', None, token
+    if scenario == 'like':
+        return 'POST', f'/statuses/like/{rng.choice(tweet_ids)}', None, token
+    if scenario == 'follow':
+        return 'POST', '/user/friendships/create', {'id': rng.choice(user_ids)}, token
+    return 'POST', '/user/auth', {'email': f'bench{user_index}@bench.local', 'password': PASSWORD}, None
+
+
+def run(transport, counter, user_ids, tweet_ids, tokens, requests, concurrency, scenarios, seed):
+    rng = random.Random(seed)
+    names = list(scenarios)
+    plan = [make_request(s, rng, user_ids, tweet_ids, tokens) + (s,)
+            for s in rng.choices(names, weights=[scenarios[n] for n in names], k=requests)]
+    results = defaultdict(lambda: {'latencies': [], 'queries': [], 'errors': 0})
+    lock = threading.Lock()
+
+    def call(item):
+        method, path, body, token, scenario = item
+        if counter:
+            counter.reset()
+        start = time.perf_counter()
+        try:
+            ok = transport.request(method, path, body, token) < 400
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            result = results[scenario]
+            result['latencies'].append(elapsed)
+            if counter:
+                result['queries'].append(counter.value)
+            if not ok:
+                result['errors'] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(call, plan))
+    wall = time.perf_counter() - start
+
+    report = {}
+    for scenario, result in sorted(results.items()):
+        latencies = result['latencies']
+        report[scenario] = {
+            'requests': len(latencies),
+            'errors': result['errors'],
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'throughput_rps': len(latencies) / wall,
+            'queries_per_request': (sum(result['queries']) / len(result['queries'])
+                                    if result['queries'] else None),
+        }
+    report['total'] = {'requests': requests, 'throughput_rps': requests / wall}
+    return report
+
+
+def format_delta(current, baseline):
+    if baseline in (None, 0) or current is None:
+        return ''
+    return f' ({(current - baseline) / baseline * 100:+.1f}%)'
+
+
+def print_report(report, baseline=None):
+    baseline = baseline or {}
+    for scenario, stats in report.items():
+        before = baseline.get(scenario, {})
+        line = [f'{scenario:>14}']
+        for key in ('requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'queries_per_request'):
+            if key not in stats or stats[key] is None:
+                continue
+            value = stats[key]
+            text = f'{value:.2f}' if isinstance(value, float) else str(value)
+            line.append(f'{key}={text}{format_delta(value, before.get(key))}')
+        print('  '.join(line))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='app.config.BenchmarkConfig')
+    parser.add_argument('--url', help='drive a running server instead of the test client')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--tweets', type=int, default=2000)
+    parser.add_argument('--likes', type=int, default=5000)
+    parser.add_argument('--follow-mean', type=float, default=20)
+    parser.add_argument('--follow-alpha', type=float, default=1.2)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='only run these scenarios, can be repeated')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the report as a JSON baseline')
+    parser.add_argument('--baseline', help='compare against a saved JSON baseline')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user_ids = seed_graph(args.users, args.tweets, args.likes, args.follow_mean,
+                              args.follow_alpha, args.seed)
+        tweet_ids = [r[0] for r in db.session.query(Tweet.id)]
+        tokens = [generate_token({'id': i, 'username': f'bench{n}'}) for n, i in enumerate(user_ids)]
+        counter = None if args.url else QueryCounter(db.engine)
+
+    transport = HTTPTransport(args.url) if args.url else TestClientTransport(app)
+    scenarios = {s: SCENARIOS[s] for s in args.scenario} if args.scenario else SCENARIOS
+    report = run(transport, counter, user_ids, tweet_ids, tokens, args.requests,
+                 args.concurrency, scenarios, args.seed)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+'''Logins per second per core for the password hashing service
+
+    python -m benchmarks.password_hashing --workers 4 --logins 200
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask
+from app.hashing import hasher
+
+
+def run(workers, logins, threads, iterations):
+    app = Flask(__name__)
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    app.config['PASSWORD_HASH_ITERATIONS'] = iterations
+    hasher.init_app(app)
+
+    def login(_):
+        with app.app_context():
+            return hasher.check(pwhash, 'password')
+
+    with app.app_context():
+        pwhash = hasher.hash('password')
+        # start the pool processes before timing
+        hasher.check(pwhash, 'password')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        assert all(executor.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+
+    cores = max(workers, 1)
+    print(f'workers={workers} threads={threads} iterations={iterations}')
+    print(f'{logins / elapsed:.1f} logins/sec, {logins / elapsed / cores:.1f} logins/sec per core')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='hashing processes, 0 hashes on the calling thread')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16,
+                        help='concurrent request threads')
+    parser.add_argument('--iterations', type=int, default=150000)
+    args = parser.parse_args()
+    run(args.workers, args.logins, args.threads, args.iterations)
@@ -0,0 +1,59 @@
+'''Seed a synthetic social graph through the models
+
+Follow targets are drawn from a power law, so a few accounts collect most
+of the followers like on the real site.
+'''
+import random
+from app.models import db, User, Tweet, Favorites, followers
+from app.counters import reconcile_counters
+from app.hashing import hasher
+
+PASSWORD = 'password'
+
+
+def power_law_weights(n, alpha):
+    return [1.0 / (rank ** alpha) for rank in range(1, n + 1)]
+
+
+def seed_graph(users=200, tweets=2000, likes=5000, follow_mean=20, follow_alpha=1.2, seed=0):
+    '''Create users, follows, tweets and likes, returns the created user ids'''
+    rng = random.Random(seed)
+
+    # hash once and bulk insert, the before_insert listener would hash every row
+    password_hash = hasher.hash(PASSWORD)
+    accounts = [{'username': f'bench{i}', 'email': f'bench{i}@bench.local',
+                 'password_hash': password_hash, 'verified': True} for i in range(users)]
+    db.session.bulk_insert_mappings(User, accounts, return_defaults=True)
+    db.session.commit()
+    user_ids = [u['id'] for u in accounts]
+
+    weights = power_law_weights(users, follow_alpha)
+    edges = set()
+    for follower_id in user_ids:
+        count = min(users - 1, int(rng.expovariate(1.0 / follow_mean)))
+        for followed_id in rng.choices(user_ids, weights=weights, k=count):
+            if followed_id != follower_id:
+                edges.add((follower_id, followed_id))
+    if edges:
+        db.session.execute(followers.insert(), [
+            {'follower_id': a, 'followed_id': b} for a, b in edges])
+
+    authors = rng.choices(user_ids, weights=weights, k=tweets)
+    statuses = []
+    for i, author_id in enumerate(authors):
+        status = Tweet(text=f'benchmark status {i}', user_id=author_id)
+        if statuses and rng.random() < 0.2:
+            status.in_reply_to_status = rng.choice(statuses)
+        statuses.append(status)
+    db.session.add_all(statuses)
+    db.session.commit()
+
+    tweet_ids = [t.id for t in statuses]
+    pairs = {(rng.choice(user_ids), rng.choice(tweet_ids)) for _ in range(likes)} if tweet_ids else set()
+    if pairs:
+        db.session.bulk_insert_mappings(Favorites, [
+            {'user_id': u, 'tweet_id': t} for u, t in pairs])
+    db.session.commit()
+
+    reconcile_counters()
+    return user_ids
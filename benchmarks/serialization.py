@@ -0,0 +1,65 @@
+'''Serialization throughput of a page of tweets, default path against the fast one
+
+Dumps a --page sized page with TweetSchema and encodes it the way
+jsonify does, once through marshmallow and flask.json, once through the
+compiled dumps with orjson and once with the stdlib fallback encoder.
+
+    python -m benchmarks.serialization --page 1000 --rounds 20
+'''
+import argparse
+import time
+from app import create_app
+from app.models import db, User, Tweet, TweetSchema, get_tweet_context
+from app.serializers import jsonify, make_dumps, orjson
+from benchmarks.seed import seed_graph
+
+
+def measure(app, tweets, viewer, rounds, fast, dumps=None):
+    state = app.extensions['serialization']
+    default_dumps = state['dumps']
+    state['fast'] = fast
+    state['dumps'] = dumps or default_dumps
+    try:
+        with app.test_request_context():
+            context = get_tweet_context(tweets, viewer)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                body = jsonify({'data': {'statuses': TweetSchema(many=True, context=context).dump(tweets)},
+                                'next_cursor': None, 'error': None}).get_data()
+            return time.perf_counter() - start, body
+    finally:
+        state['fast'] = False
+        state['dumps'] = default_dumps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='app.config.BenchmarkConfig')
+    parser.add_argument('--page', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_graph(users=100, tweets=args.page, likes=args.page * 2)
+        viewer = User.query.first()
+        tweets = Tweet.query.order_by(Tweet.id.desc()).limit(args.page).all()
+
+        modes = [('default', False, None)]
+        if orjson is not None:
+            modes.append(('orjson', True, None))
+        modes.append(('stdlib', True, make_dumps(app, use_orjson=False)))
+        bodies = {}
+        for mode, fast, dumps in modes:
+            # the first round compiles the dumps and warms the identity map
+            measure(app, tweets, viewer, 1, fast, dumps)
+            elapsed, bodies[mode] = measure(app, tweets, viewer, args.rounds, fast, dumps)
+            print(f'{mode:>8}  page={len(tweets)}  pages/sec={args.rounds / elapsed:.1f}  '
+                  f'tweets/sec={args.rounds * len(tweets) / elapsed:,.0f}  bytes={len(bodies[mode])}')
+        assert all(body == bodies['default'] for body in bodies.values()), 'bodies differ'
+
+
+if __name__ == '__main__':
+    main()